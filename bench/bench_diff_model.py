@@ -0,0 +1,104 @@
+"""Benchmark of common.diff_model on large synthetic diffs.
+
+Usage: python bench/bench_diff_model.py [--megabytes 8] [--files 400] [--lookups 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.diff_model import parse_patch, parse_unified_diff  # noqa: E402
+
+
+def make_file_diff(index, target_bytes, rng):
+    lines = [
+        f"diff --git a/src/module_{index}.py b/src/module_{index}.py",
+        "index 1111111..2222222 100644",
+        f"--- a/src/module_{index}.py",
+        f"+++ b/src/module_{index}.py",
+    ]
+    size = 0
+    new_line = 1
+    while size < target_bytes:
+        new_line += rng.randint(5, 60)
+        removed, added, context = rng.randint(0, 8), rng.randint(1, 12), 3
+        lines.append(f"@@ -{new_line},{removed + 2 * context} +{new_line},{added + 2 * context} @@ def function_{new_line}(self):")
+        body = [f"     context_line_{i} = value_{i}" for i in range(context)]
+        body += [f"-    removed_line_{i} = compute(old_{i})" for i in range(removed)]
+        body += [f"+    added_line_{i} = compute(new_{i}, extra={i})" for i in range(added)]
+        body += [f"     trailing_line_{i} = value_{i}" for i in range(context)]
+        lines.extend(body)
+        size += sum(len(line) + 1 for line in body)
+        new_line += added + 2 * context
+    return lines
+
+
+def make_diff(megabytes, files, seed=1):
+    rng = random.Random(seed)
+    per_file = megabytes * 1024 * 1024 // files
+    lines = []
+    for index in range(files):
+        lines.extend(make_file_diff(index, per_file, rng))
+    return lines
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    print(f"{label:<42} {(time.perf_counter() - start) * 1000:10.1f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megabytes", type=int, default=8)
+    parser.add_argument("--files", type=int, default=400)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    lines = make_diff(args.megabytes, args.files)
+    text = "\n".join(lines)
+    encoded = [line.encode() for line in lines]
+    print(f"diff: {len(text) / 1024 / 1024:.1f} MB, {len(lines)} lines, {args.files} files")
+
+    files = timed("parse_unified_diff (str lines)", lambda: list(parse_unified_diff(lines)))
+    timed("parse_unified_diff (bytes lines)", lambda: list(parse_unified_diff(encoded)))
+    timed("parse_unified_diff (index only)", lambda: list(parse_unified_diff(lines, keep=lambda f: False)))
+    patches = [file.render() for file in files]
+    timed("parse_patch for every file", lambda: [parse_patch(patch) for patch in patches])
+
+    tracemalloc.start()
+    kept = list(parse_unified_diff(lines))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{'memory of parsed diff':<42} {current / 1024 / 1024:10.1f} MB (peak {peak / 1024 / 1024:.1f} MB)")
+    del kept
+
+    rng = random.Random(2)
+    queries = []
+    for _ in range(args.lookups):
+        file = rng.choice(files)
+        line = rng.randint(1, file.hunks[-1].new_end if file.hunks else 1)
+        queries.append((file, line))
+
+    def touching():
+        return sum(len(file.hunks_touching(line, line + 20)) for file, line in queries)
+
+    def positions():
+        return sum(1 for file, line in queries if file.new_line_to_position(line) is not None)
+
+    def windows():
+        return sum(len(file.context_windows(20)) for file in files)
+
+    hits = timed(f"hunks_touching x{args.lookups}", touching)
+    mapped = timed(f"new_line_to_position x{args.lookups}", positions)
+    timed("context_windows for every file", windows)
+    print(f"{hits} hunks touched, {mapped} of {args.lookups} lines mapped to a diff position")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Simple HTTP load generator for the three services.
+
+Sends requests from a number of concurrent clients and reports throughput,
+latency percentiles and status codes. Run it once against the Flask
+development server (`python conversation.py`) and once against gunicorn
+(`gunicorn -c gunicorn.conf.py conversation:app`) to compare them.
+
+Examples:
+    python bench/load_test.py http://localhost:5000/healthz --concurrency 32 --requests 2000
+    python bench/load_test.py http://localhost:5000/file_content?repo_full_name=o/r&file_path=README.md \\
+        --header "X-Api-Key: $RHINO_API_KEY" --duration 30
+    # 带签名的 webhook，每个请求使用不同的 X-GitHub-Delivery
+    python bench/load_test.py http://localhost:8080/review_pr --method POST --data @payload.json \\
+        --webhook-secret "$WEBHOOK_SECRET" --header "X-GitHub-Event: pull_request"
+"""
+import argparse
+import hashlib
+import hmac
+import threading
+import time
+import uuid
+from collections import Counter
+
+import requests
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+class LoadTest:
+    def __init__(self, url, method="GET", data=None, headers=None, webhook_secret=None, timeout=60):
+        self.url = url
+        self.method = method
+        self.data = data
+        self.headers = headers or {}
+        self.webhook_secret = webhook_secret
+        self.timeout = timeout
+        self.latencies = []
+        self.statuses = Counter()
+        self.lock = threading.Lock()
+
+    def _headers(self):
+        headers = dict(self.headers)
+        if self.webhook_secret and self.data is not None:
+            headers["X-Hub-Signature-256"] = "sha256=" + hmac.new(
+                self.webhook_secret.encode(), msg=self.data, digestmod=hashlib.sha256
+            ).hexdigest()
+            headers["X-GitHub-Delivery"] = str(uuid.uuid4())
+        return headers
+
+    def _client(self, next_request, deadline):
+        session = requests.Session()
+        while next_request() and (deadline is None or time.monotonic() < deadline):
+            start = time.perf_counter()
+            try:
+                response = session.request(self.method, self.url, data=self.data, headers=self._headers(),
+                                           timeout=self.timeout)
+                response.content
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.latencies.append(elapsed)
+                self.statuses[status] += 1
+
+    def run(self, concurrency, total=None, duration=None):
+        remaining = [total]
+        remaining_lock = threading.Lock()
+
+        def next_request():
+            if remaining[0] is None:
+                return True
+            with remaining_lock:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+                return True
+
+        deadline = time.monotonic() + duration if duration else None
+        threads = [threading.Thread(target=self._client, args=(next_request, deadline)) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        count = len(self.latencies)
+        ok = sum(n for status, n in self.statuses.items() if isinstance(status, int) and status < 400)
+        print(f"requests:    {count} in {elapsed:.2f}s ({ok} successful)")
+        print(f"throughput:  {count / elapsed:.1f} req/s")
+        for label, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            print(f"latency {label}: {percentile(self.latencies, fraction) * 1000:.1f} ms")
+        print(f"max latency: {max(self.latencies, default=0) * 1000:.1f} ms")
+        print("status codes: " + ", ".join(f"{status}={n}" for status, n in sorted(self.statuses.items(), key=str)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--data", help="request body, or @file to read it from a file")
+    parser.add_argument("--header", action="append", default=[], help='extra header, e.g. "X-Api-Key: secret"')
+    parser.add_argument("--webhook-secret", help="sign the body like a GitHub webhook")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, help="total number of requests (default 1000 unless --duration is set)")
+    parser.add_argument("--duration", type=float, help="run for this many seconds instead of a fixed number of requests")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    data = None
+    if args.data is not None:
+        if args.data.startswith("@"):
+            with open(args.data[1:], "rb") as f:
+                data = f.read()
+        else:
+            data = args.data.encode()
+    headers = {}
+    for header in args.header:
+        name, _, value = header.partition(":")
+        headers[name.strip()] = value.strip()
+    if data is not None and "Content-Type" not in headers:
+        headers["Content-Type"] = "application/json"
+
+    total = args.requests if args.requests is not None or args.duration else 1000
+    test = LoadTest(args.url, args.method.upper(), data, headers, args.webhook_secret, args.timeout)
+    elapsed = test.run(args.concurrency, total=total, duration=args.duration)
+    test.report(elapsed)
+
+
+if __name__ == "__main__":
+    main()
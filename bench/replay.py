@@ -0,0 +1,403 @@
+"""Replay recorded payloads against the three services without network access.
+
+GitHub and OpenAI are replaced by the local stub servers in bench/stubs.py,
+which have configurable latency and payload sizes, and MongoDB by an
+in-memory mongomock client shared by all services. The services run
+in this process on werkzeug's threaded server, configured only through their
+usual environment variables (GITHUB_API_URL, OPENAI_API_BASE, ...).
+
+Scenarios:
+    review         signed pull_request webhooks to pr_review's /review_pr; the latency
+                   of the webhook and of the whole review (until the job is done)
+    conversation   /add-message (or /add-message-stream) on the review conversations
+    gh_interacter  the requests in payloads/gh_interacter_requests.json
+
+For each scenario the report has p50/p95/p99 latency, throughput, status
+codes, the tokens and requests the OpenAI stub received, the GitHub stub
+requests and the peak RSS of the process so far (stubs included).
+
+Examples:
+    pip install -r bench/requirements.txt
+    python bench/replay.py --requests 200 --concurrency 8
+    python bench/replay.py --scenarios review --openai-latency-ms 3000 --files 40 --json before.json
+"""
+import argparse
+import copy
+import hashlib
+import hmac
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from load_test import percentile
+from stubs import GitHubStub, OpenAIStub, SyntheticRepo
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+PAYLOAD_DIR = os.path.join(BENCH_DIR, "payloads")
+SECRET = "bench"
+JOB_FINISHED = ("done", "dead")
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def load_payload(name):
+    with open(os.path.join(PAYLOAD_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def use_in_memory_mongo():
+    # 各服务都调用 MongoClient('mongodb', 27017)，返回同一个内存客户端，使它们共享数据
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("mongomock is required: pip install -r bench/requirements.txt")
+    import pymongo
+
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+    return client
+
+
+def load_services(args, github, openai_stub):
+    """Configure the services for the stubs and import them."""
+    os.environ.update({
+        "GITHUB_API_URL": github.url,
+        "OPENAI_API_BASE": f"{openai_stub.url}/v1",
+        "OPENAI_API_KEY": "bench",
+        "WEBHOOK_SECRET": SECRET,
+        "SECRET_KEY_FOR_SESSION": SECRET,
+        "LOGIN_PASSWORD": SECRET,
+        "RHINO_API_KEY": SECRET,
+        # 本地队列只存在于当前进程中
+        "REVIEW_QUEUE_BACKEND": "local",
+        "REVIEW_DEBOUNCE_SECONDS": "0",
+    })
+    if args.github_token:
+        # gh_interacter 只在有 token 时使用 GraphQL 批量接口
+        os.environ["GITHUB_TOKEN"] = "bench"
+    os.environ.setdefault("REVIEW_WORKER_POLL_SECONDS", "0.02")
+    os.environ.setdefault("REVIEW_WORKERS", str(args.review_workers))
+    for service in ("pr_review", "conversation", "gh_interacter"):
+        sys.path.insert(0, os.path.join(REPO_ROOT, service))
+    sys.path.insert(0, REPO_ROOT)
+
+    use_in_memory_mongo()
+    import pr_review
+    import conversation
+    import gh_interacter
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    pr_review.start_background_workers()
+    return pr_review, conversation, gh_interacter
+
+
+def serve(app):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class Scenario:
+    """Runs `work(client, n, session)` from `concurrency` clients until `total` calls are done.
+
+    `work` returns a dict of measurements: `status` plus any latencies in
+    seconds, e.g. `{"status": 200, "latency": 0.12}`.
+    """
+
+    def __init__(self, name, work, setup=None):
+        self.name = name
+        self.work = work
+        self.setup = setup
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def _client(self, client, next_call):
+        session = requests.Session()
+        if self.setup is not None:
+            self.setup(session)
+        n = 0
+        while next_call():
+            try:
+                sample = self.work(client, n, session)
+            except requests.RequestException as e:
+                sample = {"status": type(e).__name__}
+            n += 1
+            with self.lock:
+                self.samples.append(sample)
+
+    def run(self, concurrency, total):
+        remaining = [total]
+        remaining_lock = threading.Lock()
+
+        def next_call():
+            with remaining_lock:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+                return True
+
+        threads = [threading.Thread(target=self._client, args=(i, next_call)) for i in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def summary(self, elapsed):
+        statuses = Counter(sample["status"] for sample in self.samples)
+        result = {
+            "requests": len(self.samples),
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_per_second": round(len(self.samples) / elapsed, 2) if elapsed else 0.0,
+            "status_codes": {str(status): n for status, n in sorted(statuses.items(), key=str)},
+        }
+        keys = sorted({key for sample in self.samples for key in sample if key != "status"})
+        for key in keys:
+            values = [sample[key] for sample in self.samples if key in sample]
+            result[key] = {
+                label: round(percentile(values, fraction) * 1000, 1)
+                for label, fraction in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99))
+            }
+            result[key]["max_ms"] = round(max(values) * 1000, 1)
+        return result
+
+
+def signed_headers(body, delivery):
+    return {
+        "Content-Type": "application/json",
+        "X-GitHub-Event": "pull_request",
+        "X-GitHub-Delivery": delivery,
+        "X-Hub-Signature-256": "sha256=" + hmac.new(SECRET.encode(), msg=body, digestmod=hashlib.sha256).hexdigest(),
+    }
+
+
+def review_scenario(args, github, url, event_ids):
+    templates = {action: load_payload(f"pull_request_{action}.json") for action in ("opened", "synchronize")}
+
+    def work(client, n, session):
+        # 每个客户端只处理自己的PR，同一个PR的事件依次发送，后面的推送不会取代还没完成的review
+        pr_number = client * 1000 + n % args.prs_per_client + 1
+        action = "opened" if n < args.prs_per_client else "synchronize"
+        event = copy.deepcopy(templates[action])
+        repo = event["repository"]["full_name"]
+        head_sha = hashlib.sha1(f"{args.seed}-{client}-{n}".encode()).hexdigest()
+        event["number"] = event["pull_request"]["number"] = pr_number
+        event["pull_request"]["head"]["sha"] = head_sha
+        github.heads[(repo, pr_number)] = head_sha
+        body = json.dumps(event).encode()
+        delivery = f"bench-{args.seed}-{client}-{n}"
+
+        start = time.perf_counter()
+        response = session.post(f"{url}/review_pr", data=body, headers=signed_headers(body, delivery))
+        sample = {"status": response.status_code, "webhook_latency": time.perf_counter() - start}
+        if response.status_code != 202:
+            return sample
+
+        deadline = time.monotonic() + args.review_timeout
+        while time.monotonic() < deadline:
+            job = session.get(f"{url}/jobs/{delivery}").json()
+            if job["status"] in JOB_FINISHED:
+                break
+            time.sleep(0.01)
+        else:
+            sample["status"] = "review_timeout"
+            return sample
+        sample["review_latency"] = time.perf_counter() - start
+        if job["status"] != "done":
+            sample["status"] = "review_failed"
+        elif "skipped" in (job.get("result") or {}):
+            sample["status"] = "review_skipped"
+        else:
+            event_ids.append(delivery)
+        return sample
+
+    return Scenario("review", work)
+
+
+def wait_for_writes(mongo_writer, timeout=30):
+    """Wait until pr_review's background writer has handled every submitted operation.
+
+    Exits when any operation was dropped or failed: the later scenarios would
+    otherwise run against missing conversations and still report results.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = mongo_writer.stats()
+        if stats["dropped"] or stats["failed"]:
+            sys.exit(f"pr_review's MongoDB writer lost operations, check the versions in bench/requirements.txt: {stats}")
+        if stats["written"] >= stats["submitted"] and not stats["queued"]:
+            return
+        if time.monotonic() > deadline:
+            sys.exit(f"pr_review's MongoDB writer did not finish in {timeout}s: {stats}")
+        time.sleep(0.05)
+
+
+def check_conversations(conversation, event_ids):
+    missing = [uuid for uuid in event_ids if conversation.collection.find_one({"uuid": uuid}) is None]
+    if missing:
+        sys.exit(f"{len(missing)} of {len(event_ids)} conversations are missing, e.g. {missing[0]}")
+
+
+def seed_conversations(conversation, repo_data, count):
+    # 没有运行 review 场景时，按 review 保存的格式直接写入对话
+    event_ids = []
+    for i in range(count):
+        head_sha = hashlib.sha1(f"seed-{i}".encode()).hexdigest()
+        prompt = "Review the following pull request.\n" + repo_data.diff(head_sha)
+        messages = [
+            {"role": "system", "content": "As an AI assistant with expertise in programming, review the pull request."},
+            {"role": "user", "content": prompt},
+            {"role": "assistant", "content": "**[Changes]** Refactors request handling."},
+        ]
+        uuid = f"bench-seed-{i}"
+        conversation.collection.insert_one({"uuid": uuid, "messages": conversation.content_store.store(messages)})
+        event_ids.append(uuid)
+    return event_ids
+
+
+def conversation_scenario(args, url, event_ids):
+    questions = load_payload("conversation_questions.json")
+    endpoint = "/add-message-stream" if args.stream else "/add-message"
+
+    def setup(session):
+        session.post(f"{url}/login", data={"password": SECRET}, allow_redirects=False)
+
+    def work(client, n, session):
+        uuid = event_ids[(client + n * args.concurrency) % len(event_ids)]
+        payload = {"uuid": uuid, "content": questions[n % len(questions)]}
+        start = time.perf_counter()
+        if not args.stream:
+            response = session.post(f"{url}{endpoint}", json=payload)
+            return {"status": response.status_code, "latency": time.perf_counter() - start}
+
+        sample = {}
+        with session.post(f"{url}{endpoint}", json=payload, stream=True) as response:
+            status = response.status_code
+            for line in response.iter_lines():
+                if line.startswith(b"data:") and "time_to_first_token" not in sample:
+                    sample["time_to_first_token"] = time.perf_counter() - start
+                if line.startswith(b"event: error"):
+                    status = "stream_error"
+        sample.update(status=status, latency=time.perf_counter() - start)
+        return sample
+
+    return Scenario("conversation", work, setup)
+
+
+def gh_interacter_scenario(args, url):
+    calls = load_payload("gh_interacter_requests.json")
+    headers = {"X-Api-Key": SECRET}
+
+    def work(client, n, session):
+        call = calls[(client + n) % len(calls)]
+        pr_number = client * 1000 + n % args.prs_per_client + 1
+        params = {key: value.replace("{pr}", str(pr_number)) for key, value in call.get("params", {}).items()}
+        start = time.perf_counter()
+        response = session.request(call["method"], f"{url}{call['path']}", params=params,
+                                   json=call.get("json"), headers=headers)
+        response.content
+        return {"status": response.status_code, "latency": time.perf_counter() - start}
+
+    return Scenario("gh_interacter", work)
+
+
+def print_report(name, result):
+    print(f"== {name}")
+    print(f"requests:     {result['requests']} in {result['elapsed_seconds']:.2f}s "
+          f"({result['throughput_per_second']:.1f}/s)")
+    print("status codes: " + ", ".join(f"{status}={n}" for status, n in result["status_codes"].items()))
+    for key, value in result.items():
+        if isinstance(value, dict) and "p50_ms" in value:
+            print(f"{key + ':':<21} p50 {value['p50_ms']:.1f} ms, p95 {value['p95_ms']:.1f} ms, "
+                  f"p99 {value['p99_ms']:.1f} ms, max {value['max_ms']:.1f} ms")
+    openai_stats = result["openai"]
+    print(f"openai:       {openai_stats['requests']} requests, {openai_stats['prompt_tokens']} prompt tokens, "
+          f"{openai_stats['completion_tokens']} completion tokens")
+    print(f"github:       {result['github_requests']} requests")
+    print(f"peak RSS:     {result['peak_rss_mb']:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="review,conversation,gh_interacter")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--prs-per-client", type=int, default=2, help="later events of the same PR are synchronize")
+    parser.add_argument("--review-workers", type=int, default=4)
+    parser.add_argument("--review-timeout", type=float, default=120)
+    parser.add_argument("--stream", action="store_true", help="use /add-message-stream")
+    parser.add_argument("--github-token", action="store_true", help="make gh_interacter use GraphQL for batches")
+    parser.add_argument("--github-latency-ms", type=float, default=20)
+    parser.add_argument("--openai-latency-ms", type=float, default=200)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--stream-chunk-ms", type=float, default=0)
+    parser.add_argument("--files", type=int, default=10, help="changed files per PR")
+    parser.add_argument("--file-lines", type=int, default=400)
+    parser.add_argument("--hunks", type=int, default=3, help="hunks per file")
+    parser.add_argument("--completion-chars", type=int, default=1500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="keep the services' logs")
+    args = parser.parse_args()
+
+    repo_data = SyntheticRepo(args.files, args.file_lines, args.hunks, args.seed)
+    github = GitHubStub(repo_data, latency_ms=args.github_latency_ms, jitter_ms=args.jitter_ms, seed=args.seed).start()
+    openai_stub = OpenAIStub(args.completion_chars, args.stream_chunk_ms, latency_ms=args.openai_latency_ms,
+                             jitter_ms=args.jitter_ms, seed=args.seed + 1).start()
+    pr_review, conversation, gh_interacter = load_services(args, github, openai_stub)
+    urls = {name: serve(module.app)[1] for name, module in
+            (("review", pr_review), ("conversation", conversation), ("gh_interacter", gh_interacter))}
+
+    event_ids = []
+    results = {"config": vars(args), "scenarios": {}}
+    for name in args.scenarios.split(","):
+        if name == "review":
+            scenario = review_scenario(args, github, urls[name], event_ids)
+        elif name == "conversation":
+            # 等待后台写入完成，review 的对话才能被读到
+            wait_for_writes(pr_review.mongo_writer)
+            if not event_ids:
+                event_ids.extend(seed_conversations(conversation, repo_data, args.concurrency))
+            check_conversations(conversation, event_ids)
+            scenario = conversation_scenario(args, urls[name], list(event_ids))
+        elif name == "gh_interacter":
+            scenario = gh_interacter_scenario(args, urls[name])
+        else:
+            parser.error(f"unknown scenario {name}")
+
+        openai_before, github_before = openai_stub.stats(), github.requests
+        elapsed = scenario.run(args.concurrency, args.requests)
+        openai_after = openai_stub.stats()
+        result = scenario.summary(elapsed)
+        result["openai"] = {key: openai_after[key] - openai_before[key] for key in openai_after}
+        result["github_requests"] = github.requests - github_before
+        result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        results["scenarios"][name] = result
+        print_report(name, result)
+
+    wait_for_writes(pr_review.mongo_writer)
+    pr_review.stop_background_workers(timeout=10)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""Local stand-ins for the GitHub and OpenAI APIs used by bench/replay.py.
+
+Both servers answer from deterministic synthetic data, so runs are
+reproducible without network access. Every response is delayed by
+`latency_ms` plus a random jitter drawn from a seeded generator.
+"""
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+WORDS = ("value", "result", "config", "request", "items", "index", "buffer", "client", "cache", "token", "offset", "payload")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency_ms=0, jitter_ms=0, seed=0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def delay(self):
+        with self.lock:
+            self.requests += 1
+            jitter = self.random.uniform(0, self.jitter_ms) if self.jitter_ms else 0
+        if self.latency_ms or jitter:
+            time.sleep((self.latency_ms + jitter) / 1000)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SyntheticRepo:
+    """Deterministic PR files: `files` files of `file_lines` lines with `hunks` hunks each."""
+
+    def __init__(self, files=10, file_lines=400, hunks=3, seed=0):
+        self.files = files
+        self.file_lines = file_lines
+        self.hunks = hunks
+        self.seed = seed
+
+    def _random(self, *key):
+        return random.Random(hashlib.sha1(repr((self.seed,) + key).encode()).hexdigest())
+
+    def path(self, index):
+        return f"src/module_{index}.py"
+
+    def changed(self, path):
+        # 只有前三分之一的文件随每次推送变化，其余文件在各个 head 上相同（可以命中 blob 缓存）
+        match = re.search(r"(\d+)", path)
+        return match is not None and int(match.group(1)) < max(self.files // 3, 1)
+
+    def content(self, head_sha, path):
+        rng = self._random(head_sha if self.changed(path) else None, path)
+        lines = []
+        while len(lines) < self.file_lines:
+            name = rng.choice(WORDS)
+            lines.append(f"def {name}_{len(lines)}({rng.choice(WORDS)}, {rng.choice(WORDS)}=None):")
+            for _ in range(rng.randint(3, 12)):
+                lines.append(f"    {rng.choice(WORDS)} = {rng.choice(WORDS)}.get({rng.choice(WORDS)!r}, {rng.randint(0, 999)})")
+            lines.append(f"    return {rng.choice(WORDS)}")
+            lines.append("")
+        return "\n".join(lines[:self.file_lines])
+
+    def patch(self, head_sha, path):
+        # 每个 hunk：3行上下文，2行新增，3行上下文
+        lines = self.content(head_sha, path).split("\n")
+        step = max(len(lines) // self.hunks, 10)
+        hunks = []
+        removed = 0
+        for start in range(4, min(len(lines) - 8, step * self.hunks), step):
+            old_start = start - removed
+            body = [" " + line for line in lines[start - 1:start + 2]]
+            body += ["+" + line for line in lines[start + 2:start + 4]]
+            body += [" " + line for line in lines[start + 4:start + 7]]
+            hunks.append(f"@@ -{old_start},6 +{start},8 @@\n" + "\n".join(body))
+            removed += 2
+        return "\n".join(hunks)
+
+    def pr_files(self, head_sha):
+        files = []
+        for index in range(self.files):
+            path = self.path(index)
+            content = self.content(head_sha, path)
+            files.append({
+                "sha": hashlib.sha1(f"blob {len(content)}\0{content}".encode()).hexdigest(),
+                "filename": path,
+                "status": "modified",
+                "additions": 2 * self.hunks,
+                "deletions": 0,
+                "changes": 2 * self.hunks,
+                "patch": self.patch(head_sha, path),
+            })
+        return files
+
+    def diff(self, head_sha):
+        parts = []
+        for file in self.pr_files(head_sha):
+            path = file["filename"]
+            parts.append(f"diff --git a/{path} b/{path}\nindex 0000000..{file['sha'][:7]} 100644\n"
+                         f"--- a/{path}\n+++ b/{path}\n{file['patch']}\n")
+        return "".join(parts)
+
+
+class GitHubHandler(StubHandler):
+    ROUTES = [
+        ("GET", re.compile(r"^/repos/([^/]+/[^/]+)$"), "repo"),
+        ("GET", re.compile(r"^/repos/([^/]+/[^/]+)/pulls/(\d+)$"), "pull"),
+        ("GET", re.compile(r"^/repos/([^/]+/[^/]+)/pulls/(\d+)/files$"), "pull_files"),
+        ("GET", re.compile(r"^/repos/([^/]+/[^/]+)/issues/(\d+)$"), "issue"),
+        ("POST", re.compile(r"^/repos/([^/]+/[^/]+)/issues/(\d+)/comments$"), "comment"),
+        ("GET", re.compile(r"^/repos/([^/]+/[^/]+)/contents/(.+)$"), "contents"),
+        ("GET", re.compile(r"^/repos/([^/]+/[^/]+)/branches/(.+)$"), "branch"),
+        ("GET", re.compile(r"^/repos/([^/]+/[^/]+)/compare/([0-9a-f]+)\.\.\.([0-9a-f]+)$"), "compare"),
+        ("POST", re.compile(r"^/graphql$"), "graphql"),
+    ]
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def route(self, method):
+        self.server.delay()
+        url = urlparse(self.path)
+        self.query = parse_qs(url.query)
+        for route_method, pattern, name in self.ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                return getattr(self, name)(*[unquote(group) for group in match.groups()])
+        self.send_body(404, {"message": "Not Found"})
+
+    def head_sha(self, repo, number):
+        # 由 replay 设置每个 PR 当前的 head
+        return self.server.heads.get((repo, int(number)), hashlib.sha1(f"{repo}#{number}".encode()).hexdigest())
+
+    def repo(self, repo):
+        self.send_body(200, {
+            "id": 1, "full_name": repo, "name": repo.split("/")[1], "default_branch": "main",
+            "url": f"{self.server.url}/repos/{repo}", "owner": {"login": repo.split("/")[0]},
+        })
+
+    def pull_json(self, repo, number):
+        head_sha = self.head_sha(repo, number)
+        files = self.server.repo_data.files
+        return {
+            "url": f"{self.server.url}/repos/{repo}/pulls/{number}",
+            "issue_url": f"{self.server.url}/repos/{repo}/issues/{number}",
+            "number": int(number),
+            "title": f"Benchmark PR #{number}",
+            "body": f"Refactors the request handling. Fixes #{int(number) + 1000}.",
+            "state": "open",
+            "head": {"sha": head_sha, "ref": f"feature-{number}", "repo": {"full_name": repo}},
+            "base": {"sha": "b" * 40, "ref": "main", "repo": {"full_name": repo}},
+            "changed_files": files,
+            "additions": files * 2 * self.server.repo_data.hunks,
+            "deletions": 0,
+        }
+
+    def pull(self, repo, number):
+        if "diff" in (self.headers.get("Accept") or ""):
+            diff = self.server.repo_data.diff(self.head_sha(repo, number)).encode()
+            return self.send_body(200, diff, content_type="text/plain; charset=utf-8")
+        self.send_body(200, self.pull_json(repo, number))
+
+    def pull_files(self, repo, number):
+        if int(self.query.get("page", ["1"])[0]) > 1:
+            return self.send_body(200, [])
+        self.send_body(200, self.server.repo_data.pr_files(self.head_sha(repo, number)))
+
+    def issue(self, repo, number):
+        self.send_body(200, {
+            "url": f"{self.server.url}/repos/{repo}/issues/{number}",
+            "number": int(number),
+            "title": f"Issue {number}",
+            "body": "Requests time out when the cache is cold. " * 20,
+        })
+
+    def comment(self, repo, number):
+        body = self.read_json().get("body", "")
+        with self.server.lock:
+            self.server.comments += 1
+        self.send_body(201, {"id": 1, "body": body, "html_url": f"{self.server.url}/{repo}/pull/{number}#comment"})
+
+    def contents(self, repo, path):
+        ref = self.query.get("ref", ["main"])[0]
+        content = self.server.repo_data.content(ref, path)
+        self.send_body(200, {
+            "type": "file", "name": path.rsplit("/", 1)[-1], "path": path, "encoding": "base64",
+            "sha": hashlib.sha1(f"blob {len(content)}\0{content}".encode()).hexdigest(),
+            "size": len(content),
+            "content": base64.b64encode(content.encode()).decode(),
+            "url": f"{self.server.url}/repos/{repo}/contents/{path}",
+        })
+
+    def branch(self, repo, branch):
+        self.send_body(200, {"name": branch, "commit": {"sha": hashlib.sha1(f"{repo}@{branch}".encode()).hexdigest()}})
+
+    def compare(self, repo, base, head):
+        self.send_body(200, {
+            "status": "ahead",
+            "commits": [{"sha": head, "parents": [{"sha": base}]}],
+            "files": self.server.repo_data.pr_files(head)[:max(self.server.repo_data.files // 3, 1)],
+        })
+
+    def graphql(self):
+        variables = self.read_json().get("variables", {})
+        repository = {}
+        for key, value in variables.items():
+            if key.startswith("e"):
+                ref, path = value.split(":", 1)
+                content = self.server.repo_data.content(ref, path)
+                repository["f" + key[1:]] = {
+                    "oid": hashlib.sha1(content.encode()).hexdigest(),
+                    "text": content, "isBinary": False, "isTruncated": False,
+                }
+            elif key.startswith("n"):
+                repository["i" + key[1:]] = {"title": f"Issue {value}", "body": "Issue body. " * 20}
+        self.send_body(200, {"data": {"repository": repository}})
+
+
+class GitHubStub(StubServer):
+    def __init__(self, repo_data, **kwargs):
+        super().__init__(GitHubHandler, **kwargs)
+        self.repo_data = repo_data
+        self.heads = {}
+        self.comments = 0
+
+
+class OpenAIHandler(StubHandler):
+    def do_POST(self):
+        self.server.delay()
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self.send_body(404, {"error": {"message": "Not Found"}})
+        request = self.read_json()
+        prompt_chars = sum(len(message.get("content") or "") for message in request.get("messages", []))
+        content = self.server.completion(request)
+        prompt_tokens, completion_tokens = prompt_chars // 4 + 1, len(content) // 4 + 1
+        self.server.record(request.get("model"), prompt_tokens, completion_tokens)
+
+        if not request.get("stream"):
+            return self.send_body(200, {
+                "id": "chatcmpl-bench", "object": "chat.completion", "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens},
+            })
+
+        # server-sent events，每块约16个字符
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for start in range(0, len(content), 16):
+            chunk = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "model": request.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": content[start:start + 16]}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.server.stream_chunk_ms:
+                time.sleep(self.server.stream_chunk_ms / 1000)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+class OpenAIStub(StubServer):
+    def __init__(self, completion_chars=1500, stream_chunk_ms=0, **kwargs):
+        super().__init__(OpenAIHandler, **kwargs)
+        self.completion_chars = completion_chars
+        self.stream_chunk_ms = stream_chunk_ms
+        self.tokens = {"prompt_tokens": 0, "completion_tokens": 0}
+
+    def completion(self, request):
+        text = ("**[Changes]** Refactors request handling.\n**[Suggestions]** Check the cache keys. "
+                * (self.completion_chars // 80 + 1))[:self.completion_chars]
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            return json.dumps({"en": text, "zh": text})
+        return text
+
+    def record(self, model, prompt_tokens, completion_tokens):
+        with self.lock:
+            self.tokens["prompt_tokens"] += prompt_tokens
+            self.tokens["completion_tokens"] += completion_tokens
+
+    def stats(self):
+        with self.lock:
+            return dict(self.tokens, requests=self.requests)
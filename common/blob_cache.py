@@ -0,0 +1,156 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class DiskBlobStore:
+    # 以 blob SHA 为文件名存储在本地目录中，适合单节点部署
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, sha):
+        return os.path.join(self.directory, sha[:2], sha)
+
+    def get(self, sha):
+        try:
+            with open(self._path(sha), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, sha, content):
+        path = self._path(sha)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再重命名，避免并发读到写了一半的文件
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+class MongoBlobStore:
+    # MongoDB 单个文档不能超过 16MB，更大的文件只保存在内存中
+    max_document_bytes = 15 * 1024 * 1024
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, sha):
+        doc = self.collection.find_one({"_id": sha}, {"content": 1})
+        return doc["content"] if doc else None
+
+    def put(self, sha, content):
+        if len(content) > self.max_document_bytes:
+            return
+        self.collection.update_one({"_id": sha}, {"$setOnInsert": {"content": content}}, upsert=True)
+
+
+class BlobCache:
+    """Content-addressed cache of decoded file bodies keyed by git blob SHA.
+
+    Blob SHAs are immutable, so entries never go stale and only need to be
+    evicted for space. The in-memory tier is an LRU bounded by `max_bytes`;
+    an optional `backing` store (`DiskBlobStore` or `MongoBlobStore`) keeps
+    evicted blobs and shares them across processes.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, backing=None):
+        self.max_bytes = max_bytes
+        self.backing = backing
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.backing_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sha):
+        with self._lock:
+            content = self._entries.get(sha)
+            if content is not None:
+                self._entries.move_to_end(sha)
+                self.hits += 1
+                return content
+
+        content = None
+        if self.backing is not None:
+            try:
+                content = self.backing.get(sha)
+            except Exception as e:
+                logger.warning(f"Error while reading blob {sha} from the cache backing store: {e}")
+        with self._lock:
+            if content is None:
+                self.misses += 1
+                return None
+            self.backing_hits += 1
+        self._put_memory(sha, content)
+        return content
+
+    def put(self, sha, content):
+        self._put_memory(sha, content)
+        if self.backing is not None:
+            try:
+                self.backing.put(sha, content)
+            except Exception as e:
+                logger.warning(f"Error while writing blob {sha} to the cache backing store: {e}")
+
+    def get_or_fetch(self, sha, fetch):
+        # fetch() 只在缓存未命中时调用，返回解码后的文件内容
+        content = self.get(sha)
+        if content is None:
+            content = fetch()
+            self.put(sha, content)
+        return content
+
+    def _put_memory(self, sha, content):
+        size = len(content.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if sha in self._entries:
+                self._entries.move_to_end(sha)
+                return
+            self._entries[sha] = content
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.encode("utf-8"))
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "backing_hits": self.backing_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+def blob_cache_from_env(mongo_db=None):
+    """Build the cache from BLOB_CACHE_* environment variables.
+
+    BLOB_CACHE_BACKEND is "memory" (default), "disk" (BLOB_CACHE_DIR) or
+    "mongo", which uses `mongo_db` when the service already has one, and
+    otherwise connects to BLOB_CACHE_MONGO_URI.
+    """
+    max_bytes = int(os.environ.get("BLOB_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    backend = os.environ.get("BLOB_CACHE_BACKEND", "memory")
+    backing = None
+    if backend == "disk":
+        backing = DiskBlobStore(os.environ.get("BLOB_CACHE_DIR", "/tmp/blob_cache"))
+    elif backend == "mongo":
+        if mongo_db is None:
+            from pymongo import MongoClient
+            mongo_db = MongoClient(os.environ.get("BLOB_CACHE_MONGO_URI", "mongodb://mongodb:27017"))["pr_review"]
+        backing = MongoBlobStore(mongo_db["blob_cache"])
+    return BlobCache(max_bytes=max_bytes, backing=backing)
@@ -0,0 +1,30 @@
+def indent(line):
+    return len(line) - len(line.lstrip())
+
+
+def block_end(lines, start):
+    """Index of the last line of the block whose definition is on `lines[start]`.
+
+    Blocks are delimited by braces when the definition line or the next one
+    opens one, and by indentation otherwise (Python, YAML, Ruby, ...).
+    """
+    text = lines[start]
+    if "{" in text or (start + 1 < len(lines) and lines[start + 1].strip().startswith("{")):
+        depth = 0
+        opened = False
+        for index in range(start, len(lines)):
+            # 粗略处理，不区分字符串和注释中的括号
+            depth += lines[index].count("{") - lines[index].count("}")
+            opened = opened or "{" in lines[index]
+            if opened and depth <= 0:
+                return index
+        return len(lines) - 1
+    level = indent(text)
+    end = start
+    for index in range(start + 1, len(lines)):
+        if not lines[index].strip():
+            continue
+        if indent(lines[index]) <= level:
+            break
+        end = index
+    return end
@@ -0,0 +1,87 @@
+import hashlib
+import os
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+PREVIEW_CHARS = 300
+
+
+class ContentStore:
+    """Content-addressed storage for large message bodies.
+
+    Messages longer than `min_chars` are stored once in their own collection
+    (`conversation_contents`), keyed by the SHA-256 of the content, and the
+    conversation only keeps a `content_ref` with the length and a short
+    preview. This keeps conversation documents small and far from the 16 MB
+    document limit, and identical prompts are stored only once.
+    """
+
+    def __init__(self, collection, min_chars=8192):
+        self.collection = collection
+        self.min_chars = min_chars
+
+    @staticmethod
+    def content_ref(content):
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def externalize(self, messages):
+        """Return `(stored_messages, operations)` for a list of messages.
+
+        The operations insert the large bodies and have to be written (see
+        `write`) before the stored messages are.
+        """
+        stored, operations = [], []
+        for message in messages:
+            content = message.get("content") or ""
+            # 其他字段（例如 cached）原样保存
+            extra = {key: value for key, value in message.items() if key not in ("role", "content")}
+            if len(content) <= self.min_chars:
+                stored.append({"role": message["role"], "content": content, **extra})
+                continue
+            ref = self.content_ref(content)
+            operations.append(UpdateOne(
+                {"_id": ref},
+                {"$setOnInsert": {"content": content, "length": len(content), "created_at": datetime.utcnow()}},
+                upsert=True,
+            ))
+            stored.append({
+                "role": message["role"],
+                "content_ref": ref,
+                "length": len(content),
+                "preview": content[:PREVIEW_CHARS],
+                **extra,
+            })
+        return stored, operations
+
+    def write(self, operations):
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def store(self, messages):
+        # 先写入内容，再由调用方写入引用这些内容的消息
+        stored, operations = self.externalize(messages)
+        self.write(operations)
+        return stored
+
+    def resolve(self, messages):
+        """Return the messages with every `content_ref` replaced by its content."""
+        refs = {message["content_ref"] for message in messages if "content_ref" in message}
+        if not refs:
+            return list(messages)
+        contents = {
+            doc["_id"]: doc["content"]
+            for doc in self.collection.find({"_id": {"$in": list(refs)}}, {"content": 1})
+        }
+        resolved = []
+        for message in messages:
+            if "content_ref" in message:
+                ref = message["content_ref"]
+                message = {key: value for key, value in message.items() if key not in ("content_ref", "length", "preview")}
+                message["content"] = contents.get(ref, "")
+            resolved.append(message)
+        return resolved
+
+
+def content_store_from_env(db):
+    return ContentStore(db["conversation_contents"], min_chars=int(os.environ.get("CONTENT_STORE_MIN_CHARS", "8192")))
@@ -0,0 +1,251 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@ ?(.*)")
+
+# Hunk.kinds 中每一行的类型
+CONTEXT = ord(" ")
+ADDED = ord("+")
+REMOVED = ord("-")
+NO_NEWLINE = ord("\\")
+
+
+class Hunk:
+    """One hunk of a file diff.
+
+    `lines` keep their +/-/space prefix and `kinds[i]` is the kind of
+    `lines[i]`. `added` holds the new-file line numbers of the added lines and
+    `removed` the old-file line numbers of the removed ones. `position` is the
+    GitHub diff position of the @@ line, counted from the first hunk of the
+    file.
+    """
+
+    __slots__ = ("old_start", "old_count", "new_start", "new_count", "section", "header",
+                 "position", "kinds", "lines", "added", "removed")
+
+    def __init__(self, old_start, old_count, new_start, new_count, section, header, position):
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.section = section
+        self.header = header
+        self.position = position
+        self.kinds = array("B")
+        self.lines = []
+        self.added = array("l")
+        self.removed = array("l")
+
+    @property
+    def new_end(self):
+        # 纯删除的 hunk 也占用 new_start 这一行，便于查找
+        return self.new_start + max(self.new_count, 1) - 1
+
+    @property
+    def old_end(self):
+        return self.old_start + max(self.old_count, 1) - 1
+
+    def touches(self, start, end):
+        return self.new_start <= end and start <= self.new_end
+
+    def new_line_to_position(self, line):
+        new_line = self.new_start
+        for offset, kind in enumerate(self.kinds, 1):
+            if kind == REMOVED or kind == NO_NEWLINE:
+                continue
+            if new_line == line:
+                return self.position + offset
+            new_line += 1
+        return None
+
+    def render(self):
+        return "\n".join([self.header] + self.lines)
+
+    def __repr__(self):
+        return f"Hunk(-{self.old_start},{self.old_count} +{self.new_start},{self.new_count})"
+
+
+class FileDiff:
+    """The hunks of one file, ordered by their position in the new file."""
+
+    __slots__ = ("path", "previous_path", "status", "binary", "hunks", "hunk_count",
+                 "additions", "deletions", "size", "_new_starts", "_new_ends")
+
+    def __init__(self, path, status="modified", previous_path=None):
+        self.path = path
+        self.previous_path = previous_path
+        self.status = status
+        self.binary = False
+        self.hunks = []
+        # 不保留内容时 hunks 为空，hunk_count 仍然记录数量
+        self.hunk_count = 0
+        self.additions = 0
+        self.deletions = 0
+        self.size = 0
+        self._new_starts = array("l")
+        self._new_ends = array("l")
+
+    def hunks_touching(self, start, end):
+        """Hunks that overlap lines `start`..`end` of the new file."""
+        low = bisect_left(self._new_ends, start)
+        high = bisect_right(self._new_starts, end)
+        return self.hunks[low:high]
+
+    def context_window(self, hunk, radius, total_lines=None):
+        start = max(hunk.new_start - radius, 1)
+        end = hunk.new_end + radius
+        if total_lines is not None:
+            end = min(end, total_lines)
+        return start, end
+
+    def context_windows(self, radius, total_lines=None):
+        # 所有 hunk 的上下文窗口，重叠或相邻的窗口合并
+        windows = []
+        for hunk in self.hunks:
+            start, end = self.context_window(hunk, radius, total_lines)
+            if windows and start <= windows[-1][1] + 1:
+                windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+            else:
+                windows.append((start, end))
+        return windows
+
+    def new_line_to_position(self, line):
+        """GitHub diff position of a line of the new file, None when it is not in the diff."""
+        for hunk in self.hunks_touching(line, line):
+            position = hunk.new_line_to_position(line)
+            if position is not None:
+                return position
+        return None
+
+    def changed_lines(self):
+        lines = array("l")
+        for hunk in self.hunks:
+            lines.extend(hunk.added)
+        return lines
+
+    def render(self):
+        return "\n".join(hunk.render() for hunk in self.hunks)
+
+    def __repr__(self):
+        return f"FileDiff({self.path!r}, {self.status}, +{self.additions} -{self.deletions}, {self.hunk_count} hunks)"
+
+
+class _HunkReader:
+    # 逐行读取一个文件的 hunk 部分
+    def __init__(self, file, keep=True):
+        self.file = file
+        self.keep = keep
+        self.hunk = None
+        self.position = -1
+        self.old_line = 0
+        self.new_line = 0
+
+    def feed(self, line):
+        self.position += 1
+        if line.startswith("@@"):
+            match = HUNK_HEADER.match(line)
+            if match is None:
+                return
+            old_start, old_count, new_start, new_count, section = match.groups()
+            hunk = Hunk(
+                int(old_start), 1 if old_count is None else int(old_count),
+                int(new_start), 1 if new_count is None else int(new_count),
+                section, line, self.position,
+            )
+            self.old_line = hunk.old_start
+            self.new_line = hunk.new_start
+            self.file.hunk_count += 1
+            if self.keep:
+                self.hunk = hunk
+                self.file.hunks.append(hunk)
+                self.file._new_starts.append(hunk.new_start)
+                self.file._new_ends.append(hunk.new_end)
+            return
+
+        kind = ord(line[0]) if line else CONTEXT
+        if kind == ADDED:
+            self.file.additions += 1
+            if self.hunk is not None:
+                self.hunk.added.append(self.new_line)
+            self.new_line += 1
+        elif kind == REMOVED:
+            self.file.deletions += 1
+            if self.hunk is not None:
+                self.hunk.removed.append(self.old_line)
+            self.old_line += 1
+        elif kind != NO_NEWLINE:
+            kind = CONTEXT
+            self.old_line += 1
+            self.new_line += 1
+        if self.hunk is not None:
+            self.hunk.kinds.append(kind)
+            self.hunk.lines.append(line)
+
+
+def parse_patch(patch, path=None, status="modified"):
+    """Parse a single file's patch, e.g. the `patch` of a GitHub PR file."""
+    file = FileDiff(path, status)
+    if patch:
+        reader = _HunkReader(file)
+        for line in patch.split("\n"):
+            reader.feed(line)
+        file.size = len(patch)
+    return file
+
+
+def _path_from_git_header(line):
+    # diff --git a/<path> b/<path>，路径在后面的 ---/+++ 行中会被更准确地覆盖
+    paths = line[len("diff --git "):]
+    split = paths.rfind(" b/")
+    return paths[split + 3:] if split >= 0 else paths
+
+
+def parse_unified_diff(lines, keep=None):
+    """Parse a multi-file unified diff (`git diff` output) from an iterable of lines.
+
+    Lines may be str or bytes, without their line endings. A `FileDiff` is
+    yielded as soon as its file ends, so only one file is held at a time.
+    `keep(file)` is called once the file's header has been read; when it
+    returns False, the hunks of that file are counted but not stored.
+    """
+    file = None
+    reader = None
+
+    for raw in lines:
+        line = raw.decode("utf-8", errors="replace") if isinstance(raw, bytes) else raw
+        if line.startswith("diff --git "):
+            if file is not None:
+                yield file
+            file = FileDiff(_path_from_git_header(line))
+            file.size = len(raw) + 1
+            reader = None
+            continue
+        if file is None:
+            continue
+        file.size += len(raw) + 1
+
+        if reader is not None:
+            reader.feed(line)
+        elif line.startswith("@@"):
+            # 文件头结束，路径已经确定
+            reader = _HunkReader(file, keep is None or keep(file))
+            reader.feed(line)
+        elif line.startswith("new file mode"):
+            file.status = "added"
+        elif line.startswith("deleted file mode"):
+            file.status = "removed"
+        elif line.startswith("rename from "):
+            file.status = "renamed"
+            file.previous_path = line[len("rename from "):]
+        elif line.startswith("rename to "):
+            file.path = line[len("rename to "):]
+        elif line.startswith("+++ b/"):
+            file.path = line[len("+++ b/"):]
+        elif line.startswith("--- a/") and file.status == "removed":
+            file.path = line[len("--- a/"):]
+        elif line.startswith("Binary files ") or line.startswith("GIT binary patch"):
+            file.binary = True
+
+    if file is not None:
+        yield file
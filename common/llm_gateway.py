@@ -0,0 +1,318 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import openai
+
+from common import metrics
+from common.tokens import count_message_tokens, count_tokens
+
+logger = logging.getLogger(__name__)
+
+RETRIES = metrics.counter("llm_retries_total", "OpenAI calls retried after a transient error.", ("model", "purpose", "error"))
+FAILURES = metrics.counter("llm_failures_total", "OpenAI calls that failed after all retries.", ("model", "purpose", "error"))
+COALESCED = metrics.counter("llm_coalesced_total", "Calls served by an identical call already in flight.", ("purpose",))
+REJECTED = metrics.counter("llm_rejected_total", "Calls rejected without reaching OpenAI.", ("purpose", "reason"))
+QUEUE_WAIT = metrics.histogram("llm_queue_wait_seconds", "Time spent waiting for a free concurrency slot.", ("purpose",))
+
+
+class CircuitOpenError(Exception):
+    """OpenAI failed repeatedly; calls are rejected until the circuit is tried again."""
+
+
+class LLMTimeoutError(Exception):
+    """The call did not finish before its deadline."""
+
+
+def is_retryable(error):
+    # 429、5xx、超时和连接错误可以重试；请求本身有问题（400、401等）时重试不会成功
+    if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                          openai.error.Timeout, openai.error.APIConnectionError, openai.error.TryAgain)):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive transient failures.
+
+    While open, calls fail fast with `CircuitOpenError`. After
+    `reset_seconds` a single trial call is let through; its success closes
+    the circuit and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if time.monotonic() - self._opened_at >= self.reset_seconds else "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_in_flight:
+                raise CircuitOpenError("OpenAI API is failing, circuit breaker is open")
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    logger.error(f"OpenAI API failed {self._failures} times in a row, opening the circuit breaker")
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        # 试探调用因为非暂时性错误失败时，不改变熔断状态
+        with self._lock:
+            self._trial_in_flight = False
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self, deadline):
+        if not self.done.wait(max(deadline - time.monotonic(), 0)):
+            raise LLMTimeoutError("Timed out waiting for an identical OpenAI call in flight")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class LLMGateway:
+    """The single way the services call `openai.ChatCompletion.create`.
+
+    - At most `max_concurrency` calls are in flight per process; the wait for
+      a slot counts against the call's deadline.
+    - Every call has a deadline of `timeout` seconds covering queueing,
+      retries and the request itself, passed to OpenAI as `request_timeout`.
+    - 429, 5xx, timeouts and connection errors are retried up to
+      `max_retries` times with exponential backoff and full jitter, honouring
+      Retry-After.
+    - Sustained failures open a `CircuitBreaker`.
+    - Identical non-streaming calls in flight at the same time (same model,
+      messages and options) share one upstream call.
+
+    Token usage of each upstream call is recorded with `metrics.record_usage`
+    and passed to the listeners added with `add_usage_listener`, in the
+    calling thread. Streamed responses carry no usage, so their tokens are
+    counted locally with `common.tokens` when the stream ends.
+    """
+
+    def __init__(self, max_concurrency=8, timeout=300, max_retries=3, backoff_base=1.0, backoff_max=30,
+                 failure_threshold=5, reset_seconds=30, coalesce=True):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.coalesce = coalesce
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._active = 0
+        self._usage_listeners = []
+
+    def add_usage_listener(self, listener):
+        # listener(model, purpose, usage)，usage 是响应中的 usage 字典
+        self._usage_listeners.append(listener)
+
+    def _notify_usage(self, model, purpose, response):
+        usage = response.get("usage") if hasattr(response, "get") else None
+        if not usage:
+            return
+        for listener in self._usage_listeners:
+            try:
+                listener(model, purpose, usage)
+            except Exception as e:
+                logger.error(f"Error while recording OpenAI token usage: {e}")
+
+    @staticmethod
+    def call_key(model, messages, options):
+        payload = json.dumps({"model": model, "messages": messages, "options": options}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self._active,
+                "coalescing": len(self._in_flight),
+                "max_concurrency": self.max_concurrency,
+                "circuit_open": int(self.breaker.state != "closed"),
+            }
+
+    def chat(self, model, messages, purpose="chat", timeout=None, **options):
+        """`openai.ChatCompletion.create(model=model, messages=messages, **options)` through the gateway."""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        if not self.coalesce:
+            return self._call(model, messages, purpose, deadline, options)
+
+        key = self.call_key(model, messages, options)
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlightCall()
+        if not leader:
+            COALESCED.inc(purpose=purpose)
+            logger.info(f"trace_id={metrics.current_trace_id()} purpose={purpose} coalesced with an identical call in flight")
+            return call.wait(deadline)
+
+        try:
+            call.result = self._call(model, messages, purpose, deadline, options)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+    def stream(self, model, messages, purpose="chat", timeout=None, **options):
+        """Yield the chunks of a streamed completion; not coalesced.
+
+        Only the request is retried, never after the first chunk has been
+        returned. The concurrency slot is held until the stream ends.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        chunks = self._call(model, messages, purpose, deadline, dict(options, stream=True), keep_slot=True)
+        parts = []
+        try:
+            for chunk in chunks:
+                for choice in chunk.get("choices") or []:
+                    parts.append(choice.get("delta", {}).get("content") or "")
+                yield chunk
+        except Exception as e:
+            if is_retryable(e):
+                self.breaker.record_failure()
+            raise
+        else:
+            self.breaker.record_success()
+        finally:
+            # 客户端中途断开时既不算成功也不算失败
+            self.breaker.release_trial()
+            self._release()
+            # 流式响应中没有 usage，在本地统计已发送和已收到的token数
+            prompt_tokens = count_message_tokens(messages, model)
+            completion_tokens = count_tokens("".join(parts), model)
+            response = {"usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                  "total_tokens": prompt_tokens + completion_tokens}}
+            metrics.record_usage(response, model, purpose)
+            self._notify_usage(model, purpose, response)
+
+    def _acquire(self, purpose, deadline):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=max(deadline - start, 0)):
+            REJECTED.inc(purpose=purpose, reason="queue_timeout")
+            raise LLMTimeoutError(f"No free OpenAI slot within the deadline ({self.max_concurrency} calls in flight)")
+        QUEUE_WAIT.observe(time.monotonic() - start, purpose=purpose)
+        with self._lock:
+            self._active += 1
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+        self._slots.release()
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        headers = getattr(error, "headers", None) or {}
+        retry_after = headers.get("retry-after") or headers.get("Retry-After")
+        try:
+            return min(max(float(retry_after), delay), self.backoff_max) if retry_after else delay
+        except ValueError:
+            return delay
+
+    def _call(self, model, messages, purpose, deadline, options, keep_slot=False):
+        streaming = bool(options.get("stream"))
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                REJECTED.inc(purpose=purpose, reason="circuit_open")
+                raise
+            if deadline - time.monotonic() <= 0:
+                self.breaker.release_trial()
+                REJECTED.inc(purpose=purpose, reason="deadline")
+                raise LLMTimeoutError("OpenAI call deadline exceeded")
+            try:
+                self._acquire(purpose, deadline)
+            except LLMTimeoutError:
+                self.breaker.release_trial()
+                raise
+
+            try:
+                response = openai.ChatCompletion.create(
+                    model=model, messages=messages, request_timeout=max(deadline - time.monotonic(), 1), **options
+                )
+            except Exception as e:
+                self._release()
+                error = e
+            else:
+                if keep_slot:
+                    # 流式调用由 stream() 在结束时释放，并记录成功或失败以及token数
+                    return response
+                self._release()
+                self.breaker.record_success()
+                metrics.record_usage(response, model, purpose)
+                self._notify_usage(model, purpose, response)
+                return response
+
+            error_name = type(error).__name__
+            if not is_retryable(error):
+                self.breaker.release_trial()
+                FAILURES.inc(model=model, purpose=purpose, error=error_name)
+                raise error
+            self.breaker.record_failure()
+            delay = self._backoff(attempt, error)
+            if attempt == self.max_retries or time.monotonic() + delay >= deadline:
+                FAILURES.inc(model=model, purpose=purpose, error=error_name)
+                raise error
+            RETRIES.inc(model=model, purpose=purpose, error=error_name)
+            logger.warning(
+                f"trace_id={metrics.current_trace_id()} OpenAI {'stream ' if streaming else ''}call failed with "
+                f"{error_name}: {error}, retry {attempt + 1} of {self.max_retries} in {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+
+def llm_gateway_from_env(timeout=300):
+    gateway = LLMGateway(
+        max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", "8")),
+        timeout=float(os.environ.get("LLM_TIMEOUT_SECONDS", str(timeout))),
+        max_retries=int(os.environ.get("LLM_MAX_RETRIES", "3")),
+        backoff_base=float(os.environ.get("LLM_BACKOFF_SECONDS", "1")),
+        backoff_max=float(os.environ.get("LLM_BACKOFF_MAX_SECONDS", "30")),
+        failure_threshold=int(os.environ.get("LLM_CIRCUIT_FAILURE_THRESHOLD", "5")),
+        reset_seconds=float(os.environ.get("LLM_CIRCUIT_RESET_SECONDS", "30")),
+        coalesce=os.environ.get("LLM_COALESCE", "true").lower() in ("1", "true", "yes"),
+    )
+    metrics.expose_stats("llm_gateway", "OpenAI gateway state.", gateway.stats)
+    return gateway
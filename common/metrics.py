@@ -0,0 +1,279 @@
+import bisect
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# 秒，覆盖从毫秒级的 MongoDB 操作到数分钟的 GPT-4 调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, const_labels):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value, const_labels))
+        return lines
+
+    def _samples(self, key, value, const_labels):
+        return [f"{self.name}{_format_labels(self.labelnames, key, const_labels)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # 每个桶的计数（非累积）、总和、总数
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self, key, state, const_labels):
+        counts, total, count = state[0][:], state[1], state[2]
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, list(const_labels) + [("le", _format_value(bound))])
+            samples.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key, const_labels)
+        samples.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        samples.append(f"{self.name}_count{labels} {count}")
+        return samples
+
+
+class Registry:
+    """Process-local metrics rendered in the Prometheus text format.
+
+    `const_labels` (e.g. `service`) are added to every sample. Collectors are
+    called before each render to refresh gauges from other components, such
+    as cache stats or the job queue length.
+    """
+
+    def __init__(self):
+        self.const_labels = {}
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with a different type or labels")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Error while collecting metrics: {e}")
+        const_labels = sorted(self.const_labels.items())
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(const_labels))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+add_collector = REGISTRY.add_collector
+
+STAGE_SECONDS = histogram("stage_duration_seconds", "Duration of each processing stage.", ("stage", "outcome"))
+HTTP_REQUESTS = counter("http_requests_total", "HTTP requests handled.", ("endpoint", "method", "status"))
+HTTP_SECONDS = histogram("http_request_duration_seconds", "HTTP request latency.", ("endpoint",))
+LLM_REQUESTS = counter("llm_requests_total", "OpenAI chat completion requests.", ("model", "purpose"))
+LLM_TOKENS = counter("llm_tokens_total", "Tokens reported in response.usage.", ("model", "purpose", "type"))
+LLM_REQUEST_TOKENS = histogram("llm_request_tokens", "Total tokens per chat completion.", ("model", "purpose"),
+                               buckets=TOKEN_BUCKETS)
+
+# 当前线程正在处理的请求或任务的 trace ID
+_trace = threading.local()
+
+
+def current_trace_id():
+    return getattr(_trace, "trace_id", None)
+
+
+def set_trace_id(trace_id):
+    _trace.trace_id = trace_id
+
+
+@contextmanager
+def trace(trace_id):
+    saved = current_trace_id()
+    set_trace_id(trace_id)
+    try:
+        yield
+    finally:
+        set_trace_id(saved)
+
+
+@contextmanager
+def span(stage):
+    """Time a stage, observe it in `stage_duration_seconds` and log it with the trace ID."""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage, outcome=outcome)
+        logger.info(f"trace_id={current_trace_id()} stage={stage} outcome={outcome} duration_ms={elapsed * 1000:.0f}")
+
+
+def record_usage(response, model, purpose):
+    # 没有 usage 时只记录请求数；流式响应的 usage 由 LLMGateway 在本地统计
+    LLM_REQUESTS.inc(model=model, purpose=purpose)
+    usage = response.get("usage") if hasattr(response, "get") else None
+    if not usage:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        LLM_TOKENS.inc(usage.get(kind, 0), model=model, purpose=purpose, type=kind)
+    LLM_REQUEST_TOKENS.observe(usage.get("total_tokens", 0), model=model, purpose=purpose)
+    logger.info(
+        f"trace_id={current_trace_id()} model={model} purpose={purpose} "
+        f"prompt_tokens={usage.get('prompt_tokens', 0)} completion_tokens={usage.get('completion_tokens', 0)}"
+    )
+
+
+def expose_stats(name, documentation, stats):
+    """Export the numeric values of a `stats()` dict as a gauge labelled by `stat`."""
+    metric = gauge(name, documentation, ("stat",))
+
+    def collect():
+        for key, value in stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric.set(value, stat=key)
+
+    add_collector(collect)
+    return metric
+
+
+def instrument_app(app, service, trace_headers=("X-Trace-Id",)):
+    """Add request metrics, trace IDs and a `/metrics` endpoint to a Flask app.
+
+    The trace ID is taken from the first of `trace_headers` present on the
+    request, or generated, and returned in the `X-Trace-Id` response header.
+    Handlers can replace it with `set_trace_id`, e.g. with the conversation uuid.
+    """
+    from flask import g, request
+
+    REGISTRY.const_labels["service"] = service
+
+    @app.before_request
+    def _start_request():
+        g.metrics_start = time.perf_counter()
+        trace_id = next((request.headers[name] for name in trace_headers if request.headers.get(name)), None)
+        set_trace_id(trace_id or uuid.uuid4().hex)
+
+    @app.after_request
+    def _finish_request(response):
+        start = g.pop("metrics_start", None)
+        endpoint = request.endpoint or "unknown"
+        if start is not None and endpoint != "metrics":
+            # 流式响应只统计到开始返回为止
+            HTTP_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        trace_id = current_trace_id()
+        if trace_id is not None:
+            response.headers["X-Trace-Id"] = trace_id
+        return response
+
+    @app.teardown_request
+    def _clear_trace(exc):
+        set_trace_id(None)
+
+    @app.route("/metrics")
+    def metrics():
+        return REGISTRY.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+    return app
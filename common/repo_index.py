@@ -0,0 +1,429 @@
+import ast
+import json
+import logging
+import os
+import re
+import threading
+
+from common.code_blocks import block_end
+from common.diff_model import parse_patch
+
+logger = logging.getLogger(__name__)
+
+# 建立索引的源文件类型
+INDEXED_EXTENSIONS = (
+    ".py", ".js", ".jsx", ".mjs", ".ts", ".tsx", ".go", ".java", ".kt", ".scala", ".rb", ".rs",
+    ".c", ".h", ".cc", ".cpp", ".hpp", ".cs", ".php", ".swift", ".m", ".lua", ".sh",
+)
+# 每个定义保存的代码片段最多行数
+SNIPPET_MAX_LINES = 30
+# 每个文件中每个标识符最多记录的引用行数
+REFS_PER_NAME = 5
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+KEYWORDS = frozenset("""
+    and as assert async await break case catch class const continue def default del do elif else enum except
+    export extends false final finally fn for from func function go if impl implements import in interface is
+    lambda let match mod module mut new nil none not null or package pass private protected pub public raise
+    return self static struct super switch this throw throws true try type typeof use var void while with yield
+    int str bool float string char long double byte unsigned signed auto err ok
+""".split())
+KEYWORD_DEFINITION = re.compile(
+    r"^\s*(?:(?:export|public|private|protected|internal|static|abstract|final|async|override|virtual|inline|default"
+    r"|pub(?:\(\w+\))?)\s+)*(def|class|function|func|fn|interface|struct|enum|trait|type|module|object|impl)\s+"
+    r"(?:\([^)]*\)\s*)?\*?([A-Za-z_]\w*)"
+)
+ASSIGNED_FUNCTION = re.compile(
+    r"^\s*(?:export\s+)?(?:const|let|var)\s+([A-Za-z_]\w*)\s*=\s*(?:async\s+)?(?:function\b|\([^)]*\)\s*=>|\w+\s*=>)"
+)
+C_FUNCTION = re.compile(
+    r"^(?!\s*(?:if|else|for|while|switch|return|catch|do|case|new|throw|await|yield|try|sizeof)\b)"
+    r"\s*(?:[\w<>\[\],*&:]+\s+)+\**([A-Za-z_]\w*)\s*\([^;]*\)\s*(?:const\s*)?\{?\s*$"
+)
+# 粗略去掉字符串和行注释，避免把其中的单词当作标识符
+LITERALS = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`|//.*$|#.*$')
+FUNCTION_KINDS = {"def": "function", "func": "function", "fn": "function", "function": "function"}
+
+
+def is_indexed(path):
+    return path.endswith(INDEXED_EXTENSIONS)
+
+
+def identifiers(text):
+    """Identifiers in a piece of code or a search query, without keywords and one-letter names."""
+    return [name for name in IDENTIFIER.findall(text) if len(name) > 1 and name.lower() not in KEYWORDS]
+
+
+def _python_symbols(content):
+    tree = ast.parse(content)
+    defs = []
+
+    def visit(node, scope):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if isinstance(child, ast.ClassDef):
+                    kind = "class"
+                else:
+                    kind = "method" if scope and scope[-1][1] == "class" else "function"
+                start = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                qualname = ".".join([name for name, _ in scope] + [child.name])
+                defs.append({"name": child.name, "qualname": qualname, "kind": kind,
+                             "line": start, "end_line": child.end_lineno})
+                visit(child, scope + [(child.name, kind)])
+            elif not scope and isinstance(child, (ast.Assign, ast.AnnAssign)):
+                targets = child.targets if isinstance(child, ast.Assign) else [child.target]
+                for target in targets:
+                    if isinstance(target, ast.Name):
+                        defs.append({"name": target.id, "qualname": target.id, "kind": "variable",
+                                     "line": child.lineno, "end_line": child.end_lineno})
+            else:
+                visit(child, scope)
+
+    visit(tree, [])
+    refs = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load):
+            refs.append((node.id, node.lineno))
+        elif isinstance(node, ast.Attribute):
+            refs.append((node.attr, node.lineno))
+        elif isinstance(node, ast.ImportFrom):
+            refs.extend((alias.name, node.lineno) for alias in node.names)
+    return defs, refs
+
+
+def _generic_symbols(content):
+    lines = content.split("\n")
+    defs, refs = [], []
+    for index, line in enumerate(lines):
+        match = KEYWORD_DEFINITION.match(line)
+        if match:
+            kind, name = FUNCTION_KINDS.get(match.group(1), match.group(1)), match.group(2)
+        else:
+            match = ASSIGNED_FUNCTION.match(line) or (C_FUNCTION.match(line) if not line.rstrip().endswith(";") else None)
+            kind, name = "function", match.group(1) if match else None
+        if name and name.lower() not in KEYWORDS:
+            defs.append({"name": name, "qualname": name, "kind": kind, "line": index + 1,
+                         "end_line": block_end(lines, index) + 1})
+        refs.extend((name, index + 1) for name in identifiers(LITERALS.sub("", line)))
+    return defs, refs
+
+
+def index_file(path, content, blob_sha=None):
+    """Symbol table of one file: its definitions with code snippets and the lines referencing each identifier."""
+    defs, refs = None, None
+    if path.endswith(".py"):
+        try:
+            defs, refs = _python_symbols(content)
+        except (SyntaxError, ValueError):
+            pass
+    if defs is None:
+        defs, refs = _generic_symbols(content)
+
+    lines = content.split("\n")
+    for definition in defs:
+        start, end = definition["line"], definition["end_line"]
+        snippet = lines[start - 1:min(end, start - 1 + SNIPPET_MAX_LINES)]
+        if end - start + 1 > SNIPPET_MAX_LINES:
+            snippet.append("    ...")
+        definition["snippet"] = "\n".join(snippet)
+
+    # 定义所在行上的名称不算引用
+    definition_lines = {(definition["name"], definition["line"]) for definition in defs}
+    references = {}
+    for name, line in refs:
+        if len(name) < 2 or name.lower() in KEYWORDS or (name, line) in definition_lines:
+            continue
+        lines_of_name = references.setdefault(name, [])
+        if len(lines_of_name) < REFS_PER_NAME and line not in lines_of_name:
+            lines_of_name.append(line)
+    return {
+        "path": path,
+        "blob": blob_sha,
+        "defs": defs,
+        "def_names": sorted({definition["name"] for definition in defs}),
+        "refs": references,
+        "ref_names": sorted(references),
+    }
+
+
+def skipped_entry(path, blob_sha):
+    # 无法建索引的文件（例如非 UTF-8）也记录 blob SHA，内容不变时不再重复获取
+    return {"path": path, "blob": blob_sha, "defs": [], "def_names": [], "refs": {}, "ref_names": [], "skipped": True}
+
+
+def enclosing_definition(entry, line):
+    # 包含该行的最内层函数或类
+    enclosing = [
+        definition for definition in entry["defs"]
+        if definition["kind"] != "variable" and definition["line"] <= line <= definition["end_line"]
+    ]
+    return min(enclosing, key=lambda d: d["end_line"] - d["line"]) if enclosing else None
+
+
+class MongoRepoIndexStore:
+    """Index entries as one document per (repository, file) in MongoDB.
+
+    Multikey indexes on `def_names` and `ref_names` are the inverted index
+    from identifiers to the files defining and referencing them.
+    """
+
+    def __init__(self, db):
+        self.files = db["repo_index_files"]
+        self.heads = db["repo_index_heads"]
+
+    def ensure_indexes(self):
+        self.files.create_index([("repo", 1), ("def_names", 1)])
+        self.files.create_index([("repo", 1), ("ref_names", 1)])
+
+    def head(self, repo):
+        doc = self.heads.find_one({"_id": repo})
+        return doc["head"] if doc else None
+
+    def file_blobs(self, repo):
+        return {doc["path"]: doc.get("blob") for doc in self.files.find({"repo": repo}, {"path": 1, "blob": 1})}
+
+    def update(self, repo, head, entries, removed):
+        from pymongo import DeleteOne, ReplaceOne
+
+        operations = [ReplaceOne({"_id": f"{repo}:{entry['path']}"}, dict(entry, repo=repo), upsert=True) for entry in entries]
+        operations += [DeleteOne({"_id": f"{repo}:{path}"}) for path in removed]
+        if operations:
+            self.files.bulk_write(operations, ordered=False)
+        self.heads.update_one({"_id": repo}, {"$set": {"head": head, "files": self.files.count_documents({"repo": repo})}},
+                              upsert=True)
+
+    def defining(self, repo, names, limit):
+        return list(self.files.find({"repo": repo, "def_names": {"$in": list(names)}}, {"_id": 0}).limit(limit))
+
+    def referencing(self, repo, name, limit):
+        return list(self.files.find({"repo": repo, "ref_names": name}, {"_id": 0}).sort("path", 1).limit(limit))
+
+    def stats(self):
+        return {"repos": self.heads.count_documents({}), "files": self.files.estimated_document_count()}
+
+
+class LocalRepoIndexStore:
+    """Index kept in memory, and saved as one JSON file per repository when `directory` is set."""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._repos = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        pass
+
+    def _path(self, repo):
+        return os.path.join(self.directory, repo.replace("/", "__") + ".json")
+
+    def _repo(self, repo):
+        # 调用方持有锁
+        state = self._repos.get(repo)
+        if state is not None:
+            return state
+        state = {"head": None, "files": {}, "defined": {}, "referenced": {}}
+        if self.directory is not None and os.path.exists(self._path(repo)):
+            with open(self._path(repo), encoding="utf-8") as f:
+                saved = json.load(f)
+            state["head"] = saved["head"]
+            for entry in saved["files"]:
+                self._add(state, entry)
+        self._repos[repo] = state
+        return state
+
+    @staticmethod
+    def _add(state, entry):
+        state["files"][entry["path"]] = entry
+        for name in entry["def_names"]:
+            state["defined"].setdefault(name, set()).add(entry["path"])
+        for name in entry["ref_names"]:
+            state["referenced"].setdefault(name, set()).add(entry["path"])
+
+    @staticmethod
+    def _remove(state, path):
+        entry = state["files"].pop(path, None)
+        if entry is None:
+            return
+        for field, names in (("defined", entry["def_names"]), ("referenced", entry["ref_names"])):
+            for name in names:
+                paths = state[field].get(name)
+                if paths is not None:
+                    paths.discard(path)
+                    if not paths:
+                        del state[field][name]
+
+    def head(self, repo):
+        with self._lock:
+            return self._repo(repo)["head"]
+
+    def file_blobs(self, repo):
+        with self._lock:
+            return {path: entry.get("blob") for path, entry in self._repo(repo)["files"].items()}
+
+    def update(self, repo, head, entries, removed):
+        with self._lock:
+            state = self._repo(repo)
+            for path in removed:
+                self._remove(state, path)
+            for entry in entries:
+                self._remove(state, entry["path"])
+                self._add(state, entry)
+            state["head"] = head
+            saved = {"head": head, "files": list(state["files"].values())} if self.directory is not None else None
+        if saved is not None:
+            # 先写临时文件再重命名，避免读到写了一半的文件
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{self._path(repo)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self._path(repo))
+
+    def defining(self, repo, names, limit):
+        with self._lock:
+            state = self._repo(repo)
+            paths = sorted({path for name in names for path in state["defined"].get(name, ())})
+            return [state["files"][path] for path in paths[:limit]]
+
+    def referencing(self, repo, name, limit):
+        with self._lock:
+            state = self._repo(repo)
+            return [state["files"][path] for path in sorted(state["referenced"].get(name, ()))[:limit]]
+
+    def stats(self):
+        with self._lock:
+            return {"repos": len(self._repos), "files": sum(len(state["files"]) for state in self._repos.values())}
+
+
+class RepoIndex:
+    """Symbol index of each repository's default branch, for cross-file context.
+
+    `search` answers identifier queries from the GPT action;
+    `related_code` finds, for the changes of a pull request, the definitions
+    they use and the code that calls what they change, in other files.
+    """
+
+    def __init__(self, store, max_files_per_name=20):
+        self.store = store
+        self.max_files_per_name = max_files_per_name
+
+    def update(self, repo, head, entries, removed=()):
+        self.store.update(repo, head, entries, list(removed))
+
+    def head(self, repo):
+        return self.store.head(repo)
+
+    def definitions(self, repo, names, exclude_paths=()):
+        names = set(names)
+        results = []
+        for entry in self.store.defining(repo, names, self.max_files_per_name * max(len(names), 1)):
+            if entry["path"] in exclude_paths:
+                continue
+            for definition in entry["defs"]:
+                if definition["name"] in names:
+                    results.append(dict(definition, path=entry["path"]))
+        return results
+
+    def references(self, repo, name, exclude_paths=()):
+        # 引用 name 的位置，附带所在的函数或类
+        results = []
+        for entry in self.store.referencing(repo, name, self.max_files_per_name):
+            if entry["path"] in exclude_paths:
+                continue
+            lines = entry["refs"].get(name, [])
+            contexts = {}
+            for line in lines:
+                definition = enclosing_definition(entry, line)
+                key = (definition["line"], definition["end_line"]) if definition else (line, line)
+                contexts.setdefault(key, definition)
+            for (start, end), definition in contexts.items():
+                result = {"path": entry["path"], "name": name, "lines": [l for l in lines if start <= l <= end]}
+                if definition is not None:
+                    result.update(qualname=definition["qualname"], kind=definition["kind"], line=definition["line"],
+                                  end_line=definition["end_line"], snippet=definition["snippet"])
+                results.append(result)
+        return results
+
+    def search(self, repo, query, limit=10):
+        """Definitions of and references to the identifiers in `query`, definitions first."""
+        names = list(dict.fromkeys(identifiers(query)))[:20]
+        definitions = self.definitions(repo, names)
+        # 名称完全匹配的顺序与查询中的顺序一致
+        definitions.sort(key=lambda d: (names.index(d["name"]), d["kind"] == "variable", d["path"], d["line"]))
+        references = []
+        for name in names:
+            if len(references) >= limit:
+                break
+            references.extend(self.references(repo, name))
+        return {"definitions": definitions[:limit], "references": references[:limit]}
+
+    def related_code(self, repo, code_changes, limit=8):
+        """Snippets from unchanged files related to `code_changes` (dicts with `filename`, `patch`, `full_content`).
+
+        Callers of the definitions touched by the patches come first, then the
+        definitions of identifiers used on changed lines.
+        """
+        changed_paths = {change["filename"] for change in code_changes}
+        touched, used = [], []
+        for change in code_changes:
+            if not change.get("patch"):
+                continue
+            file_diff = parse_patch(change["patch"], change["filename"])
+            for line in change["patch"].split("\n"):
+                if line[:1] in ("+", "-") and not line.startswith(("+++", "---")):
+                    used.extend(identifiers(LITERALS.sub("", line[1:])))
+            if change.get("full_content") and is_indexed(change["filename"]):
+                entry = index_file(change["filename"], change["full_content"])
+                touched.extend(
+                    definition["name"] for definition in entry["defs"]
+                    if definition["kind"] != "variable" and file_diff.hunks_touching(definition["line"], definition["end_line"])
+                )
+        touched = list(dict.fromkeys(touched))
+        used = [name for name in dict.fromkeys(used) if name not in touched]
+
+        results, seen = [], set()
+
+        def add(item, relation):
+            key = (item["path"], item.get("line"), item.get("end_line"))
+            if key not in seen and "snippet" in item:
+                seen.add(key)
+                results.append(dict(item, relation=relation))
+
+        for name in touched:
+            for reference in self.references(repo, name, exclude_paths=changed_paths):
+                add(reference, "caller")
+        for definition in self.definitions(repo, used, exclude_paths=changed_paths):
+            if definition["kind"] != "variable":
+                add(definition, "definition")
+        return results[:limit]
+
+
+def render_snippet(item):
+    if item["relation"] == "caller":
+        title = f"{item['path']} lines {item['line']}-{item['end_line']}, {item['qualname']} uses {item['name']}"
+    else:
+        title = f"{item['path']} lines {item['line']}-{item['end_line']}, definition of {item['qualname']}"
+    return f"{title}:\n{item['snippet']}\n"
+
+
+def repo_index_from_env(mongo_db=None):
+    """Build the index from REPO_INDEX_* environment variables; None when disabled.
+
+    REPO_INDEX_BACKEND is "memory", "disk" (REPO_INDEX_DIR) or "mongo", which
+    uses `mongo_db` when the service already has one, and otherwise connects
+    to REPO_INDEX_MONGO_URI. pr_review can only read an index built by
+    gh_interacter through "mongo": a "disk" store loads each repository once
+    and does not see later updates written by another process.
+    """
+    backend = os.environ.get("REPO_INDEX_BACKEND", "")
+    if backend == "memory":
+        store = LocalRepoIndexStore()
+    elif backend == "disk":
+        store = LocalRepoIndexStore(os.environ.get("REPO_INDEX_DIR", "/tmp/repo_index"))
+    elif backend == "mongo":
+        if mongo_db is None:
+            from pymongo import MongoClient
+            mongo_db = MongoClient(os.environ.get("REPO_INDEX_MONGO_URI", "mongodb://mongodb:27017"))["pr_review"]
+        store = MongoRepoIndexStore(mongo_db)
+    else:
+        return None
+    return RepoIndex(store, max_files_per_name=int(os.environ.get("REPO_INDEX_MAX_FILES_PER_NAME", "20")))
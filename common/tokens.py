@@ -0,0 +1,83 @@
+import logging
+import threading
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken 是可选依赖，没有安装时按字符数估算
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# 各模型的上下文窗口
+CONTEXT_WINDOWS = {
+    "gpt-4-1106-preview": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+# 留出 system prompt 和回复的余量之后，每个模型可以用于PR内容的token数
+PROMPT_TOKEN_BUDGETS = {
+    "gpt-4-1106-preview": 100000,
+    "gpt-4": 6000,
+    "gpt-3.5-turbo": 12000,
+}
+# 为回复保留的token数
+REPLY_TOKENS = 4096
+
+_encodings = {}
+_encodings_lock = threading.Lock()
+# 编码文件无法加载时（例如离线部署且没有 TIKTOKEN_CACHE_DIR），之后都按字符数估算
+_load_failed = False
+
+
+def _encoding_for(model):
+    # 返回None时按字符数估算
+    global _load_failed
+    with _encodings_lock:
+        if _load_failed:
+            return None
+        encoding = _encodings.get(model)
+        if encoding is None:
+            try:
+                try:
+                    encoding = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                # tiktoken 第一次使用时需要下载 BPE 文件
+                logger.error(f"Error while loading the tiktoken encoding, estimating tokens from characters instead: {e}")
+                _load_failed = True
+                return None
+            _encodings[model] = encoding
+        return encoding
+
+
+def count_tokens(text, model="gpt-4"):
+    """Count tokens locally, without calling the API.
+
+    Uses tiktoken when it is installed and its encoding can be loaded, and
+    otherwise estimates four characters per token, which is close enough for
+    English text and code. tiktoken downloads its encoding files on first
+    use; offline deployments must provide them in TIKTOKEN_CACHE_DIR.
+    """
+    if not text:
+        return 0
+    encoding = _encoding_for(model) if tiktoken is not None else None
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages, model="gpt-4"):
+    # 每条消息额外约有4个token的格式开销，回复的开头还有3个
+    return sum(count_tokens(message["content"], model) + 4 for message in messages) + 3
+
+
+def conversation_token_budget(model):
+    """Tokens of history that can be sent to `model` while leaving room for the reply.
+
+    The history starts with the review prompt, which alone may use the whole
+    PROMPT_TOKEN_BUDGETS entry, so the budget is the context window minus the
+    reply and never less than the prompt budget.
+    """
+    window = CONTEXT_WINDOWS.get(model, 8192)
+    return max(window - REPLY_TOKENS, PROMPT_TOKEN_BUDGETS.get(model, 6000))
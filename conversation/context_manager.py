@@ -0,0 +1,107 @@
+import logging
+
+from common.tokens import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Summarize the following part of a discussion between a user and an AI reviewer about a pull request review. "
+    "Keep the questions asked, the decisions made, the suggestions the user accepted or rejected, and any code that was agreed on. "
+    "Be concise."
+)
+
+
+class ContextManager:
+    """Chooses which stored messages are sent to GPT for a follow-up turn.
+
+    The pull request prompt and the first review are always sent verbatim, as
+    are the most recent messages. When everything does not fit in `budget`
+    tokens, the turns in between are replaced with a rolling summary stored in
+    the conversation document as `context_summary`. The summary only ever
+    grows by folding the next turns into the previous summary.
+    """
+
+    def __init__(self, collection, model, budget, recent_messages=6, summary_model="gpt-3.5-turbo", content_store=None,
+                 llm=None):
+        self.collection = collection
+        self.content_store = content_store
+        # 生成摘要的调用同样经过 LLMGateway
+        self.llm = llm
+        self.model = model
+        self.budget = budget
+        self.recent_messages = recent_messages
+        self.summary_model = summary_model
+
+    def _summary_message(self, content):
+        return {"role": "system", "content": f"Summary of the earlier discussion about the review:\n{content}"}
+
+    def _summarize(self, previous_summary, messages):
+        discussion = "\n\n".join(f"{message['role'].upper()}: {message['content']}" for message in messages)
+        if previous_summary:
+            discussion = f"Summary of the discussion so far:\n{previous_summary}\n\nLater discussion:\n{discussion}"
+        completion = self.llm.chat(
+            self.summary_model,
+            [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": discussion},
+            ],
+            purpose="summary",
+        )
+        return completion.choices[0].message["content"].strip()
+
+    def prepare(self, conversation):
+        """Return `(messages_to_send, token_count)` for the stored conversation.
+
+        The last stored message is the new user message.
+        """
+        uuid = conversation["uuid"]
+        messages = conversation.get("messages", [])
+        if self.content_store is not None:
+            messages = self.content_store.resolve(messages)
+        messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+
+        # Don't include the initial system prompt when generating subsequent conversation. Ref: issue #41
+        start = 1 if len(messages) > 1 and messages[0]["role"] == "system" else 0
+        pinned_end = start
+        for index in range(start, len(messages)):
+            if messages[index]["role"] == "assistant":
+                pinned_end = index + 1
+                break
+        pinned = messages[start:pinned_end]
+
+        to_send = messages[start:]
+        tokens = count_message_tokens(to_send, self.model)
+        if tokens <= self.budget:
+            return to_send, tokens
+
+        # 先尝试使用已保存的摘要
+        summary = conversation.get("context_summary")
+        if summary and not pinned_end <= summary["upto"] <= len(messages):
+            summary = None
+        if summary:
+            to_send = pinned + [self._summary_message(summary["content"])] + messages[summary["upto"]:]
+            tokens = count_message_tokens(to_send, self.model)
+            if tokens <= self.budget:
+                return to_send, tokens
+
+        # 最近的消息从一轮对话的用户消息开始
+        cut = max(len(messages) - self.recent_messages, pinned_end)
+        while cut > pinned_end and messages[cut]["role"] != "user":
+            cut -= 1
+        if cut <= (summary["upto"] if summary else pinned_end):
+            logger.warning(f"conversation={uuid} recent messages alone exceed the token budget ({tokens} > {self.budget})")
+            return to_send, tokens
+
+        # 只把摘要之后、最近消息之前的部分合并进摘要
+        if summary:
+            content = self._summarize(summary["content"], messages[summary["upto"]:cut])
+        else:
+            content = self._summarize(None, messages[pinned_end:cut])
+        self.collection.update_one(
+            {"uuid": uuid},
+            {"$set": {"context_summary": {"upto": cut, "content": content}}},
+        )
+        logger.info(f"conversation={uuid} summarized messages up to index {cut}")
+
+        to_send = pinned + [self._summary_message(content)] + messages[cut:]
+        return to_send, count_message_tokens(to_send, self.model)
@@ -1,21 +1,72 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
-from pymongo import MongoClient
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, Response, stream_with_context
+from pymongo import MongoClient, ReturnDocument
 import os
+import json
+import time
+import logging
 import openai
+from common import metrics
+from common.content_store import content_store_from_env
+from common.llm_gateway import CircuitOpenError, LLMTimeoutError, llm_gateway_from_env
+from common.tokens import conversation_token_budget
+from context_manager import ContextManager
+from response_cache import response_cache_from_env
 
 app = Flask(__name__)
+# 对话的uuid就是review的事件ID，作为 trace ID
+metrics.instrument_app(app, "conversation")
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 app.secret_key = os.getenv("SECRET_KEY_FOR_SESSION")  # 用于Flask session
 
 client = MongoClient('mongodb', 27017)
 db = client['pr_review']
 collection = db['review_comments_and_conversations']
+# 较大的消息内容单独按内容哈希存储，对话文档中只保存引用
+content_store = content_store_from_env(db)
+# 回复时只需要这些字段
+CONVERSATION_PROJECTION = {"uuid": 1, "messages": 1, "context_summary": 1}
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
+# 所有GPT调用共用的并发限制、超时、重试和熔断；截止时间要短于 gunicorn 的请求超时
+llm = llm_gateway_from_env(timeout=110)
+
+# 超过该长度的消息（例如包含所有文件内容的PR提示）在列表中只返回预览，按需单独加载
+LARGE_MESSAGE_CHARS = int(os.getenv("LARGE_MESSAGE_CHARS", "4000"))
+MESSAGE_PREVIEW_CHARS = 300
+MESSAGES_PAGE_SIZE_MAX = 200
+
+CONVERSATION_MODEL = "gpt-4-1106-preview"
+# 发送给GPT的历史消息的token预算，超出时较早的对话会被替换为摘要；
+# 默认按模型的上下文窗口计算，要能放下 pr_review 按同一张表生成的 review 提示词
+context_manager = ContextManager(
+    collection,
+    CONVERSATION_MODEL,
+    budget=int(os.getenv("CONVERSATION_TOKEN_BUDGET") or conversation_token_budget(CONVERSATION_MODEL)),
+    recent_messages=int(os.getenv("CONVERSATION_RECENT_MESSAGES", "6")),
+    summary_model=os.getenv("CONVERSATION_SUMMARY_MODEL", "gpt-3.5-turbo"),
+    content_store=content_store,
+    llm=llm,
+)
+# 按 (review上下文, 规范化后的问题) 缓存GPT的回复，每个进程一份
+response_cache = response_cache_from_env()
+
+prompt_tokens_sent = metrics.histogram(
+    "conversation_prompt_tokens", "Tokens of the history sent to GPT per message.", buckets=metrics.TOKEN_BUCKETS)
+time_to_first_token = metrics.histogram("conversation_time_to_first_token_seconds", "Time until the first streamed token.")
+
+def ensure_indexes():
+    # 在每个进程启动时调用（gunicorn 在 worker fork 之后调用）
+    try:
+        collection.create_index("uuid", unique=True)
+    except Exception as e:
+        logger.error(f"Error while creating MongoDB indexes: {e}")
 
 @app.before_request
 def require_login():
     # 列出不需要登录就可以访问的端点
-    allowed_routes = ['login', 'healthz']
+    allowed_routes = ['login', 'healthz', 'metrics']
     if 'logged_in' not in session and request.endpoint not in allowed_routes:
         return redirect(url_for('login'))
 
@@ -48,43 +99,222 @@ def login():
 
 @app.route('/get-conversation/<uuid>', methods=['GET'])
 def get_conversation(uuid):
-    conversation = collection.find_one({"uuid": uuid})
-    messages = conversation.get('messages', []) if conversation else []
+    conversation = collection.find_one({"uuid": uuid}, {"messages": 1})
+    messages = content_store.resolve(conversation.get('messages', [])) if conversation else []
     return jsonify(messages)
 
+def message_count(uuid):
+    # 对话中的消息只会追加，消息数即可作为对话的版本号
+    result = list(collection.aggregate([
+        {"$match": {"uuid": uuid}},
+        {"$project": {"count": {"$size": {"$ifNull": ["$messages", []]}}}},
+    ]))
+    return result[0]["count"] if result else None
+
+def describe_message(index, message):
+    if 'content_ref' in message:
+        # 单独存储的消息只返回预览，内容较短时才加载
+        if message['length'] > LARGE_MESSAGE_CHARS:
+            return {"index": index, "role": message.get('role'), "length": message['length'],
+                    "content": None, "preview": message['preview'][:MESSAGE_PREVIEW_CHARS], "truncated": True,
+                    "cached": bool(message.get('cached'))}
+        message = content_store.resolve([message])[0]
+    content = message.get('content') or ''
+    entry = {"index": index, "role": message.get('role'), "length": len(content), "cached": bool(message.get('cached'))}
+    if len(content) > LARGE_MESSAGE_CHARS:
+        entry.update(content=None, preview=content[:MESSAGE_PREVIEW_CHARS], truncated=True)
+    else:
+        entry.update(content=content, truncated=False)
+    return entry
+
+@app.route('/get-conversation/<uuid>/messages', methods=['GET'])
+def get_conversation_messages(uuid):
+    # 分页返回从 since 开始的消息，大消息只返回预览；对话没有变化时返回304
+    since = max(request.args.get('since', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', 50, type=int), 1), MESSAGES_PAGE_SIZE_MAX)
+
+    total = message_count(uuid)
+    if total is None:
+        return jsonify({'code': 404, 'message': 'Conversation not found'}), 404
+    etag = f'"{uuid}-{total}"'
+    if request.headers.get('If-None-Match') == etag:
+        return '', 304, {'ETag': etag}
+
+    messages = []
+    if since < total:
+        conversation = collection.find_one({"uuid": uuid}, {"messages": {"$slice": [since, limit]}})
+        messages = [
+            describe_message(since + offset, message)
+            for offset, message in enumerate(conversation.get('messages', []) if conversation else [])
+        ]
+    response = jsonify({"version": total, "total": total, "start": since, "messages": messages})
+    response.headers['ETag'] = etag
+    return response
+
+@app.route('/get-conversation/<uuid>/messages/<int:index>', methods=['GET'])
+def get_conversation_message(uuid, index):
+    conversation = collection.find_one({"uuid": uuid}, {"messages": {"$slice": [index, 1]}})
+    messages = conversation.get('messages', []) if conversation else []
+    if not messages:
+        return jsonify({'code': 404, 'message': 'Message not found'}), 404
+    messages = content_store.resolve(messages)
+    response = jsonify({"index": index, "role": messages[0].get('role'), "content": messages[0].get('content')})
+    # 已有的消息不会再改变
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
 @app.route('/add-message', methods=['POST'])
 def add_message():
     data = request.json
     uuid = data['uuid']
+    metrics.set_trace_id(uuid)
     user_message = {
         "role": "user",
         "content": data['content']
     }
 
-    # 将用户消息保存到MongoDB
-    collection.update_one({"uuid": uuid}, {"$push": {"messages": user_message}})
-    # 从MongoDB中获取与该uuid相关的历史对话
-    conversation = collection.find_one({"uuid": uuid})
-    messages = conversation.get('messages', []) if conversation else []
+    # 保存用户消息，并在同一次请求中取回与该uuid相关的历史对话
+    with metrics.span("conversation_load"):
+        conversation = collection.find_one_and_update(
+            {"uuid": uuid},
+            {"$push": {"messages": {"$each": content_store.store([user_message])}}},
+            projection=CONVERSATION_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+    if conversation is None:
+        return jsonify({'code': 404, 'message': 'Conversation not found'}), 404
+
+    # 重复的问题直接使用缓存的回复；在准备上下文之前查找，命中时不需要生成摘要
+    history = conversation.get('messages', [])[:-1]
+    reply = response_cache.get(CONVERSATION_MODEL, history, user_message['content'])
+    cached = reply is not None
+    tokens_sent = 0
+    try:
+        if cached:
+            logger.info(f"conversation={uuid} reply served from the response cache")
+        else:
+            # 在token预算内选择要发送的历史消息（可能需要先调用GPT生成摘要）
+            with metrics.span("context_prepare"):
+                messages_to_send, tokens_sent = context_manager.prepare(conversation)
+            prompt_tokens_sent.observe(tokens_sent)
+            logger.info(f"conversation={uuid} tokens_sent={tokens_sent}")
+            start = time.monotonic()
+            with metrics.span("llm_reply"):
+                completion = llm.chat(CONVERSATION_MODEL, messages_to_send, purpose="conversation")
+            reply = completion.choices[0].message["content"]
+            response_cache.put(CONVERSATION_MODEL, history, user_message['content'], reply,
+                               time.monotonic() - start, tokens_sent)
+    except CircuitOpenError:
+        return jsonify({'code': 503, 'message': 'OpenAI API is unavailable, please try again later'}), 503
+    except LLMTimeoutError:
+        return jsonify({'code': 504, 'message': 'OpenAI API did not respond in time'}), 504
+    except Exception as e:
+        logger.error(f"Error while generating the GPT response for conversation {uuid}: {e}")
+        return jsonify({'code': 500, 'message': 'Error while calling OpenAI API'}), 500
+    gpt_response = {"role": "assistant", "content": reply}
+    if cached:
+        gpt_response["cached"] = True
 
-    # Don't include the initial system prompt when generating subsequent conversation. Ref: issue #41
-    if len(messages) > 1 and messages[0].get("role") == "system":
-        # Exclude the first message (initial system prompt)
-        messages_to_send = messages[1:]
+    # 将GPT-4的回复保存到MongoDB
+    with metrics.span("conversation_save"):
+        collection.update_one({"uuid": uuid}, {"$push": {"messages": {"$each": content_store.store([gpt_response])}}})
+
+    return jsonify({"status": "success", "tokens_sent": tokens_sent, "cached": cached})
+
+@app.route('/add-message-stream', methods=['POST'])
+def add_message_stream():
+    # 以 server-sent events 的形式逐段返回 GPT 的回复
+    data = request.json
+    uuid = data['uuid']
+    metrics.set_trace_id(uuid)
+    user_message = {
+        "role": "user",
+        "content": data['content']
+    }
+
+    # 先保存用户消息，并在同一次请求中取回与该uuid相关的历史对话；回复中断时问题也不会丢失
+    with metrics.span("conversation_load"):
+        conversation = collection.find_one_and_update(
+            {"uuid": uuid},
+            {"$push": {"messages": {"$each": content_store.store([user_message])}}},
+            projection=CONVERSATION_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+    if conversation is None:
+        return jsonify({'code': 404, 'message': 'Conversation not found'}), 404
+    history = conversation.get('messages', [])[:-1]
+
+    # 命中缓存时一次性返回缓存的回复，不需要准备上下文
+    cached_reply = response_cache.get(CONVERSATION_MODEL, history, user_message['content'])
+    cached = cached_reply is not None
+    messages_to_send, tokens_sent = None, 0
+    if cached:
+        logger.info(f"conversation={uuid} reply served from the response cache")
     else:
-        # Otherwise, send all messages
-        messages_to_send = messages
+        # 在token预算内选择要发送的历史消息
+        try:
+            with metrics.span("context_prepare"):
+                messages_to_send, tokens_sent = context_manager.prepare(conversation)
+        except CircuitOpenError:
+            return jsonify({'code': 503, 'message': 'OpenAI API is unavailable, please try again later'}), 503
+        except LLMTimeoutError:
+            return jsonify({'code': 504, 'message': 'OpenAI API did not respond in time'}), 504
+        except Exception as e:
+            logger.error(f"Error while preparing the context of conversation {uuid}: {e}")
+            return jsonify({'code': 500, 'message': 'Error while calling OpenAI API'}), 500
+        prompt_tokens_sent.observe(tokens_sent)
+        logger.info(f"conversation={uuid} tokens_sent={tokens_sent}")
 
-    completion = openai.ChatCompletion.create(
-        model="gpt-4-1106-preview",
-        messages=messages_to_send
-    )
-    gpt_response = completion.choices[0].message
+    def generate():
+        start = time.monotonic()
+        parts = []
+        if cached:
+            parts.append(cached_reply)
+            yield f"data: {json.dumps({'content': cached_reply})}\n\n"
+        else:
+            first_token_at = None
+            try:
+                for chunk in llm.stream(CONVERSATION_MODEL, messages_to_send, purpose="conversation_stream"):
+                    delta = chunk["choices"][0]["delta"].get("content")
+                    if not delta:
+                        continue
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                        time_to_first_token.observe(first_token_at - start)
+                        logger.info(f"conversation={uuid} time_to_first_token_ms={(first_token_at - start) * 1000:.0f}")
+                    parts.append(delta)
+                    yield f"data: {json.dumps({'content': delta})}\n\n"
+            except Exception as e:
+                logger.error(f"Error while streaming the GPT response for conversation {uuid}: {e}")
+                metrics.STAGE_SECONDS.observe(time.monotonic() - start, stage="llm_stream", outcome="error")
+                yield f"event: error\ndata: {json.dumps({'message': 'Error while calling OpenAI API'})}\n\n"
+                return
 
-    # 将GPT-4的回复保存到MongoDB
-    collection.update_one({"uuid": uuid}, {"$push": {"messages": gpt_response}})
+            metrics.STAGE_SECONDS.observe(time.monotonic() - start, stage="llm_stream", outcome="ok")
+            response_cache.put(CONVERSATION_MODEL, history, user_message['content'], "".join(parts),
+                               time.monotonic() - start, tokens_sent)
 
-    return jsonify({"status": "success"})
+        # 回复结束后，将GPT-4的完整回复保存到MongoDB
+        assistant_message = {"role": "assistant", "content": "".join(parts)}
+        if cached:
+            assistant_message["cached"] = True
+        try:
+            with metrics.span("conversation_save"):
+                stored_messages = content_store.store([assistant_message])
+                collection.update_one({"uuid": uuid}, {"$push": {"messages": {"$each": stored_messages}}})
+        except Exception as e:
+            logger.error(f"Error while saving the messages of conversation {uuid}: {e}")
+            yield f"event: error\ndata: {json.dumps({'message': 'Error while saving the conversation'})}\n\n"
+            return
+        logger.info(f"conversation={uuid} stream_duration_ms={(time.monotonic() - start) * 1000:.0f}")
+        yield f"event: done\ndata: {json.dumps({'status': 'success', 'tokens_sent': tokens_sent, 'cached': cached})}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == '__main__':
+    ensure_indexes()
     app.run(host='0.0.0.0')
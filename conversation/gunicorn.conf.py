@@ -0,0 +1,19 @@
+# gunicorn -c gunicorn.conf.py conversation:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+# 每个流式回复（/add-message-stream）在整个生成过程中占用一个线程
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+# 每个 worker 在 fork 之后创建自己的 MongoClient
+preload_app = False
+accesslog = "-"
+
+
+def post_worker_init(worker):
+    import conversation
+    conversation.ensure_indexes()
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from common import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = metrics.counter("response_cache_lookups_total", "Response cache lookups by result.", ("result",))
+SAVED_SECONDS = metrics.counter("response_cache_saved_seconds_total", "GPT latency saved by cached replies.")
+SAVED_TOKENS = metrics.counter("response_cache_saved_prompt_tokens_total", "Prompt tokens not sent thanks to cached replies.")
+
+# 对话页面上预设按钮的问题，回答只取决于PR和第一条review
+PRESET_QUESTIONS = (
+    "Any further suggestions related to my pull request?",
+    "This is a prototype implementation. So don't provide suggestions on fault tolerance, safety, or security concerns, "
+    "which are not addressed at this stage.",
+)
+
+# 英文按单词切分，中文等非ASCII字符逐字切分
+_TOKEN = re.compile(r"[a-z0-9_]+|[^\x00-\x7f]")
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split()).rstrip("?？.。!！ ")
+
+
+def _terms(question):
+    # 去掉英文复数的 s，"suggestions" 和 "suggestion" 视为同一个词
+    words = [word[:-1] if len(word) > 3 and word.endswith("s") else word
+             for word in _TOKEN.findall(normalize_question(question))]
+    return Counter(words + [f"{a} {b}" for a, b in zip(words, words[1:])])
+
+
+class _Entry:
+    __slots__ = ("key", "reply", "context", "terms", "expires_at", "latency", "prompt_tokens")
+
+    def __init__(self, key, reply, context, terms, expires_at, latency, prompt_tokens):
+        self.key = key
+        self.reply = reply
+        self.context = context
+        self.terms = terms
+        self.expires_at = expires_at
+        self.latency = latency
+        self.prompt_tokens = prompt_tokens
+
+
+class ResponseCache:
+    """Caches GPT replies by (context version, normalized question).
+
+    The context is the stored conversation before the question, identified
+    by the content hash of each message, so a lookup needs neither the
+    message bodies nor the summarized history sent to GPT. With
+    `scope="review"` (the default) the `review_questions` (by default the
+    preset buttons, whose meaning does not depend on the discussion) only need
+    the same pull request prompt and first review, so they are answered once
+    per review; other questions still need the whole history. With
+    `scope="history"` every question needs the whole history to match.
+
+    With `similarity` > 0, a question that misses exactly is compared with the
+    cached questions of the same context by TF-IDF cosine similarity over
+    words and word pairs, and the best match at or above the threshold is
+    used. Entries expire after `ttl_seconds`; the least recently used are
+    evicted beyond `max_entries`, and `max_entries=0` disables the cache.
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=3600, scope="review", similarity=0.0,
+                 review_questions=PRESET_QUESTIONS):
+        if scope not in ("review", "history"):
+            raise ValueError(f"Unknown response cache scope: {scope}")
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.scope = scope
+        self.review_questions = {normalize_question(question) for question in review_questions}
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self._contexts = {}
+        # 所有缓存问题中每个词出现的文档数，用于计算IDF
+        self._df = Counter()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    @staticmethod
+    def _digest(message):
+        # 与 ContentStore 的 content_ref 相同，内容单独存储的消息无需加载内容
+        ref = message.get("content_ref")
+        if ref is None:
+            ref = hashlib.sha256(message["content"].encode("utf-8")).hexdigest()
+        return ref
+
+    def context_key(self, model, history, question):
+        # history 是保存的对话中问题之前的消息
+        if self.scope == "review" and normalize_question(question) in self.review_questions:
+            for index, message in enumerate(history):
+                if message["role"] == "assistant":
+                    history = history[:index + 1]
+                    break
+        payload = json.dumps([model, [[m["role"], self._digest(m)] for m in history]])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _key(self, context, question):
+        return hashlib.sha256(f"{context}\n{normalize_question(question)}".encode("utf-8")).hexdigest()
+
+    def get(self, model, history, question):
+        """Return the cached reply to `question` asked after the stored messages `history`, or None."""
+        if not self.max_entries:
+            return None
+        context = self.context_key(model, history, question)
+        key = self._key(context, question)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._live(key, now)
+            result = "hit"
+            if entry is None and self.similarity > 0:
+                entry = self._most_similar(context, _terms(question), now)
+                result = "similar"
+            if entry is None:
+                self._stats["misses"] += 1
+                LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(entry.key)
+            self._stats["hits" if result == "hit" else "similar_hits"] += 1
+        LOOKUPS.inc(result=result)
+        SAVED_SECONDS.inc(entry.latency)
+        SAVED_TOKENS.inc(entry.prompt_tokens)
+        return entry.reply
+
+    def put(self, model, history, question, reply, latency, prompt_tokens):
+        # latency 和 prompt_tokens 是这次GPT调用的耗时和token数，命中时计入节省的部分
+        if not self.max_entries:
+            return
+        context = self.context_key(model, history, question)
+        key = self._key(context, question)
+        entry = _Entry(key, reply, context, _terms(question), time.monotonic() + self.ttl_seconds, latency, prompt_tokens)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._contexts.setdefault(context, set()).add(key)
+            self._df.update(entry.terms.keys())
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["similar_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["similar_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at <= now:
+            self._remove(key)
+            self._stats["expired"] += 1
+            return None
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        for term in entry.terms:
+            self._df[term] -= 1
+            if self._df[term] <= 0:
+                del self._df[term]
+        keys = self._contexts.get(entry.context)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._contexts[entry.context]
+
+    def _most_similar(self, context, terms, now):
+        candidates = [
+            entry for entry in (self._live(key, now) for key in list(self._contexts.get(context, ())))
+            if entry is not None
+        ]
+        if not candidates or not terms:
+            return None
+        # 只和同一上下文的问题比较，IDF 则基于所有缓存的问题，常见词的权重较低
+        documents = len(self._entries)
+
+        def vector(document):
+            weights = {term: count * (math.log((1 + documents) / (1 + self._df[term])) + 1)
+                       for term, count in document.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+            return weights, norm
+
+        query, query_norm = vector(terms)
+        best, best_score = None, self.similarity
+        for entry in candidates:
+            weights, norm = vector(entry.terms)
+            if not norm:
+                continue
+            score = sum(weight * weights.get(term, 0) for term, weight in query.items()) / (query_norm * norm)
+            if score >= best_score:
+                best, best_score = entry, score
+        if best is not None:
+            logger.info(f"trace_id={metrics.current_trace_id()} response cache similar match score={best_score:.2f}")
+        return best
+
+
+def response_cache_from_env():
+    """Build the cache from RESPONSE_CACHE_* environment variables.
+
+    RESPONSE_CACHE_SIMILARITY is the TF-IDF cosine threshold for near-duplicate
+    questions (e.g. 0.85); 0, the default, only matches normalized questions exactly.
+    """
+    cache = ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+        ttl_seconds=float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "3600")),
+        scope=os.environ.get("RESPONSE_CACHE_SCOPE", "review"),
+        similarity=float(os.environ.get("RESPONSE_CACHE_SIMILARITY", "0")),
+    )
+    metrics.expose_stats("response_cache", "Conversation response cache statistics.", cache.stats)
+    return cache
@@ -0,0 +1,97 @@
+import fnmatch
+import os
+
+from common.diff_model import parse_unified_diff
+
+# 默认不返回内容的文件：依赖锁文件、第三方代码和构建产物
+DEFAULT_EXCLUDE_PATTERNS = [
+    "*.lock", "package-lock.json", "pnpm-lock.yaml", "go.sum",
+    "vendor/*", "*/vendor/*", "third_party/*", "node_modules/*", "*/node_modules/*",
+    "dist/*", "*.min.js", "*.min.css", "*.map", "*.pb.go", "*_pb2.py",
+]
+
+
+def exclude_patterns():
+    # DIFF_EXCLUDE_PATTERNS 为逗号分隔的 glob 列表，设置后替换默认规则
+    value = os.environ.get("DIFF_EXCLUDE_PATTERNS")
+    if value is None:
+        return DEFAULT_EXCLUDE_PATTERNS
+    return [pattern.strip() for pattern in value.split(",") if pattern.strip()]
+
+
+def is_excluded(path, patterns):
+    name = path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def iter_lines(chunks):
+    # 把流式读取的数据块拆分成行（不含换行符）
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def index_diff(lines, patterns, keep_path=None, keep_max_bytes=None):
+    """Index a unified diff read line by line, without holding the whole diff.
+
+    Returns `(files, overflow)`. Every file gets an entry with its path,
+    status, added/removed line counts, size in bytes and number of hunks.
+    Hunk text is kept in `entry["_patch"]` (a list of hunks) only for
+    `keep_path`, or, without `keep_path`, for every file that is not
+    excluded, until the kept text exceeds `keep_max_bytes`. Past that point
+    all kept text is dropped and `overflow` is True.
+    """
+    files = []
+    kept_bytes = 0
+    overflow = False
+
+    def keep(file):
+        if keep_path is not None:
+            return file.path == keep_path
+        return not overflow and not is_excluded(file.path, patterns)
+
+    for file in parse_unified_diff(lines, keep):
+        entry = {
+            "path": file.path,
+            "status": file.status,
+            "additions": file.additions,
+            "deletions": file.deletions,
+            "bytes": file.size,
+            "hunks": file.hunk_count,
+            "binary": file.binary,
+            "excluded": file.binary or is_excluded(file.path, patterns),
+            "_patch": [hunk.render() for hunk in file.hunks] if file.hunks else None,
+        }
+        if file.previous_path:
+            entry["previous_path"] = file.previous_path
+        files.append(entry)
+
+        if keep_path is None and entry["_patch"]:
+            kept_bytes += sum(len(hunk) + 1 for hunk in entry["_patch"])
+            if keep_max_bytes is not None and kept_bytes > keep_max_bytes:
+                # 超过内联上限，丢弃已保存的内容，之后只建立索引
+                overflow = True
+                for kept in files:
+                    kept["_patch"] = None
+    return files, overflow
+
+
+def paginate_hunks(hunks, max_bytes):
+    # 按大小把 hunk 分页，单个超过上限的 hunk 单独成一页
+    pages = []
+    page = []
+    size = 0
+    for hunk in hunks:
+        if page and size + len(hunk) > max_bytes:
+            pages.append(page)
+            page = []
+            size = 0
+        page.append(hunk)
+        size += len(hunk) + 1
+    if page:
+        pages.append(page)
+    return pages
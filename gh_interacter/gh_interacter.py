@@ -1,13 +1,107 @@
 from functools import wraps
 from flask import Flask, request, jsonify, abort
-import requests
 import base64
+import hashlib
+import hmac
+import json
 import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from common import metrics
+from common.blob_cache import blob_cache_from_env
+from common.repo_index import repo_index_from_env
+from github_client import GitHubClient
+from repo_metadata import RepoMetadataCache
+from diff_index import exclude_patterns, index_diff, iter_lines, paginate_hunks
+from index_builder import RepoIndexBuilder
 
 app = Flask(__name__)
+metrics.instrument_app(app, "gh_interacter")
 
 RHINO_API_KEY = os.getenv("RHINO_API_KEY")
 
+# 所有 GitHub 请求共用一个带连接池、认证和限流处理的客户端
+github = GitHubClient(
+    token=os.getenv("GITHUB_TOKEN"),
+    base_url=os.getenv("GITHUB_API_URL", "https://api.github.com"),
+    pool_size=int(os.getenv("GITHUB_POOL_SIZE", "10")),
+    etag_cache_entries=int(os.getenv("GITHUB_ETAG_CACHE_ENTRIES", "1000")),
+    min_remaining=int(os.getenv("GITHUB_MIN_REMAINING", "100")),
+)
+
+# 默认分支和分支对应的 commit SHA，由 push webhook 保持最新
+repo_metadata = RepoMetadataCache(github, ttl_seconds=int(os.getenv("REPO_METADATA_TTL_SECONDS", "300")),
+                                  max_entries=int(os.getenv("REPO_METADATA_MAX_ENTRIES", "10000")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# 批量接口：单次请求的条目数和响应大小上限
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_RESPONSE_MAX_BYTES = int(os.getenv("BATCH_RESPONSE_MAX_BYTES", str(512 * 1024)))
+batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_FETCH_CONCURRENCY", "8")))
+
+# /pr_content：diff 不超过该大小时内联返回，单个文件按页返回 hunk
+PR_CONTENT_INLINE_MAX_BYTES = int(os.getenv("PR_CONTENT_INLINE_MAX_BYTES", str(64 * 1024)))
+PR_CONTENT_PAGE_MAX_BYTES = int(os.getenv("PR_CONTENT_PAGE_MAX_BYTES", str(32 * 1024)))
+
+# 文件内容按 blob SHA 缓存
+blob_cache = blob_cache_from_env()
+
+metrics.expose_stats("blob_cache", "Blob cache statistics.", blob_cache.stats)
+
+# 默认分支的符号索引，由 push webhook 增量更新；REPO_INDEX_BACKEND 未设置时不启用
+repo_index = repo_index_from_env()
+repo_index_builder = None
+if repo_index is not None:
+    repo_index.store.ensure_indexes()
+    repo_index_builder = RepoIndexBuilder(
+        github,
+        blob_cache,
+        repo_index,
+        exclude_patterns(),
+        max_files=int(os.getenv("REPO_INDEX_MAX_FILES", "5000")),
+        max_file_bytes=int(os.getenv("REPO_INDEX_MAX_FILE_BYTES", str(256 * 1024))),
+        fetch_concurrency=int(os.getenv("REPO_INDEX_FETCH_CONCURRENCY", "4")),
+    )
+    metrics.expose_stats("repo_index", "Repository index statistics.", repo_index_builder.stats)
+metrics.expose_stats("repo_metadata_cache", "Repository metadata cache statistics.", repo_metadata.stats)
+github_rate_limit = metrics.gauge("github_rate_limit", "GitHub API quota from the X-RateLimit headers.", ("resource", "field"))
+github_etag_cache = metrics.gauge("github_etag_cache", "Conditional request cache of the GitHub client.", ("stat",))
+
+def collect_github_quota():
+    quota = github.quota()
+    for resource, limits in quota["rate_limit"].items():
+        for field in ("limit", "remaining", "reset_in_seconds"):
+            if limits.get(field) is not None:
+                github_rate_limit.set(limits[field], resource=resource, field=field)
+    github_etag_cache.set(quota["etag_cache_entries"], stat="entries")
+    github_etag_cache.set(quota["not_modified_responses"], stat="not_modified_responses")
+
+metrics.add_collector(collect_github_quota)
+
+# (仓库, commit SHA, 文件路径) -> blob SHA。commit SHA 不可变，命中后无需再访问 GitHub
+commit_path_index = OrderedDict()
+commit_path_index_lock = threading.Lock()
+COMMIT_PATH_INDEX_MAX_ENTRIES = int(os.getenv("COMMIT_PATH_INDEX_MAX_ENTRIES", "10000"))
+
+def is_commit_sha(ref):
+    return re.fullmatch(r"[0-9a-f]{40}", ref or "") is not None
+
+def remember_blob_sha(key, sha):
+    with commit_path_index_lock:
+        commit_path_index[key] = sha
+        commit_path_index.move_to_end(key)
+        while len(commit_path_index) > COMMIT_PATH_INDEX_MAX_ENTRIES:
+            commit_path_index.popitem(last=False)
+
+def lookup_blob_sha(key):
+    with commit_path_index_lock:
+        sha = commit_path_index.get(key)
+        if sha is not None:
+            commit_path_index.move_to_end(key)
+        return sha
+
 def require_api_key(view_function):
     @wraps(view_function)
     def decorated_function(*args, **kwargs):
@@ -17,84 +111,438 @@ def require_api_key(view_function):
             abort(401)  # Unauthorized access
     return decorated_function
 
-def check_branch_exists(repo_full_name, branch_name):
-    github_api_url = f"https://api.github.com/repos/{repo_full_name}/branches/{branch_name}"
-    response = requests.get(github_api_url)
-    return response.status_code == 200
+def validate_signature(request):
+    signature = request.headers.get("X-Hub-Signature-256")
+    if signature is None or not WEBHOOK_SECRET:
+        return False
+
+    sha_name, _, signature = signature.partition("=")
+    if sha_name != "sha256":
+        return False
+
+    mac = hmac.new(WEBHOOK_SECRET.encode(), msg=request.data, digestmod=hashlib.sha256)
+    return hmac.compare_digest(mac.hexdigest(), signature)
+
+def render_file_patch(entry, hunks):
+    previous_path = entry.get('previous_path', entry['path'])
+    old = '/dev/null' if entry['status'] == 'added' else f"a/{previous_path}"
+    new = '/dev/null' if entry['status'] == 'removed' else f"b/{entry['path']}"
+    return "\n".join([f"diff --git a/{previous_path} b/{entry['path']}", f"--- {old}", f"+++ {new}"] + hunks)
+
+def public_entry(entry):
+    return {key: value for key, value in entry.items() if not key.startswith('_')}
 
 @app.route('/pr_content', methods=['GET'])
 @require_api_key
 def get_pr_content():
     repo_full_name = request.args.get('repo_full_name')
     pr_number = request.args.get('pr_number')
+    file_path = request.args.get('file')
 
     if not repo_full_name or not pr_number:
         return jsonify({'code': 400, 'message': 'Missing repo_full_name or pr_number'}), 400
+    try:
+        page = int(request.args.get('page', 1))
+    except ValueError:
+        return jsonify({'code': 400, 'message': 'page must be an integer'}), 400
 
     # 获取PR的基本信息
-    github_api_url = f"https://api.github.com/repos/{repo_full_name}/pulls/{pr_number}"
-    response = requests.get(github_api_url)
+    response = github.get(f"repos/{repo_full_name}/pulls/{pr_number}")
 
     if response.status_code == 404:
         return jsonify({'code': 404, 'message': 'Pull Request not found'}), 404
     elif response.status_code != 200:
         return jsonify({'code': response.status_code, 'message': 'Unexpected error occurred'}), response.status_code
 
-    # 获取PR的diff
-    diff_url = response.json().get('diff_url')
-    if not diff_url:
-        return jsonify({'code': 500, 'message': 'Failed to get diff URL'}), 500
-
-    diff_response = requests.get(diff_url, headers={'Accept': 'application/vnd.github.v3.diff'})
+    # 流式读取PR的diff，只保留索引和需要返回的部分
+    diff_response = github.get(f"repos/{repo_full_name}/pulls/{pr_number}",
+                               headers={'Accept': 'application/vnd.github.v3.diff'}, stream=True)
 
     if diff_response.status_code != 200:
+        diff_response.close()
         return jsonify({'code': diff_response.status_code, 'message': 'Failed to get PR diff'}), diff_response.status_code
 
-    # 返回PR的基本信息和diff
+    try:
+        files, overflow = index_diff(
+            iter_lines(diff_response.iter_content(chunk_size=64 * 1024)),
+            exclude_patterns(),
+            keep_path=file_path,
+            keep_max_bytes=PR_CONTENT_INLINE_MAX_BYTES,
+        )
+    finally:
+        diff_response.close()
+
+    # 分页返回单个文件的 hunk
+    if file_path:
+        entry = next((entry for entry in files if entry['path'] == file_path), None)
+        if entry is None:
+            return jsonify({'code': 404, 'message': 'File not found in the Pull Request'}), 404
+        pages = paginate_hunks(entry['_patch'] or [], PR_CONTENT_PAGE_MAX_BYTES)
+        if pages and not 1 <= page <= len(pages):
+            return jsonify({'code': 404, 'message': f'Page out of range, the file has {len(pages)} pages'}), 404
+        return jsonify({
+            'file': public_entry(entry),
+            'page': page,
+            'total_pages': len(pages),
+            'patch': "\n".join(pages[page - 1]) if pages else '',
+        })
+
+    # 返回PR的基本信息和文件索引
     pr_content = response.json()
     # 获取PR的源分支和源仓库
     source_branch = pr_content.get('head', {}).get('ref')
     source_repo = pr_content.get('head', {}).get('repo', {}).get('full_name')
-    
+
+    # diff 不大时直接内联返回（不包含被排除的文件）
+    code_changes = None
+    if not overflow:
+        code_changes = "\n".join(render_file_patch(entry, entry['_patch']) for entry in files if entry['_patch'])
+
     return jsonify({
         'title': pr_content.get('title'),
         'body': pr_content.get('body'),
         'source_branch': source_branch,
-        'source_repo': source_repo,      
-        'code_changes': diff_response.text  # 注意，这可能是一个很大的字符串
+        'source_repo': source_repo,
+        'head_sha': pr_content.get('head', {}).get('sha'),
+        'files': [public_entry(entry) for entry in files],
+        'code_changes': code_changes,
+        'code_changes_truncated': overflow,
     })
 
+class FetchError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+    def to_dict(self):
+        return {'code': self.code, 'message': self.message}
+
+def resolve_ref(repo_full_name, branch_name):
+    """Return `(commit_sha, ref)` for a branch name, commit SHA or tag.
+
+    Branches are resolved to commit SHAs so that every fetch is pinned to a
+    commit; `commit_sha` is None for refs GitHub has to resolve (e.g. tags).
+    """
+    try:
+        if not branch_name:
+            branch_name = repo_metadata.default_branch(repo_full_name)
+            if not branch_name:
+                raise FetchError(404, 'Repository not found')
+        commit_sha = branch_name if is_commit_sha(branch_name) else repo_metadata.branch_sha(repo_full_name, branch_name)
+    except RuntimeError as e:
+        raise FetchError(502, f'Failed to resolve branch: {e}')
+    return commit_sha, commit_sha or branch_name
+
+def cached_file_content(repo_full_name, commit_sha, file_path):
+    # 之前在同一个 commit 上获取过该文件时，直接从缓存返回
+    if not commit_sha:
+        return None
+    blob_sha = lookup_blob_sha((repo_full_name, commit_sha, file_path))
+    return blob_cache.get(blob_sha) if blob_sha is not None else None
+
+def remember_file_content(repo_full_name, commit_sha, file_path, blob_sha, content):
+    blob_cache.put(blob_sha, content)
+    if commit_sha:
+        remember_blob_sha((repo_full_name, commit_sha, file_path), blob_sha)
+
+def fetch_file_content(repo_full_name, file_path, commit_sha, ref):
+    content = cached_file_content(repo_full_name, commit_sha, file_path)
+    if content is not None:
+        return content
+
+    response = github.get(f"repos/{repo_full_name}/contents/{file_path}", params={'ref': ref})
+
+    if response.status_code != 200:
+        raise FetchError(response.status_code, f'Failed to fetch file content from {ref}')
+
+    file_info = response.json()
+    blob_sha = file_info.get('sha')
+    content = blob_cache.get(blob_sha) if blob_sha else None
+    if content is None:
+        file_content_encoded = file_info.get('content')
+        if file_content_encoded is None:
+            raise FetchError(500, 'No content found in the response')
+
+        # 对Base64编码的内容进行解码
+        content = base64.b64decode(file_content_encoded).decode('utf-8')
+    if blob_sha:
+        remember_file_content(repo_full_name, commit_sha, file_path, blob_sha, content)
+    return content
+
+def fetch_issue_info(repo_full_name, issue_number):
+    response = github.get(f"repos/{repo_full_name}/issues/{issue_number}")
+
+    if response.status_code != 200:
+        raise FetchError(response.status_code, 'Failed to fetch issue info')
+
+    issue_info = response.json()
+    return {
+        'title': issue_info.get('title'),
+        'description': issue_info.get('body')
+    }
+
+def graphql_file_contents(repo_full_name, commit_sha, file_paths):
+    """Fetch several files at one commit with a single GraphQL query.
+
+    Returns a dict of path -> content or `FetchError`. Files GraphQL cannot
+    return in full (truncated text) are left out, so the caller can fall back
+    to the REST API for them.
+    """
+    owner, name = repo_full_name.split('/', 1)
+    variables = {'owner': owner, 'name': name}
+    fields = []
+    for i, path in enumerate(file_paths):
+        variables[f'e{i}'] = f'{commit_sha}:{path}'
+        fields.append(f'f{i}: object(expression: $e{i}) {{ ... on Blob {{ oid text isBinary isTruncated }} }}')
+    declarations = ''.join(f', $e{i}: String!' for i in range(len(file_paths)))
+    query = (f'query($owner: String!, $name: String!{declarations}) '
+             f'{{ repository(owner: $owner, name: $name) {{ {" ".join(fields)} }} }}')
+    data, _ = github.graphql(query, variables)
+    repository = data.get('repository')
+    if repository is None:
+        raise FetchError(404, 'Repository not found')
+
+    results = {}
+    for i, path in enumerate(file_paths):
+        blob = repository.get(f'f{i}')
+        if not blob:
+            # 不存在的路径为null，目录为空对象
+            results[path] = FetchError(404, 'File not found')
+        elif blob['isBinary']:
+            results[path] = FetchError(415, 'Binary files are not supported')
+        elif blob['text'] is not None and not blob['isTruncated']:
+            remember_file_content(repo_full_name, commit_sha, path, blob['oid'], blob['text'])
+            results[path] = blob['text']
+    return results
+
+def graphql_issue_infos(repo_full_name, issue_numbers):
+    # 返回 issue号 -> 信息或 FetchError，PR 号同样可以查询
+    owner, name = repo_full_name.split('/', 1)
+    variables = {'owner': owner, 'name': name}
+    fields = []
+    for i, number in enumerate(issue_numbers):
+        variables[f'n{i}'] = number
+        fields.append(f'i{i}: issueOrPullRequest(number: $n{i}) '
+                      f'{{ ... on Issue {{ title body }} ... on PullRequest {{ title body }} }}')
+    declarations = ''.join(f', $n{i}: Int!' for i in range(len(issue_numbers)))
+    query = (f'query($owner: String!, $name: String!{declarations}) '
+             f'{{ repository(owner: $owner, name: $name) {{ {" ".join(fields)} }} }}')
+    data, _ = github.graphql(query, variables)
+    repository = data.get('repository')
+    if repository is None:
+        raise FetchError(404, 'Repository not found')
+
+    results = {}
+    for i, number in enumerate(issue_numbers):
+        issue = repository.get(f'i{i}')
+        if issue is None:
+            results[number] = FetchError(404, 'Issue not found')
+        else:
+            results[number] = {'title': issue.get('title'), 'description': issue.get('body')}
+    return results
+
+def fetch_concurrently(fetch, keys, results):
+    # 通过 REST API 并发获取 results 中还没有的条目
+    futures = {key: batch_executor.submit(fetch, key) for key in keys if key not in results}
+    for key, future in futures.items():
+        try:
+            results[key] = future.result()
+        except FetchError as e:
+            results[key] = e
+        except Exception as e:
+            results[key] = FetchError(500, str(e))
+
+def batch_items(id_field, ids, results, render):
+    """Build the per-item list of a batch response within BATCH_RESPONSE_MAX_BYTES.
+
+    Items that do not fit anymore get a 413 error so that they can be
+    requested separately.
+    """
+    items = []
+    size = 0
+    truncated = False
+    for item_id in ids:
+        result = results[item_id]
+        if isinstance(result, FetchError):
+            items.append({id_field: item_id, 'error': result.to_dict()})
+            continue
+        item = {id_field: item_id, **render(result)}
+        item_size = len(json.dumps(item))
+        if size + item_size > BATCH_RESPONSE_MAX_BYTES:
+            truncated = True
+            items.append({id_field: item_id, 'error': {'code': 413, 'message': 'Response size limit reached, request this item separately'}})
+            continue
+        size += item_size
+        items.append(item)
+    return items, truncated
+
 @app.route('/file_content', methods=['GET'])
 @require_api_key
 def get_file_content():
     repo_full_name = request.args.get('repo_full_name')
     file_path = request.args.get('file_path')
     branch_name = request.args.get('branch_name')
-    if not branch_name:
-        # 检查是否存在 main 或 master 分支
-        if check_branch_exists(repo_full_name, "main"):
-            branch_name = "main"
-        elif check_branch_exists(repo_full_name, "master"):
-            branch_name = "master"
-        else:
-            return jsonify({'code': 404, 'message': 'No main or master branch found'}), 404
 
     if not repo_full_name or not file_path:
         return jsonify({'code': 400, 'message': 'Missing repo_full_name or file_path'}), 400
 
-    github_api_url = f"https://api.github.com/repos/{repo_full_name}/contents/{file_path}?ref={branch_name}"
-    response = requests.get(github_api_url)
+    try:
+        commit_sha, ref = resolve_ref(repo_full_name, branch_name)
+        content = fetch_file_content(repo_full_name, file_path, commit_sha, ref)
+    except FetchError as e:
+        return jsonify(e.to_dict()), e.code
+    return jsonify({'content': content, 'commit_sha': commit_sha})
 
-    if response.status_code != 200:
-        return jsonify({'code': response.status_code, 'message': f'Failed to fetch file content from {branch_name} branch'}), response.status_code
+@app.route('/batch_file_content', methods=['POST'])
+@require_api_key
+def get_batch_file_content():
+    payload = request.json or {}
+    repo_full_name = payload.get('repo_full_name')
+    file_paths = payload.get('file_paths')
+    branch_name = payload.get('branch_name')
+
+    if not repo_full_name or not isinstance(file_paths, list) or not file_paths:
+        return jsonify({'code': 400, 'message': 'Missing repo_full_name or file_paths'}), 400
+    if len(file_paths) > BATCH_MAX_ITEMS:
+        return jsonify({'code': 400, 'message': f'At most {BATCH_MAX_ITEMS} files can be requested at once'}), 400
+    file_paths = list(dict.fromkeys(file_paths))
+
+    try:
+        commit_sha, ref = resolve_ref(repo_full_name, branch_name)
+        results = {}
+        for file_path in file_paths:
+            content = cached_file_content(repo_full_name, commit_sha, file_path)
+            if content is not None:
+                results[file_path] = content
+        missing = [file_path for file_path in file_paths if file_path not in results]
+        # GraphQL 需要认证，一次查询获取所有文件
+        if missing and github.token and commit_sha:
+            try:
+                results.update(graphql_file_contents(repo_full_name, commit_sha, missing))
+            except RuntimeError as e:
+                app.logger.warning(f"Falling back to REST for batch file content: {e}")
+    except FetchError as e:
+        return jsonify(e.to_dict()), e.code
+
+    fetch_concurrently(lambda file_path: fetch_file_content(repo_full_name, file_path, commit_sha, ref), file_paths, results)
+    files, truncated = batch_items('file_path', file_paths, results, lambda content: {'content': content})
+    return jsonify({'commit_sha': commit_sha, 'files': files, 'truncated': truncated})
+
+@app.route('/batch_issue_info', methods=['POST'])
+@require_api_key
+def get_batch_issue_info():
+    payload = request.json or {}
+    repo_full_name = payload.get('repo_full_name')
+    issue_numbers = payload.get('issue_numbers')
+
+    if not repo_full_name or not isinstance(issue_numbers, list) or not issue_numbers:
+        return jsonify({'code': 400, 'message': 'Missing repo_full_name or issue_numbers'}), 400
+    if len(issue_numbers) > BATCH_MAX_ITEMS:
+        return jsonify({'code': 400, 'message': f'At most {BATCH_MAX_ITEMS} issues can be requested at once'}), 400
+    try:
+        issue_numbers = list(dict.fromkeys(int(number) for number in issue_numbers))
+    except (TypeError, ValueError):
+        return jsonify({'code': 400, 'message': 'issue_numbers must be integers'}), 400
+
+    results = {}
+    if github.token:
+        try:
+            results = graphql_issue_infos(repo_full_name, issue_numbers)
+        except FetchError as e:
+            return jsonify(e.to_dict()), e.code
+        except RuntimeError as e:
+            app.logger.warning(f"Falling back to REST for batch issue info: {e}")
+
+    fetch_concurrently(lambda number: fetch_issue_info(repo_full_name, number), issue_numbers, results)
+    issues, truncated = batch_items('issue_number', issue_numbers, results, lambda info: info)
+    return jsonify({'issues': issues, 'truncated': truncated})
+
+@app.route('/webhook/push', methods=['POST'])
+def handle_push_webhook():
+    # 根据 push / repository 事件更新或失效仓库元数据缓存
+    if not validate_signature(request):
+        abort(401)
 
-    file_content_encoded = response.json().get('content')
-    if file_content_encoded is None:
-        return jsonify({'code': 500, 'message': 'No content found in the response'}), 500
+    event = request.headers.get('X-GitHub-Event')
+    payload = request.json or {}
+    repo_full_name = payload.get('repository', {}).get('full_name')
+    if not repo_full_name:
+        return jsonify({'message': 'Ignored'}), 200
 
-    # 对Base64编码的内容进行解码
-    file_content_decoded = base64.b64decode(file_content_encoded).decode('utf-8')
-    return jsonify({'content': file_content_decoded})
+    if event == 'push':
+        ref = payload.get('ref', '')
+        if ref.startswith('refs/heads/'):
+            branch_name = ref[len('refs/heads/'):]
+            repo_metadata.update_branch(repo_full_name, branch_name, None if payload.get('deleted') else payload.get('after'))
+        default_branch = payload.get('repository', {}).get('default_branch')
+        if default_branch:
+            repo_metadata.set_default_branch(repo_full_name, default_branch)
+        # 只为默认分支建索引
+        if (repo_index_builder is not None and default_branch and ref == f'refs/heads/{default_branch}'
+                and not payload.get('deleted') and payload.get('after')):
+            repo_index_builder.schedule(repo_full_name, payload['after'])
+    elif event in ('repository', 'create', 'delete'):
+        repo_metadata.invalidate(repo_full_name)
+    return jsonify({'message': 'OK'}), 200
+
+@app.route('/search_code', methods=['GET'])
+@require_api_key
+def search_code():
+    repo_full_name = request.args.get('repo_full_name')
+    query = request.args.get('q')
+
+    if not repo_full_name or not query:
+        return jsonify({'code': 400, 'message': 'Missing repo_full_name or q'}), 400
+    if repo_index is None:
+        return jsonify({'code': 501, 'message': 'Code search is not enabled'}), 501
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), 50)
+    except ValueError:
+        return jsonify({'code': 400, 'message': 'limit must be an integer'}), 400
+
+    commit_sha = repo_index.head(repo_full_name)
+    if commit_sha is None:
+        return jsonify({'code': 404, 'message': 'Repository is not indexed yet'}), 404
+    results = repo_index.search(repo_full_name, query, limit)
+    return jsonify(dict(results, commit_sha=commit_sha))
+
+@app.route('/repo_index', methods=['POST'])
+@require_api_key
+def rebuild_repo_index():
+    # 首次建立索引或手动重建；之后由 push webhook 增量更新
+    repo_full_name = (request.json or {}).get('repo_full_name')
+    if not repo_full_name:
+        return jsonify({'code': 400, 'message': 'Missing repo_full_name'}), 400
+    if repo_index_builder is None:
+        return jsonify({'code': 501, 'message': 'Code search is not enabled'}), 501
+    try:
+        commit_sha, _ = resolve_ref(repo_full_name, None)
+    except FetchError as e:
+        return jsonify(e.to_dict()), e.code
+    if commit_sha is None:
+        return jsonify({'code': 404, 'message': 'Default branch not found'}), 404
+    repo_index_builder.schedule(repo_full_name, commit_sha)
+    return jsonify({'message': 'Indexing scheduled', 'commit_sha': commit_sha}), 202
+
+@app.route('/cache_stats', methods=['GET'])
+@require_api_key
+def get_cache_stats():
+    return jsonify({
+        'blob_cache': blob_cache.stats(),
+        'commit_path_index_entries': len(commit_path_index),
+        'repo_metadata': repo_metadata.stats(),
+        'repo_index': repo_index_builder.stats() if repo_index_builder is not None else None,
+    })
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # 返回 GitHub API 剩余配额，便于监控和负载均衡判断
+    quota = github.quota()
+    status = 'Healthy'
+    if any(rate['remaining'] == 0 for rate in quota['rate_limit'].values()):
+        status = 'Rate limited'
+    return jsonify({'status': status, 'github': quota})
 
 @app.route('/issue_info', methods=['GET'])
 @require_api_key
@@ -105,23 +553,15 @@ def get_issue_info():
     if not repo_full_name or not issue_number:
         return jsonify({'code': 400, 'message': 'Missing repo_full_name or issue_number'}), 400
 
-    github_api_url = f"https://api.github.com/repos/{repo_full_name}/issues/{issue_number}"
-    response = requests.get(github_api_url)
-
-    if response.status_code != 200:
-        return jsonify({'code': response.status_code, 'message': 'Failed to fetch issue info'}), response.status_code
-
-    issue_info = response.json()
-    return jsonify({
-        'title': issue_info.get('title'),
-        'description': issue_info.get('body')
-    })
+    try:
+        return jsonify(fetch_issue_info(repo_full_name, issue_number))
+    except FetchError as e:
+        return jsonify(e.to_dict()), e.code
 
 @app.route('/submit_pr_comment', methods=['POST'])
 @require_api_key
 def submit_pr_comment():
-    token = os.environ.get('GITHUB_TOKEN')
-    if not token:
+    if not github.token:
         return jsonify({'code': 401, 'message': 'GitHub access token is not set'}), 401
 
     repo_full_name = request.json.get('repo_full_name')
@@ -131,15 +571,10 @@ def submit_pr_comment():
     if not repo_full_name or not pr_number or not comment_body:
         return jsonify({'code': 400, 'message': 'Missing required parameters'}), 400
 
-    comment_url = f"https://api.github.com/repos/{repo_full_name}/issues/{pr_number}/comments"
-    headers = {
-        'Authorization': f'token {token}',
-        'Accept': 'application/vnd.github.v3+json'
-    }
     data = {
         'body': comment_body
     }
-    response = requests.post(comment_url, headers=headers, json=data)
+    response = github.post(f"repos/{repo_full_name}/issues/{pr_number}/comments", json=data)
 
     if response.status_code != 201:
         return jsonify({'code': response.status_code, 'message': 'Failed to create comment'}), response.status_code
@@ -0,0 +1,198 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from common import metrics
+
+logger = logging.getLogger(__name__)
+
+request_seconds = metrics.histogram(
+    "github_api_request_seconds", "Latency of GitHub API calls, retries counted separately.", ("resource", "status"))
+
+
+class GitHubClient:
+    """Shared GitHub REST client for all gh_interacter endpoints.
+
+    - One keep-alive `requests.Session` with a connection pool of `pool_size`.
+    - Token auth when `token` is set, which raises the quota from 60 to 5000
+      requests per hour.
+    - Conditional GETs: responses are remembered with their ETag and sent
+      back with If-None-Match. A 304 does not count against the quota and is
+      answered from the cache.
+    - The X-RateLimit-* headers drive throttling: once fewer than
+      `min_remaining` requests are left, requests are spread over the time
+      until the window resets. Rate-limited and 5xx responses are retried
+      with backoff.
+    """
+
+    def __init__(self, token=None, base_url="https://api.github.com", pool_size=10, timeout=30,
+                 etag_cache_entries=1000, etag_cache_max_body_bytes=1024 * 1024,
+                 min_remaining=100, max_throttle_seconds=10, max_retries=3, max_retry_wait=60):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.etag_cache_entries = etag_cache_entries
+        self.etag_cache_max_body_bytes = etag_cache_max_body_bytes
+        self.min_remaining = min_remaining
+        self.max_throttle_seconds = max_throttle_seconds
+        self.max_retries = max_retries
+        self.max_retry_wait = max_retry_wait
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/vnd.github+json",
+            "User-Agent": "code-chat-helper",
+        })
+        if token:
+            self.session.headers["Authorization"] = f"token {token}"
+
+        self._etags = OrderedDict()
+        self._rate = {}
+        self._lock = threading.Lock()
+        self.not_modified = 0
+
+    def url(self, path):
+        return path if path.startswith("http") else f"{self.base_url}/{path.lstrip('/')}"
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def graphql(self, query, variables=None):
+        """Run a GraphQL query and return `(data, errors)`."""
+        try:
+            response = self.post("graphql", json={"query": query, "variables": variables or {}})
+        except requests.RequestException as e:
+            raise RuntimeError(f"GitHub GraphQL request failed: {e}")
+        if response.status_code != 200:
+            raise RuntimeError(f"GitHub GraphQL API returned {response.status_code}")
+        body = response.json()
+        return body.get("data") or {}, body.get("errors") or []
+
+    def request(self, method, path, headers=None, params=None, stream=False, **kwargs):
+        url = self.url(path)
+        # REST 和 GraphQL 的配额分开计算
+        resource = "graphql" if url.endswith("/graphql") else "core"
+        headers = dict(headers or {})
+        # 流式响应的内容不会被读取，不做条件请求缓存
+        cache_key = None
+        if method == "GET" and not stream:
+            cache_key = (url, tuple(sorted((params or {}).items())), headers.get("Accept"))
+            with self._lock:
+                cached = self._etags.get(cache_key)
+            if cached is not None:
+                headers["If-None-Match"] = cached["etag"]
+
+        attempt = 0
+        while True:
+            self._throttle(resource)
+            start = time.perf_counter()
+            response = self.session.request(
+                method, url, headers=headers, params=params, stream=stream,
+                timeout=kwargs.pop("timeout", self.timeout), **kwargs
+            )
+            request_seconds.observe(time.perf_counter() - start, resource=resource, status=response.status_code)
+            self._record_rate_limit(response)
+            wait = self._retry_wait(response, attempt)
+            if wait is None:
+                break
+            attempt += 1
+            logger.warning(f"GitHub {method} {url} returned {response.status_code}, retrying in {wait:.1f}s")
+            response.close()
+            time.sleep(wait)
+
+        if cache_key is not None:
+            if response.status_code == 304 and cached is not None:
+                with self._lock:
+                    self._etags.move_to_end(cache_key)
+                    self.not_modified += 1
+                return self._cached_response(url, cached)
+            etag = response.headers.get("ETag")
+            if response.status_code == 200 and etag and len(response.content) <= self.etag_cache_max_body_bytes:
+                with self._lock:
+                    self._etags[cache_key] = {
+                        "etag": etag,
+                        "content": response.content,
+                        "headers": dict(response.headers),
+                        "encoding": response.encoding,
+                    }
+                    self._etags.move_to_end(cache_key)
+                    while len(self._etags) > self.etag_cache_entries:
+                        self._etags.popitem(last=False)
+        return response
+
+    def _cached_response(self, url, cached):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = cached["content"]
+        response.headers = CaseInsensitiveDict(cached["headers"])
+        response.encoding = cached["encoding"]
+        return response
+
+    def _record_rate_limit(self, response):
+        if "X-RateLimit-Remaining" not in response.headers:
+            return
+        resource = response.headers.get("X-RateLimit-Resource", "core")
+        with self._lock:
+            self._rate[resource] = {
+                "limit": int(response.headers.get("X-RateLimit-Limit", 0)),
+                "remaining": int(response.headers["X-RateLimit-Remaining"]),
+                "reset": int(response.headers.get("X-RateLimit-Reset", 0)),
+            }
+
+    def _throttle(self, resource):
+        # 剩余配额较少时，把剩余请求均匀分布到配额重置之前
+        with self._lock:
+            rate = self._rate.get(resource)
+        if not rate or rate["remaining"] >= self.min_remaining:
+            return
+        until_reset = rate["reset"] - time.time()
+        if until_reset <= 0:
+            return
+        delay = min(until_reset / max(rate["remaining"], 1), self.max_throttle_seconds)
+        logger.info(f"GitHub {resource} quota low ({rate['remaining']} left), throttling for {delay:.1f}s")
+        time.sleep(delay)
+
+    def _retry_wait(self, response, attempt):
+        # 返回重试前需要等待的秒数，不需要重试时返回None
+        if attempt >= self.max_retries:
+            return None
+        status = response.status_code
+        if status in (403, 429):
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None:
+                return min(float(retry_after), self.max_retry_wait)
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                reset = int(response.headers.get("X-RateLimit-Reset", 0))
+                return min(max(reset - time.time(), 1), self.max_retry_wait)
+            return None
+        if status >= 500 and response.request.method == "GET":
+            return min(2 ** attempt + random.random(), self.max_retry_wait)
+        return None
+
+    def quota(self):
+        with self._lock:
+            rates = {resource: dict(rate) for resource, rate in self._rate.items()}
+            cached_entries = len(self._etags)
+            not_modified = self.not_modified
+        for rate in rates.values():
+            rate["headroom"] = rate["remaining"] / rate["limit"] if rate["limit"] else None
+            rate["reset_in_seconds"] = max(rate["reset"] - int(time.time()), 0)
+        return {
+            "authenticated": bool(self.token),
+            "rate_limit": rates,
+            "etag_cache_entries": cached_entries,
+            "not_modified_responses": not_modified,
+        }
@@ -0,0 +1,14 @@
+# gunicorn -c gunicorn.conf.py gh_interacter:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+# GitHub 限流时客户端最多等待 60 秒后重试
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "90"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+# 每个 worker 在 fork 之后创建自己的 GitHub 连接池和缓存
+preload_app = False
+accesslog = "-"
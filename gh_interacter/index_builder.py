@@ -0,0 +1,125 @@
+import base64
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common.repo_index import index_file, is_indexed, skipped_entry
+from diff_index import is_excluded
+
+logger = logging.getLogger(__name__)
+
+
+class RepoIndexBuilder:
+    """Keeps the repository index of each default branch up to date.
+
+    An update lists the commit's tree once and only fetches and re-indexes the
+    files whose blob SHA differs from the indexed one, so a push costs one tree
+    request plus one blob request per changed file. Files that cannot be
+    indexed are recorded by blob SHA too, and a truncated tree listing never
+    removes files from the index. A file whose blob cannot be fetched keeps its
+    previous entry and is retried on the next update. Updates run on a single
+    background thread; pushes that arrive while a repository is waiting are
+    coalesced and only the latest commit is indexed.
+    """
+
+    def __init__(self, github, blob_cache, index, patterns, max_files=5000, max_file_bytes=256 * 1024,
+                 fetch_concurrency=4):
+        self.github = github
+        self.blob_cache = blob_cache
+        self.index = index
+        self.patterns = patterns
+        self.max_files = max_files
+        self.max_file_bytes = max_file_bytes
+        self.fetch_concurrency = fetch_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stats = {"updates": 0, "failures": 0, "files_indexed": 0, "files_skipped": 0, "files_removed": 0,
+                       "files_failed": 0, "coalesced": 0, "last_update_seconds": 0.0}
+
+    def schedule(self, repo, sha):
+        with self._lock:
+            queued = repo in self._pending
+            self._pending[repo] = sha
+            if queued:
+                self._stats["coalesced"] += 1
+                return
+        self._executor.submit(self._run, repo)
+
+    def _run(self, repo):
+        with self._lock:
+            sha = self._pending.pop(repo)
+        try:
+            self.update(repo, sha)
+        except Exception as e:
+            with self._lock:
+                self._stats["failures"] += 1
+            logger.error(f"Error while indexing {repo} at {sha}: {e}")
+
+    def _fetch_blob(self, repo, sha):
+        response = self.github.get(f"repos/{repo}/git/blobs/{sha}")
+        if response.status_code != 200:
+            raise RuntimeError(f"GitHub returned {response.status_code} for blob {sha} of {repo}")
+        return base64.b64decode(response.json()["content"]).decode("utf-8")
+
+    def _index_blob(self, repo, path, sha):
+        try:
+            content = self.blob_cache.get_or_fetch(sha, lambda: self._fetch_blob(repo, sha))
+        except UnicodeDecodeError:
+            # 非 UTF-8 文件不建索引，只记录其 blob SHA
+            return skipped_entry(path, sha)
+        except Exception as e:
+            # 单个文件获取失败时保留旧的索引，下次更新时重试
+            logger.error(f"Error while fetching {path} ({sha}) of {repo}: {e}")
+            return None
+        return index_file(path, content, sha)
+
+    def update(self, repo, sha):
+        """Index the tree of commit `sha`, re-indexing only the changed files."""
+        start = time.monotonic()
+        response = self.github.get(f"repos/{repo}/git/trees/{sha}", params={"recursive": "1"})
+        if response.status_code != 200:
+            raise RuntimeError(f"GitHub returned {response.status_code} for the tree of {sha}")
+        tree = response.json()
+        truncated = bool(tree.get("truncated"))
+        if truncated:
+            logger.warning(f"The tree of {repo} at {sha} is truncated, indexing the files listed without removing any")
+
+        wanted = {
+            item["path"]: item["sha"] for item in tree.get("tree", [])
+            if item.get("type") == "blob" and is_indexed(item["path"])
+            and (item.get("size") or 0) <= self.max_file_bytes and not is_excluded(item["path"], self.patterns)
+        }
+        if len(wanted) > self.max_files:
+            logger.warning(f"{repo} has {len(wanted)} indexable files, indexing the first {self.max_files}")
+            wanted = dict(sorted(wanted.items())[:self.max_files])
+
+        indexed = self.index.store.file_blobs(repo)
+        changed = [(path, blob) for path, blob in wanted.items() if indexed.get(path) != blob]
+        # 截断的列表中缺少的文件不一定已被删除
+        removed = [] if truncated else [path for path in indexed if path not in wanted]
+        with ThreadPoolExecutor(max_workers=self.fetch_concurrency) as executor:
+            results = list(executor.map(lambda item: self._index_blob(repo, *item), changed))
+        entries = [entry for entry in results if entry is not None]
+        failed = len(results) - len(entries)
+        skipped = sum(1 for entry in entries if entry.get("skipped"))
+        self.index.update(repo, sha, entries, removed)
+
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._stats["updates"] += 1
+            self._stats["files_indexed"] += len(entries) - skipped
+            self._stats["files_skipped"] += skipped
+            self._stats["files_removed"] += len(removed)
+            self._stats["files_failed"] += failed
+            self._stats["last_update_seconds"] = elapsed
+        logger.info(f"Indexed {repo} at {sha}: {len(entries) - skipped} files updated, {skipped} skipped, "
+                    f"{failed} failed, {len(removed)} removed in {elapsed:.2f}s")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = len(self._pending)
+        stats.update(self.index.store.stats())
+        return stats
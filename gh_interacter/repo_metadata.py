@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RepoMetadataCache:
+    """TTL cache for repository metadata: the default branch and branch heads.
+
+    Branch lookups cache misses too, so a branch that does not exist costs one
+    request per `ttl_seconds` rather than one per call. Push webhooks keep
+    the entries fresh through `update_branch` and `invalidate`. At most
+    `max_entries` entries are kept, evicting the least recently used.
+    """
+
+    def __init__(self, github, ttl_seconds=300, max_entries=10000):
+        self.github = github
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                # 过期的条目直接删除
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def _set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def default_branch(self, repo_full_name):
+        # 仓库不存在时返回None
+        entry = self._get(("default_branch", repo_full_name))
+        if entry is not None:
+            return entry[0]
+        response = self.github.get(f"repos/{repo_full_name}")
+        if response.status_code == 404:
+            branch = None
+        elif response.status_code != 200:
+            raise RuntimeError(f"GitHub returned {response.status_code} for repository {repo_full_name}")
+        else:
+            branch = response.json().get("default_branch")
+        self._set(("default_branch", repo_full_name), branch)
+        return branch
+
+    def branch_sha(self, repo_full_name, branch_name):
+        # 返回分支当前的commit SHA，分支不存在时返回None
+        entry = self._get(("branch", repo_full_name, branch_name))
+        if entry is not None:
+            return entry[0]
+        response = self.github.get(f"repos/{repo_full_name}/branches/{branch_name}")
+        if response.status_code == 404:
+            sha = None
+        elif response.status_code != 200:
+            raise RuntimeError(f"GitHub returned {response.status_code} for branch {branch_name} of {repo_full_name}")
+        else:
+            sha = response.json().get("commit", {}).get("sha")
+        self._set(("branch", repo_full_name, branch_name), sha)
+        return sha
+
+    def branch_exists(self, repo_full_name, branch_name):
+        return self.branch_sha(repo_full_name, branch_name) is not None
+
+    def update_branch(self, repo_full_name, branch_name, sha):
+        # sha 为None表示分支已被删除
+        self._set(("branch", repo_full_name, branch_name), sha)
+
+    def set_default_branch(self, repo_full_name, branch_name):
+        self._set(("default_branch", repo_full_name), branch_name)
+
+    def invalidate(self, repo_full_name):
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == repo_full_name]:
+                del self._entries[key]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
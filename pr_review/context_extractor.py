@@ -0,0 +1,139 @@
+import ast
+import os
+import re
+
+from common.code_blocks import block_end
+from common.diff_model import parse_patch
+
+# hunk 上下文的提取方式：
+# full  允许发送完整文件（预算足够时）
+# hunk  只发送改动所在的函数/类和文件开头的 import
+# auto  文件不超过 REVIEW_FULL_FILE_MAX_LINES 行时允许发送完整文件，否则同 hunk
+CONTEXT_MODES = ("full", "hunk", "auto")
+
+IMPORT_LINE = re.compile(
+    r"^\s*(import\s|from\s+\S+\s+import\s|#include\s|#import\s|using\s|package\s|use\s|require[\s(]"
+    r"|const\s+\w+\s*=\s*require\(|extern\s+crate\s)"
+)
+# 常见语言中函数、类等定义的开头。
+# 类型部分按“不含空白的词 + 空白”重复匹配，词和分隔符的字符集不重叠，避免长空白行上的回溯爆炸
+DEFINITION_LINE = re.compile(
+    r"^\s*((export|public|private|protected|internal|static|abstract|final|async|override|virtual|inline|pub(\(\w+\))?)\s+)*"
+    r"(def|class|function|func|fn|interface|struct|enum|impl|trait|module|object|type|sub|proc)\b"
+    r"|^(?!\s*(if|else|for|while|switch|return|catch|do|case|new|throw|await|yield|try)\b)"
+    r"\s*(?:[\w<>\[\],.*&:]+\s+)+[\w:~]+\s*\([^;]*\)\s*(const\s*)?(\{|$)"
+)
+# 只在文件开头查找 import
+IMPORT_HEADER_SCAN_LINES = 200
+
+
+def context_mode():
+    mode = os.environ.get("REVIEW_CONTEXT_MODE", "auto")
+    return mode if mode in CONTEXT_MODES else "auto"
+
+
+def python_scopes(content):
+    """`(scopes, import_lines)` of a Python file, None when it does not parse.
+
+    Scopes are the `(start, end)` line ranges of every function and class,
+    decorators included.
+    """
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError):
+        return None
+    scopes = []
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+            scopes.append((start, node.end_lineno))
+    imports = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            imports.append((node.lineno, node.end_lineno))
+    return scopes, imports
+
+
+def heuristic_scopes(content):
+    """`(scopes, import_lines)` found with indentation and brace heuristics."""
+    lines = content.split("\n")
+    scopes = []
+    for index, line in enumerate(lines):
+        if line.strip() and DEFINITION_LINE.match(line) and not line.rstrip().endswith(";"):
+            scopes.append((index + 1, block_end(lines, index) + 1))
+    imports = [
+        (index + 1, index + 1)
+        for index, line in enumerate(lines[:IMPORT_HEADER_SCAN_LINES])
+        if IMPORT_LINE.match(line)
+    ]
+    return scopes, imports
+
+
+def _merge(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ContextExtractor:
+    """Picks the code around each hunk that the reviewer needs to see.
+
+    Each changed line is covered by the smallest function or class that
+    encloses it, found with `ast` for Python files and with indentation and
+    brace heuristics for other languages. Lines outside any definition, or
+    whose definition is longer than `max_scope_lines`, get `radius` lines
+    around the hunk instead. The import header of the file is always added.
+    """
+
+    def __init__(self, radius=20, max_scope_lines=200):
+        self.radius = radius
+        self.max_scope_lines = max_scope_lines
+
+    def scopes(self, filename, content):
+        if filename.endswith(".py"):
+            result = python_scopes(content)
+            if result is not None:
+                return result
+        return heuristic_scopes(content)
+
+    def ranges(self, filename, content, patch):
+        """Line ranges of the new file to show, as `(imports, scopes)`."""
+        total_lines = len(content.split("\n"))
+        file_diff = parse_patch(patch, filename)
+        scopes, imports = self.scopes(filename, content)
+        scopes = [scope for scope in scopes if scope[1] - scope[0] < self.max_scope_lines]
+
+        selected = []
+        for hunk in file_diff.hunks:
+            # 纯删除的 hunk 没有新增行，使用其在新文件中的位置
+            changed = list(hunk.added) or [hunk.new_start]
+            for line in changed:
+                enclosing = [scope for scope in scopes if scope[0] <= line <= scope[1]]
+                if enclosing:
+                    selected.append(min(enclosing, key=lambda scope: scope[1] - scope[0]))
+                else:
+                    selected.append(file_diff.context_window(hunk, self.radius, total_lines))
+        selected = [(max(start, 1), min(end, total_lines)) for start, end in selected]
+
+        imports = _merge(imports)
+        if imports:
+            imports = [(imports[0][0], imports[-1][1])] if imports[-1][1] - imports[0][0] < 100 else imports
+        return imports, _merge(selected)
+
+    def extract(self, filename, content, patch):
+        if not content or not patch:
+            return ""
+        lines = content.split("\n")
+        imports, selected = self.ranges(filename, content, patch)
+        # import 已经包含在选中范围内时不再重复
+        imports = [
+            (start, end) for start, end in imports
+            if not any(s <= start and end <= e for s, e in selected)
+        ]
+        sections = [f"Imports (lines {start}-{end}):\n" + "\n".join(lines[start - 1:end]) for start, end in imports]
+        sections += [f"Lines {start}-{end}:\n" + "\n".join(lines[start - 1:end]) for start, end in selected]
+        return "\n".join(sections)
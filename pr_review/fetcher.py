@@ -0,0 +1,107 @@
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def referenced_issue_numbers(body):
+    # 按出现顺序提取 PR 描述中引用的 #N，并去重
+    numbers = []
+    for ref in re.findall(r"#(\d+)", body or ""):
+        if int(ref) not in numbers:
+            numbers.append(int(ref))
+    return numbers
+
+
+def _timed_call(func, *args, **kwargs):
+    start = time.monotonic()
+    result = func(*args, **kwargs)
+    return result, time.monotonic() - start
+
+
+class PRFetcher:
+    """Fetches referenced issues and changed file contents of a PR in parallel.
+
+    All calls go through the same PyGithub instance, whose requests session is
+    shared by the worker threads, so `max_workers` should not exceed the
+    `pool_size` the `Github` client was created with. Results keep the order of
+    the PR body references and of `gh_pr.get_files()`. With a `blob_cache`,
+    file contents are looked up by blob SHA first, so unchanged files are not
+    downloaded again on the next push.
+    """
+
+    def __init__(self, max_workers=8, blob_cache=None):
+        self.max_workers = max_workers
+        self.blob_cache = blob_cache
+
+    def _get_issue(self, gh_repo, number):
+        issue_or_pr = gh_repo.get_issue(number)
+        if issue_or_pr.pull_request is not None:  # This means it's a PR, not an Issue
+            return None
+        return f"Issue #{number}: {issue_or_pr.title}\n{issue_or_pr.body}\n\n"
+
+    def _get_file(self, gh_repo, file, ref):
+        def download():
+            return gh_repo.get_contents(file.filename, ref=ref).decoded_content.decode()
+
+        if file.status == "removed":
+            # 被删除的文件在 head 上已经不存在
+            full_content = ""
+        elif self.blob_cache is not None and file.sha:
+            full_content = self.blob_cache.get_or_fetch(file.sha, download)
+        else:
+            full_content = download()
+        return {
+            "filename": file.filename,
+            "patch": file.patch,
+            "full_content": full_content,
+        }
+
+    def fetch(self, gh_repo, gh_pr, files=None):
+        """Return `(issues_description, code_changes, timings)` for the PR.
+
+        `files` restricts the contents to a subset of changed files, such as the
+        files of a compare between two commits; by default all PR files are used.
+        `timings` maps each stage to its wall-clock seconds. The `*_sequential`
+        entries sum the individual call durations, i.e. roughly what the stage
+        would have cost when fetched one call after another.
+        """
+        timings = {}
+        start = time.monotonic()
+
+        if files is None:
+            files, timings["list_files"] = _timed_call(list, gh_pr.get_files())
+        else:
+            timings["list_files"] = 0.0
+        numbers = referenced_issue_numbers(gh_pr.body)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            issue_futures = [
+                executor.submit(_timed_call, self._get_issue, gh_repo, number)
+                for number in numbers
+            ]
+            file_futures = [
+                executor.submit(_timed_call, self._get_file, gh_repo, file, gh_pr.head.sha)
+                for file in files
+            ]
+            issue_results = [future.result() for future in issue_futures]
+            file_results = [future.result() for future in file_futures]
+
+        timings["fetch"] = time.monotonic() - start - timings["list_files"]
+        timings["issues_sequential"] = sum(elapsed for _, elapsed in issue_results)
+        timings["files_sequential"] = sum(elapsed for _, elapsed in file_results)
+        timings["total"] = time.monotonic() - start
+
+        issues_description = "".join(result for result, _ in issue_results if result is not None)
+        code_changes = [result for result, _ in file_results]
+
+        sequential = timings["list_files"] + timings["issues_sequential"] + timings["files_sequential"]
+        logger.info(
+            f"Fetched {len(files)} files and {len(numbers)} referenced issues in {timings['total']:.2f}s "
+            f"(sequential estimate {sequential:.2f}s, saved {sequential - timings['total']:.2f}s)"
+        )
+        if self.blob_cache is not None:
+            logger.info(f"Blob cache stats: {self.blob_cache.stats()}")
+        return issues_description, code_changes, timings
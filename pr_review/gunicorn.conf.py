@@ -0,0 +1,27 @@
+# gunicorn -c gunicorn.conf.py pr_review:app
+import os
+import sys
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+# webhook 请求只负责验证签名和入队，review 在后台线程中执行，不受该超时限制
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "60"))
+keepalive = 5
+# 不预加载应用：MongoClient、Github 客户端和后台线程都由每个 worker 在 fork 之后自己创建
+preload_app = False
+accesslog = "-"
+
+
+def post_worker_init(worker):
+    import pr_review
+    pr_review.start_background_workers()
+
+
+def worker_exit(server, worker):
+    # worker 启动失败时应用模块可能没有加载
+    module = sys.modules.get("pr_review")
+    if module is not None:
+        module.stop_background_workers(timeout=max(graceful_timeout - 5, 1))
@@ -0,0 +1,87 @@
+import threading
+import time
+from datetime import datetime
+
+from pymongo.errors import DuplicateKeyError
+
+
+class IdempotencyStore:
+    """Maps webhook idempotency keys to the event that handles them.
+
+    Keys live in MongoDB and expire through a TTL index after `ttl_seconds`.
+    The same collection remembers the latest event of every PR, so that a
+    burst of pushes only reviews the newest head.
+    """
+
+    def __init__(self, collection, ttl_seconds=86400):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+
+    def ensure_indexes(self):
+        self.collection.create_index("created_at", expireAfterSeconds=self.ttl_seconds)
+
+    def claim(self, key, event_id):
+        # 返回已经处理该key的事件ID；返回None表示由当前事件处理
+        try:
+            self.collection.insert_one({"_id": key, "event_id": event_id, "created_at": datetime.utcnow()})
+            return None
+        except DuplicateKeyError:
+            doc = self.collection.find_one({"_id": key})
+            if doc is None:
+                # 在两次调用之间过期了
+                return self.claim(key, event_id)
+            return doc["event_id"]
+
+    def release(self, key):
+        self.collection.delete_one({"_id": key})
+
+    def set_latest(self, pr_key, event_id):
+        self.collection.update_one(
+            {"_id": f"latest:{pr_key}"},
+            {"$set": {"event_id": event_id, "created_at": datetime.utcnow()}},
+            upsert=True,
+        )
+
+    def latest(self, pr_key):
+        doc = self.collection.find_one({"_id": f"latest:{pr_key}"})
+        return doc["event_id"] if doc else None
+
+
+class LocalIdempotencyStore:
+    """In-process `IdempotencyStore` for tests and local runs."""
+
+    def __init__(self, ttl_seconds=86400):
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        pass
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] < time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    def claim(self, key, event_id):
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                return entry[0]
+            self._entries[key] = (event_id, time.monotonic() + self.ttl_seconds)
+            return None
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def set_latest(self, pr_key, event_id):
+        with self._lock:
+            self._entries[f"latest:{pr_key}"] = (event_id, time.monotonic() + self.ttl_seconds)
+
+    def latest(self, pr_key):
+        with self._lock:
+            entry = self._get(f"latest:{pr_key}")
+            return entry[0] if entry else None
@@ -0,0 +1,383 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_DEAD = "dead"
+
+
+def retry_delay(attempts, base, maximum):
+    # 指数退避，并加入少量抖动，避免多个失败任务同时重试
+    delay = min(maximum, base * (2 ** max(attempts - 1, 0)))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def job_summary(job):
+    # 调度所需的字段，不包含完整的webhook payload
+    pr = job["payload"].get("pull_request", {})
+    return {
+        "_id": job["_id"],
+        "attempts": job.get("attempts", 0),
+        "next_run_at": job["next_run_at"],
+        "changed_files": pr.get("changed_files"),
+        "additions": pr.get("additions"),
+        "deletions": pr.get("deletions"),
+    }
+
+
+def describe_job(job):
+    # 转换为可以直接通过 /jobs/<event_id> 返回的格式（不包含webhook payload）
+    def fmt(value):
+        return value.isoformat() + "Z" if isinstance(value, datetime) else value
+
+    return {
+        "event_id": job["_id"],
+        "status": job["status"],
+        "attempts": job.get("attempts", 0),
+        "last_error": job.get("last_error"),
+        "result": job.get("result"),
+        "created_at": fmt(job.get("created_at")),
+        "updated_at": fmt(job.get("updated_at")),
+        "next_run_at": fmt(job.get("next_run_at")),
+    }
+
+
+class MongoJobQueue:
+    """Durable review job queue stored in the `pr_review` MongoDB database.
+
+    Jobs are claimed atomically with `find_one_and_update`, so several worker
+    threads (or several processes) can share the same collection. A job whose
+    worker dies keeps its lease only until `lease_seconds` have passed; it is
+    then retried, or dead-lettered once it has used `max_attempts`, so a PR
+    that crashes its worker is not retried forever. `complete` and `fail` only
+    apply to the attempt that was claimed, so a worker whose lease expired
+    cannot overwrite the outcome of the attempt that took over the job.
+    """
+
+    def __init__(self, collection, max_attempts=3, backoff_base=30, backoff_max=600, lease_seconds=900):
+        self.collection = collection
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+
+    def ensure_indexes(self):
+        self.collection.create_index([("status", 1), ("next_run_at", 1)])
+
+    def enqueue(self, job_id, payload, delay=0):
+        # delay 秒之后任务才能被领取
+        now = datetime.utcnow()
+        try:
+            self.collection.insert_one({
+                "_id": job_id,
+                "payload": payload,
+                "status": JOB_QUEUED,
+                "attempts": 0,
+                "last_error": None,
+                "result": None,
+                "created_at": now,
+                "updated_at": now,
+                "next_run_at": now + timedelta(seconds=delay),
+            })
+        except DuplicateKeyError:
+            # 同一个事件已经在队列中
+            return False
+        return True
+
+    def _ready_filter(self, now):
+        return {"$or": [
+            {"status": JOB_QUEUED, "next_run_at": {"$lte": now}},
+            {"status": JOB_RUNNING, "lease_expires_at": {"$lte": now}, "attempts": {"$lt": self.max_attempts}},
+        ]}
+
+    def _dead_letter_expired(self, now):
+        # 租约过期且重试次数已用完的任务（例如worker在处理时崩溃）不再重新领取
+        result = self.collection.update_many(
+            {"status": JOB_RUNNING, "lease_expires_at": {"$lte": now}, "attempts": {"$gte": self.max_attempts}},
+            {"$set": {"status": JOB_DEAD, "last_error": "Lease expired on the last attempt", "updated_at": now},
+             "$unset": {"lease_expires_at": ""}},
+        )
+        if result.modified_count:
+            logger.error(f"Dead-lettered {result.modified_count} review jobs whose lease expired on the last attempt")
+
+    def ready(self, per_repo=50):
+        """Return the jobs that can be claimed now, grouped by repository.
+
+        Each group is `{"repo", "count", "jobs"}` with the `per_repo` oldest
+        jobs as `job_summary` dicts, so that a repository with a large backlog
+        does not hide the jobs of the others.
+        """
+        pr = "$payload.pull_request"
+        now = datetime.utcnow()
+        self._dead_letter_expired(now)
+        return list(self.collection.aggregate([
+            {"$match": self._ready_filter(now)},
+            {"$sort": {"next_run_at": 1}},
+            {"$group": {
+                "_id": "$payload.repository.full_name",
+                "count": {"$sum": 1},
+                "jobs": {"$push": {
+                    "_id": "$_id",
+                    "attempts": "$attempts",
+                    "next_run_at": "$next_run_at",
+                    "changed_files": f"{pr}.changed_files",
+                    "additions": f"{pr}.additions",
+                    "deletions": f"{pr}.deletions",
+                }},
+            }},
+            {"$project": {"_id": 0, "repo": "$_id", "count": 1, "jobs": {"$slice": ["$jobs", per_repo]}}},
+        ]))
+
+    def claim(self, job_id=None):
+        # job_id 为None时领取最早可以执行的任务，否则只在该任务仍可领取时领取它
+        now = datetime.utcnow()
+        if job_id is None:
+            self._dead_letter_expired(now)
+        query = self._ready_filter(now)
+        if job_id is not None:
+            query["_id"] = job_id
+        return self.collection.find_one_and_update(
+            query,
+            {
+                "$set": {
+                    "status": JOB_RUNNING,
+                    "updated_at": now,
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("next_run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @staticmethod
+    def _lease_filter(job):
+        # 只更新仍由这次领取持有的任务；租约过期后被再次领取时 attempts 已经增加
+        return {"_id": job["_id"], "status": JOB_RUNNING, "attempts": job.get("attempts", 0)}
+
+    def complete(self, job, result):
+        """Mark the claimed `job` done; returns False when its lease was lost."""
+        updated = self.collection.update_one(
+            self._lease_filter(job),
+            {"$set": {"status": JOB_DONE, "result": result, "updated_at": datetime.utcnow()},
+             "$unset": {"lease_expires_at": ""}},
+        )
+        return updated.matched_count > 0
+
+    def fail(self, job, error):
+        """Retry or dead-letter the claimed `job`; returns the new status, or None when its lease was lost."""
+        now = datetime.utcnow()
+        update = {"last_error": error, "updated_at": now}
+        if job.get("attempts", 0) >= self.max_attempts:
+            update["status"] = JOB_DEAD
+        else:
+            update["status"] = JOB_QUEUED
+            delay = retry_delay(job.get("attempts", 0), self.backoff_base, self.backoff_max)
+            update["next_run_at"] = now + timedelta(seconds=delay)
+        updated = self.collection.update_one(
+            self._lease_filter(job),
+            {"$set": update, "$unset": {"lease_expires_at": ""}},
+        )
+        return update["status"] if updated.matched_count else None
+
+    def get(self, job_id):
+        return self.collection.find_one({"_id": job_id}, {"payload": 0})
+
+
+class LocalJobQueue:
+    """In-process job queue with the same interface as `MongoJobQueue`.
+
+    Nothing survives a restart, so it is only meant for tests and local runs.
+    """
+
+    def __init__(self, max_attempts=3, backoff_base=30, backoff_max=600, lease_seconds=900):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        pass
+
+    def enqueue(self, job_id, payload, delay=0):
+        now = datetime.utcnow()
+        with self._lock:
+            if job_id in self._jobs:
+                return False
+            self._jobs[job_id] = {
+                "_id": job_id,
+                "payload": payload,
+                "status": JOB_QUEUED,
+                "attempts": 0,
+                "last_error": None,
+                "result": None,
+                "created_at": now,
+                "updated_at": now,
+                "next_run_at": now + timedelta(seconds=delay),
+            }
+        return True
+
+    def _ready(self, now):
+        # 调用方持有锁；租约过期且重试次数已用完的任务转为 dead
+        ready = []
+        for job in self._jobs.values():
+            if job["status"] == JOB_QUEUED and job["next_run_at"] <= now:
+                ready.append(job)
+            elif job["status"] == JOB_RUNNING and job["lease_expires_at"] <= now:
+                if job["attempts"] < self.max_attempts:
+                    ready.append(job)
+                    continue
+                job.update(status=JOB_DEAD, last_error="Lease expired on the last attempt", updated_at=now)
+                job.pop("lease_expires_at", None)
+                logger.error(f"Review job {job['_id']} dead-lettered, its lease expired on the last attempt")
+        return ready
+
+    def ready(self, per_repo=50):
+        with self._lock:
+            ready = sorted(self._ready(datetime.utcnow()), key=lambda j: j["next_run_at"])
+            groups = {}
+            for job in ready:
+                repo = job["payload"].get("repository", {}).get("full_name")
+                group = groups.setdefault(repo, {"repo": repo, "count": 0, "jobs": []})
+                group["count"] += 1
+                if len(group["jobs"]) < per_repo:
+                    group["jobs"].append(job_summary(job))
+            return list(groups.values())
+
+    def claim(self, job_id=None):
+        now = datetime.utcnow()
+        with self._lock:
+            ready = [job for job in self._ready(now) if job_id is None or job["_id"] == job_id]
+            if not ready:
+                return None
+            job = min(ready, key=lambda j: j["next_run_at"])
+            job["status"] = JOB_RUNNING
+            job["updated_at"] = now
+            job["lease_expires_at"] = now + timedelta(seconds=self.lease_seconds)
+            job["attempts"] += 1
+            return dict(job)
+
+    def _leased(self, job):
+        # 调用方持有锁；与 MongoJobQueue 相同，只更新仍由这次领取持有的任务
+        stored = self._jobs.get(job["_id"])
+        if stored is None or stored["status"] != JOB_RUNNING or stored["attempts"] != job.get("attempts", 0):
+            return None
+        return stored
+
+    def complete(self, job, result):
+        with self._lock:
+            stored = self._leased(job)
+            if stored is None:
+                return False
+            stored.update(status=JOB_DONE, result=result, updated_at=datetime.utcnow())
+            stored.pop("lease_expires_at", None)
+            return True
+
+    def fail(self, job, error):
+        now = datetime.utcnow()
+        with self._lock:
+            stored = self._leased(job)
+            if stored is None:
+                return None
+            stored.update(last_error=error, updated_at=now)
+            stored.pop("lease_expires_at", None)
+            if stored["attempts"] >= self.max_attempts:
+                stored["status"] = JOB_DEAD
+            else:
+                stored["status"] = JOB_QUEUED
+                delay = retry_delay(stored["attempts"], self.backoff_base, self.backoff_max)
+                stored["next_run_at"] = now + timedelta(seconds=delay)
+            return stored["status"]
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {k: v for k, v in job.items() if k != "payload"}
+
+
+class ReviewWorkerPool:
+    """A pool of daemon threads that take jobs from a queue and run `handler(job)`.
+
+    The handler returns a result stored on the job; an exception marks the
+    attempt as failed, and the queue decides whether to retry or dead-letter it.
+    With a `scheduler` (see `scheduler.ReviewScheduler`) the scheduler chooses
+    which ready job to claim instead of the queue's arrival order.
+    """
+
+    def __init__(self, queue, handler, num_workers=2, poll_interval=1.0, scheduler=None):
+        self.queue = queue
+        self.handler = handler
+        self.scheduler = scheduler
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        self._stop.clear()
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._run, name=f"review-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.num_workers} review workers")
+
+    def stop(self, timeout=None):
+        # 等待正在处理的任务结束后再退出
+        self._stop.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            thread.join(remaining)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim() if self.scheduler is None else self.scheduler.claim(self.queue)
+            except Exception as e:
+                logger.error(f"Error while claiming a review job: {e}")
+                job = None
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+
+            try:
+                self._process(job)
+            finally:
+                if self.scheduler is not None:
+                    self.scheduler.finish(job)
+
+    def _process(self, job):
+        try:
+            result = self.handler(job)
+        except Exception as e:
+            try:
+                status = self.queue.fail(job, str(e))
+                if status is None:
+                    logger.error(f"Review job {job['_id']} failed on attempt {job['attempts']} after losing its lease: {e}")
+                else:
+                    logger.error(f"Review job {job['_id']} failed on attempt {job['attempts']}, now {status}: {e}")
+            except Exception as queue_error:
+                logger.error(f"Error while recording failure of review job {job['_id']}: {queue_error}")
+            return
+
+        try:
+            if not self.queue.complete(job, result):
+                logger.warning(f"Review job {job['_id']} finished attempt {job['attempts']} after losing its lease, "
+                               f"result not recorded")
+        except Exception as e:
+            logger.error(f"Error while completing review job {job['_id']}: {e}")
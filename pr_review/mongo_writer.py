@@ -0,0 +1,164 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+def write_concern_from_env():
+    # MONGO_WRITE_CONCERN_W 可以是数字或 "majority"，未设置时使用服务器默认值
+    w = os.environ.get("MONGO_WRITE_CONCERN_W")
+    options = {}
+    if w:
+        options["w"] = int(w) if w.isdigit() else w
+    if os.environ.get("MONGO_WRITE_CONCERN_J"):
+        options["j"] = os.environ["MONGO_WRITE_CONCERN_J"].lower() in ("1", "true", "yes")
+    if os.environ.get("MONGO_WRITE_TIMEOUT_MS"):
+        options["wtimeout"] = int(os.environ["MONGO_WRITE_TIMEOUT_MS"])
+    return WriteConcern(**options) if options else None
+
+
+class MongoWriter:
+    """Writes to MongoDB from a background thread so that callers never wait on it.
+
+    `submit` puts a write operation (`InsertOne`, `UpdateOne`, ...) on a
+    bounded queue and returns immediately. The thread takes up to
+    `batch_size` operations at a time and sends each run of consecutive
+    operations on the same collection as one ordered `bulk_write`, so all
+    operations are applied in the order they were submitted, also across
+    collections (content is written before the references to it). When the
+    queue is full or MongoDB keeps failing, operations are logged and dropped
+    instead of failing the caller.
+    """
+
+    def __init__(self, max_queue=10000, batch_size=100, flush_interval=0.2,
+                 write_concern=None, max_retries=2, retry_delay=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_concern = write_concern
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._collections = {}
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def submit(self, collection, *operations):
+        """Queue operations on `collection`; returns False when they were dropped."""
+        for index, operation in enumerate(operations):
+            try:
+                self._queue.put_nowait((collection, operation))
+            except queue.Full:
+                dropped = len(operations) - index
+                self._count("dropped", dropped)
+                logger.error(f"MongoDB write queue is full, dropping {dropped} operations on {collection.name}")
+                return False
+            self._count("submitted")
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="mongo-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        # 写完队列中剩余的操作后退出
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(f"MongoDB writer did not finish in time, {self._queue.qsize()} operations not written")
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        return stats
+
+    def _take_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self.flush(batch)
+            elif self._stop.is_set():
+                return
+
+    def _target(self, collection):
+        if self.write_concern is None:
+            return collection
+        key = collection.full_name
+        if key not in self._collections:
+            self._collections[key] = collection.with_options(write_concern=self.write_concern)
+        return self._collections[key]
+
+    def flush(self, batch):
+        # 同一集合的连续操作合并为一次写入，不同集合之间也保持提交顺序
+        runs = []
+        for collection, operation in batch:
+            if runs and runs[-1][0].full_name == collection.full_name:
+                runs[-1][1].append(operation)
+            else:
+                runs.append((collection, [operation]))
+        for collection, operations in runs:
+            self._write(collection, operations)
+
+    def _write(self, collection, operations):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._target(collection).bulk_write(operations, ordered=True)
+                self._count("written", len(operations))
+                self._count("batches")
+                return
+            except BulkWriteError as e:
+                # 写入错误（例如违反唯一索引）重试也不会成功；有序写入在第一个错误处停止
+                errors = (e.details or {}).get("writeErrors") or [{"index": 0}]
+                written = errors[0].get("index", 0)
+                self._count("written", written)
+                self._count("failed", len(operations) - written)
+                logger.error(f"Error while writing {len(operations)} operations to {collection.name}, "
+                             f"{len(operations) - written} not written: {e}")
+                return
+            except Exception as e:
+                if attempt < self.max_retries and not self._stop.is_set():
+                    logger.error(f"Error while writing {len(operations)} operations to {collection.name}, retrying: {e}")
+                    time.sleep(self.retry_delay * (2 ** attempt))
+                    continue
+                self._count("failed", len(operations))
+                logger.error(f"Error while writing {len(operations)} operations to {collection.name}, dropping them: {e}")
+                return
+
+
+def mongo_writer_from_env():
+    return MongoWriter(
+        max_queue=int(os.environ.get("MONGO_WRITER_MAX_QUEUE", "10000")),
+        batch_size=int(os.environ.get("MONGO_WRITER_BATCH_SIZE", "100")),
+        flush_interval=float(os.environ.get("MONGO_WRITER_FLUSH_SECONDS", "0.2")),
+        write_concern=write_concern_from_env(),
+    )
@@ -5,18 +5,43 @@ import openai
 import logging
 import json
 import uuid
-import re
 import json
+import threading
+import atexit
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify, url_for
 from github import Github
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from common.blob_cache import blob_cache_from_env
+from common import metrics
+from common.content_store import content_store_from_env
+from common.llm_gateway import llm_gateway_from_env
+from common.repo_index import repo_index_from_env
+from fetcher import PRFetcher
+from idempotency import IdempotencyStore, LocalIdempotencyStore
+from mongo_writer import mongo_writer_from_env
+from job_queue import MongoJobQueue, LocalJobQueue, ReviewWorkerPool, describe_job, JOB_DEAD
+from context_extractor import context_mode
+from prompt_builder import PromptBuilder
+from review_format import PROMPT_VERSION, BILINGUAL_INSTRUCTION, output_mode_for, split_bilingual, translate_review, format_comment
+from review_state import ReviewStateStore
+from scheduler import TokenLedger, LocalTokenLedger, review_scheduler_from_env
 
 app = Flask(__name__)
+# webhook 的投递ID同时作为 trace ID
+metrics.instrument_app(app, "pr_review", trace_headers=("X-GitHub-Delivery", "X-Trace-Id"))
 
 client = MongoClient('mongodb', 27017)
 db = client['pr_review']
 collection = db['review_comments_and_conversations']
+# 对话中较大的消息（例如PR提示）单独按内容哈希存储
+content_store = content_store_from_env(db)
+# 对话的写入由后台线程批量完成，不阻塞review；MongoDB不可用时只记录日志
+mongo_writer = mongo_writer_from_env()
+metrics.expose_stats("mongo_writer", "Background MongoDB writer statistics.", mongo_writer.stats)
 
 # Custom JSON formatter
 class JsonFormatter(logging.Formatter): 
@@ -32,23 +57,118 @@ class JsonFormatter(logging.Formatter):
         }
         return json.dumps(log_entry)
 
+# 当前线程正在处理的事件信息，webhook请求线程和后台review线程各自独立
+log_context = threading.local()
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record):
+        # 将当前线程的事件ID、仓库名和PR号码附加到日志记录中
+        for key in ("event_id", "repo", "pr"):
+            if not hasattr(record, key) and hasattr(log_context, key):
+                setattr(record, key, getattr(log_context, key))
+        return True
+
+@contextmanager
+def bind_log_context(**fields):
+    saved = dict(log_context.__dict__)
+    log_context.__dict__.update(fields)
+    try:
+        yield
+    finally:
+        log_context.__dict__.clear()
+        log_context.__dict__.update(saved)
+
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logHandler = logging.StreamHandler()
 formatter = JsonFormatter()
 logHandler.setFormatter(formatter)
+logHandler.addFilter(LogContextFilter())
 logger.addHandler(logHandler)
 
-# Set up OpenAI API client
+# Set up OpenAI API client. All calls go through the gateway, which limits concurrency and retries transient errors.
 openai.api_key = os.environ.get("OPENAI_API_KEY")
-
-# Set up GitHub API client
-gh = Github(os.environ.get("GITHUB_TOKEN"))
+llm = llm_gateway_from_env()
+
+# Set up GitHub API client. The connection pool is shared by the fetch threads.
+github_fetch_concurrency = int(os.environ.get("GITHUB_FETCH_CONCURRENCY", "8"))
+gh = Github(
+    os.environ.get("GITHUB_TOKEN"),
+    base_url=os.environ.get("GITHUB_API_URL", "https://api.github.com"),
+    per_page=100,
+    pool_size=github_fetch_concurrency,
+    seconds_between_requests=float(os.environ.get("GITHUB_SECONDS_BETWEEN_REQUESTS", "0")),
+    # PyGithub 默认两次写操作（如发布评论）之间间隔1秒，该间隔在所有review线程之间共享
+    seconds_between_writes=float(os.environ.get("GITHUB_SECONDS_BETWEEN_WRITES", "1")),
+)
+pr_fetcher = PRFetcher(max_workers=github_fetch_concurrency, blob_cache=blob_cache_from_env(db))
+github_fetch_seconds = metrics.histogram("github_fetch_step_seconds", "Wall-clock time of each step of fetching a PR.", ("step",))
+metrics.expose_stats("blob_cache", "Blob cache statistics of the PR fetcher.", pr_fetcher.blob_cache.stats)
 
 # Set up webhook secret
 webhook_secret = os.environ.get("WEBHOOK_SECRET")
 
+# Set up the review job queue. "local" keeps jobs in memory and is meant for tests.
+job_queue_options = {
+    "max_attempts": int(os.environ.get("REVIEW_JOB_MAX_ATTEMPTS", "3")),
+    "backoff_base": float(os.environ.get("REVIEW_JOB_BACKOFF_SECONDS", "30")),
+    "backoff_max": float(os.environ.get("REVIEW_JOB_BACKOFF_MAX_SECONDS", "600")),
+    "lease_seconds": float(os.environ.get("REVIEW_JOB_LEASE_SECONDS", "900")),
+}
+# Redelivered webhooks and repeated reviews of the same head are deduplicated for REVIEW_IDEMPOTENCY_TTL_SECONDS
+idempotency_ttl = int(os.environ.get("REVIEW_IDEMPOTENCY_TTL_SECONDS", "86400"))
+# Per-repo OpenAI token budgets apply to windows of REVIEW_TOKEN_BUDGET_WINDOW_SECONDS
+token_budget_window = int(os.environ.get("REVIEW_TOKEN_BUDGET_WINDOW_SECONDS", "3600"))
+if os.environ.get("REVIEW_QUEUE_BACKEND", "mongo") == "local":
+    job_queue = LocalJobQueue(**job_queue_options)
+    idempotency = LocalIdempotencyStore(idempotency_ttl)
+    token_ledger = LocalTokenLedger(token_budget_window)
+else:
+    job_queue = MongoJobQueue(db['review_jobs'], **job_queue_options)
+    idempotency = IdempotencyStore(db['review_idempotency'], idempotency_ttl)
+    token_ledger = TokenLedger(db['review_token_usage'], token_budget_window)
+# 按仓库加权公平地调度review任务，仓库内小的PR优先
+review_scheduler = review_scheduler_from_env(token_ledger)
+llm.add_usage_listener(review_scheduler.record_usage)
+# synchronize 事件延迟执行，期间同一个PR的后续推送会取代之前的事件
+review_debounce_seconds = float(os.environ.get("REVIEW_DEBOUNCE_SECONDS", "30"))
+
+# Review prompt assembly. Changes over the model's token budget are reviewed in chunks.
+REVIEW_MODEL = os.environ.get("REVIEW_MODEL", "gpt-4-1106-preview")
+prompt_builder = PromptBuilder(
+    REVIEW_MODEL,
+    context_lines=int(os.environ.get("PROMPT_CONTEXT_LINES", "20")),
+    context_mode=context_mode(),
+    full_file_max_lines=int(os.environ.get("REVIEW_FULL_FILE_MAX_LINES", "300")),
+    related_code_tokens=int(os.environ.get("REVIEW_RELATED_CODE_TOKENS", "3000")),
+)
+# gh_interacter 维护的默认分支符号索引，用于在提示词中加入调用方和被调用的定义
+repo_index = repo_index_from_env(db)
+review_related_code_snippets = int(os.environ.get("REVIEW_RELATED_CODE_SNIPPETS", "8"))
+review_chunk_concurrency = int(os.environ.get("REVIEW_CHUNK_CONCURRENCY", "4"))
+# 翻译与保存结果、准备评论等步骤并行执行
+translation_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("REVIEW_WORKERS", "2")))
+
+REVIEW_SYSTEM_PROMPT = """
+As an AI assistant with expertise in programming, your primary task is to review the pull request provided by the user.
+
+When generating your review, adhere to the following template:
+**[Changes]**: Summarize the main changes made in the pull request in less than 50 words.
+**[Suggestions]**: Provide any suggestions or improvements for the code. Focus on code quality, logic, potential bugs and performance problems. Refrain from mentioning document-related suggestions such as "I suggest adding some comments", etc.
+**[Clarifications]**: (Optional) If there are parts of the pull request that are unclear or lack sufficient context, ask for clarification here. If not, this section can be omitted.
+**[Conclusion]**: Conclude the review with an overall assessment.
+**[Other]**: (Optional) If there are additional observations or notes, mention them here. If not, this section can be omitted.
+
+The user may also engage in further discussions about the review. It is not necessary to use the template when discussing with the user.
+"""
+
+# Last reviewed head per PR, used to review only the new commits on synchronize
+review_states = ReviewStateStore(db['review_states'])
+
+class ReviewError(Exception):
+    pass
+
 def validate_signature(request):
     signature = request.headers.get("X-Hub-Signature-256")
     if signature is None:
@@ -66,31 +186,14 @@ def attach_event_id_and_repo_pr(func):
     # 生成一个事件ID，并将其与仓库名和PR号码一起附加到日志记录中
     @wraps(func)
     def wrapper(*args, **kwargs):
-        # print(json.dumps(request.get_json()))
-        # print(func.__name__)
-        event_id = str(uuid.uuid4())  # 生成一个唯一的事件ID
+        # 使用GitHub的投递ID作为事件ID，重新投递的webhook具有相同的ID
+        event_id = request.headers.get("X-GitHub-Delivery") or str(uuid.uuid4())
         event = request.get_json()  # 从请求中获取事件数据
         pr = event["pull_request"]  # 从事件数据中提取PR信息
         repo = event["repository"]  # 从事件数据中提取仓库信息
-        print(json.dumps(repo))
-        logger = logging.getLogger()  # 获取根日志记录器
-        old_factory = logger.makeRecord  # 保存原始的makeRecord方法
-
-        # 定义一个新的记录工厂函数，用于替换日志记录器的makeRecord方法
-        def record_factory(*args, **kwargs):
-            record = old_factory(*args, **kwargs)  # 创建一个原始的日志记录
-            record.event_id = event_id  # 将事件ID附加到日志记录中
-            record.repo = repo['full_name']  # 将仓库全名附加到日志记录中
-            # record.pr = pr['number']  # 将PR号码附加到日志记录中
-            return record  # 返回修改后的日志记录
-
-        logger.makeRecord = record_factory  # 替换日志记录器的makeRecord方法
-        try:
+        with bind_log_context(event_id=event_id, repo=repo['full_name'], pr=pr['number']):
             # 调用原始函数，并将事件ID作为关键字参数传递
             return func(*args, **kwargs, event_id=event_id)
-        finally:
-            # 无论原始函数是否成功完成或引发异常，都确保恢复原始的makeRecord方法
-            logger.makeRecord = old_factory
 
     return wrapper  # 返回包装器函数，它将替换原始函数
 
@@ -99,6 +202,21 @@ def healthz():
     # 目前比较简单，后续可以添加任何需要的健康检查逻辑
     return "Healthy", 200
 
+def claim_idempotency_key(key, event_id, claimed_keys):
+    # 返回已认领该键的事件ID。对应的任务不存在（入队失败），或者其他事件的任务已经失败或被跳过时，
+    # 重新认领以便重新review；同一事件的任务已在队列中，不能再次入队
+    existing_event_id = idempotency.claim(key, event_id)
+    if existing_event_id is not None:
+        existing_job = job_queue.get(existing_event_id)
+        finished = existing_job is not None and (
+            existing_job["status"] == JOB_DEAD or "skipped" in (existing_job.get("result") or {}))
+        if existing_job is None or (finished and existing_event_id != event_id):
+            idempotency.release(key)
+            existing_event_id = idempotency.claim(key, event_id)
+    if existing_event_id is None:
+        claimed_keys.append(key)
+    return existing_event_id
+
 @app.route("/review_pr", methods=["POST"])
 @attach_event_id_and_repo_pr
 def review_pr(event_id):
@@ -114,136 +232,346 @@ def review_pr(event_id):
     if event["action"] not in ["opened", "synchronize", "reopened"]:
         return "Ignoring non-PR opening/synchronize/reopening events", 200
 
+    pr_key = f"{event['repository']['full_name']}#{event['pull_request']['number']}"
+    head_sha = event["pull_request"].get("head", {}).get("sha")
+    claimed_keys = []
+    try:
+        # 同一次投递，或者同一个head已经用相同版本的提示词review过，直接返回已有的结果
+        existing_event_id = claim_idempotency_key(f"delivery:{event_id}", event_id, claimed_keys)
+        if existing_event_id is None and head_sha:
+            review_key = f"review:{pr_key}@{head_sha}:{PROMPT_VERSION}"
+            existing_event_id = claim_idempotency_key(review_key, event_id, claimed_keys)
+        if existing_event_id is not None:
+            logger.info(f"Duplicate of event {existing_event_id}, not enqueueing a new review")
+            return jsonify({
+                "event_id": existing_event_id,
+                "status_url": url_for("get_job", event_id=existing_event_id),
+                "duplicate": True,
+            }), 200
+
+        idempotency.set_latest(pr_key, event_id)
+        delay = review_debounce_seconds if event["action"] == "synchronize" else 0
+        job_queue.enqueue(event_id, event, delay=delay)
+    except Exception as e:
+        logger.error(f"Error while enqueueing the review job: {e}")
+        # 释放已认领的键，否则 GitHub 重新投递时会被当作重复事件，而对应的任务并不存在
+        for key in claimed_keys:
+            try:
+                idempotency.release(key)
+            except Exception as release_error:
+                logger.error(f"Error while releasing idempotency key {key}: {release_error}")
+        return "Error while enqueueing the review job", 500
+    logger.info("Review job enqueued")
+
+    return jsonify({"event_id": event_id, "status_url": url_for("get_job", event_id=event_id)}), 202
+
+@app.route("/jobs/<event_id>")
+def get_job(event_id):
+    try:
+        job = job_queue.get(event_id)
+    except Exception as e:
+        logger.error(f"Error while loading review job {event_id}: {e}")
+        return jsonify({"code": 500, "message": "Error while loading review job"}), 500
+    if job is None:
+        return jsonify({"code": 404, "message": "Review job not found"}), 404
+    return jsonify(describe_job(job))
+
+def process_review_job(job):
+    event = job["payload"]
+    with bind_log_context(event_id=job["_id"], repo=event["repository"]["full_name"], pr=event["pull_request"]["number"]), \
+            metrics.trace(job["_id"]), metrics.span("review"):
+        logger.info(f"Processing review job, attempt {job['attempts']}")
+        return run_review(job["_id"], event)
+
+def plan_incremental_review(gh_repo, gh_pr, repo_full_name):
+    # 返回上次review之后新增的提交信息；无法增量review时返回None，改为完整review
+    try:
+        state = review_states.get(repo_full_name, gh_pr.number)
+    except Exception as e:
+        logger.error(f"Error while loading the last review state from MongoDB: {e}")
+        return None
+    if state is None or state["head_sha"] == gh_pr.head.sha:
+        return None
+    if state.get("base_ref") != gh_pr.base.ref:
+        logger.info("Base branch changed since the last review, falling back to a full review")
+        return None
+
+    try:
+        comparison = gh_repo.compare(state["head_sha"], gh_pr.head.sha)
+    except Exception as e:
+        # force push 之后旧的 head 可能已经不存在
+        logger.info(f"Cannot compare with the last reviewed head, falling back to a full review: {e}")
+        return None
+    # force push 或 rebase 之后，旧的 head 不再是新 head 的祖先
+    if comparison.status != "ahead":
+        logger.info(f"Last reviewed head is {comparison.status} of the new head, falling back to a full review")
+        return None
+    # 合并了 base 分支的提交会带入无关的改动
+    if any(len(commit.parents) > 1 for commit in comparison.commits):
+        logger.info("Merge commits pushed since the last review, falling back to a full review")
+        return None
+
+    return {
+        "previous_head_sha": state["head_sha"],
+        "previous_review": state["review"],
+        "files": list(comparison.files),
+    }
+
+def create_final_review(messages, output_mode):
+    """Return `(review, translation)`; the translation is None unless a single-pass call produced both."""
+    if output_mode == "single_pass":
+        try:
+            response = llm.chat(
+                REVIEW_MODEL,
+                messages + [{"role": "system", "content": BILINGUAL_INSTRUCTION}],
+                purpose="review",
+                response_format={"type": "json_object"},
+            )
+            bilingual = split_bilingual(response.choices[0]['message']['content'].strip())
+            if bilingual is not None:
+                return bilingual
+            logger.info("Single-pass response is not valid JSON, reviewing again and translating separately")
+        except openai.error.InvalidRequestError as e:
+            # 模型不接受 response_format 等参数时返回400，改用两次调用
+            logger.error(f"Error while requesting a single-pass review, reviewing again and translating separately: {e}")
+    response = llm.chat(REVIEW_MODEL, messages, purpose="review")
+    return response.choices[0]['message']['content'].strip(), None
+
+def review_in_chunks(instruction, header, prompt_chunks, output_mode):
+    # 每个分块单独并发review，再合并成一个按模板输出的review；同时返回合并步骤的提示词
+    trace_id = metrics.current_trace_id()
+
+    def review_chunk(numbered_chunk):
+        number, chunk = numbered_chunk
+        chunk_messages = [
+            {"role": "system", "content": REVIEW_SYSTEM_PROMPT},
+            {"role": "user", "content": (
+                f"{instruction}\nThe pull request is too large to review at once. "
+                f"This is part {number} of {len(prompt_chunks)}, covering {len(chunk.files)} of the changed files.\n"
+                f"{header}{chunk.body}\n"
+            )},
+        ]
+        with metrics.trace(trace_id):
+            response = llm.chat(REVIEW_MODEL, chunk_messages, purpose="review_chunk")
+        return response.choices[0]['message']['content'].strip()
+
+    logger.info(f"Sending {len(prompt_chunks)} partial review requests to OpenAI API")
+    with ThreadPoolExecutor(max_workers=review_chunk_concurrency) as executor:
+        partial_reviews = list(executor.map(review_chunk, enumerate(prompt_chunks, 1)))
+
+    reviews_combined = "\n".join(
+        f"Review of part {number}:\n{review}\n" for number, review in enumerate(partial_reviews, 1)
+    )
+    merge_messages = [
+        {"role": "system", "content": REVIEW_SYSTEM_PROMPT},
+        {"role": "user", "content": (
+            f"The following pull request was reviewed in {len(prompt_chunks)} parts because of its size. "
+            f"Merge the partial reviews into a single review of the whole pull request that follows the template, "
+            f"removing duplicated points.\n{header}\n{reviews_combined}"
+        )},
+    ]
+    logger.info("Merging partial reviews")
+    review_content, review_translation = create_final_review(merge_messages, output_mode)
+    return merge_messages, review_content, review_translation
+
+def translate_in_background(review_content, trace_id):
+    with metrics.trace(trace_id), metrics.span("translation"):
+        return translate_review(review_content, llm)
+
+def save_messages(event_id, messages, replace=False):
+    # 大的消息内容先于引用它们的对话写入；replace 用于任务重试时覆盖上一次尝试的内容
+    stored, content_operations = content_store.externalize(messages)
+    if replace:
+        operation = UpdateOne({"uuid": event_id}, {"$set": {"messages": stored}}, upsert=True)
+    else:
+        operation = UpdateOne({"uuid": event_id}, {"$push": {"messages": {"$each": stored}}})
+    mongo_writer.submit(content_store.collection, *content_operations)
+    mongo_writer.submit(collection, operation)
+
+def run_review(event_id, event):
     pr = event["pull_request"]
     repo = event["repository"]
 
+    # 在等待期间同一个PR有了更新的事件，只review最新的head
+    try:
+        latest_event_id = idempotency.latest(f"{repo['full_name']}#{pr['number']}")
+    except Exception as e:
+        logger.error(f"Error while loading the latest event of the PR: {e}")
+        latest_event_id = None
+    if latest_event_id is not None and latest_event_id != event_id:
+        logger.info(f"Superseded by event {latest_event_id}, skipping the review")
+        return {"skipped": f"Superseded by event {latest_event_id}"}
+
     try:
         # Get the code changes from the PR
         logger.info(
             f"Fetching PR details from GitHub repo {repo['full_name']} #{pr['number']}"
         )
-        gh_repo = gh.get_repo(repo["full_name"])
-        gh_pr = gh_repo.get_pull(pr["number"])
-
-        # Extract issue description from the PR body
-        ref_numbers = re.findall(r"#(\d+)", gh_pr.body)
-        issues_description = ""
-        for ref_number in ref_numbers:
-            issue_or_pr = gh_repo.get_issue(int(ref_number))
-            if issue_or_pr.pull_request is None:  # This means it's an Issue
-                issues_description += f"Issue #{ref_number}: {issue_or_pr.title}\n{issue_or_pr.body}\n\n"
-
-        # Extract the code changes from the PR
-        code_changes = []
-        for file in gh_pr.get_files():
-            full_file_content = gh_repo.get_contents(file.filename, ref=gh_pr.head.sha).decoded_content.decode()
-            code_changes.append({
-                "filename": file.filename,
-                "patch": file.patch,
-                "full_content": full_file_content
-            })
+        with metrics.span("github_fetch"):
+            gh_repo = gh.get_repo(repo["full_name"])
+            gh_pr = gh_repo.get_pull(pr["number"])
+
+            incremental = None
+            if event["action"] == "synchronize":
+                incremental = plan_incremental_review(gh_repo, gh_pr, repo["full_name"])
+
+            # Extract the referenced issues and the code changes from the PR
+            if incremental is None:
+                issues_description, code_changes, fetch_timings = pr_fetcher.fetch(gh_repo, gh_pr)
+            else:
+                logger.info(
+                    f"Reviewing {len(incremental['files'])} files changed since {incremental['previous_head_sha']}"
+                )
+                issues_description, code_changes, fetch_timings = pr_fetcher.fetch(
+                    gh_repo, gh_pr, files=incremental["files"]
+                )
+            for step in ("list_files", "fetch"):
+                github_fetch_seconds.observe(fetch_timings[step], step=step)
 
     except Exception as e:
         logger.error(f"Error while fetching PR details from GitHub API: {e}")
-        return "Error while fetching PR details from GitHub API", 500
+        raise ReviewError(f"Error while fetching PR details from GitHub API: {e}") from e
 
-    # Concatenate the changes into a single string
+    if incremental is not None and not code_changes:
+        logger.info("No file changes since the last review")
+        return {"skipped": "No file changes since the last review"}
+
+    # Assemble the prompt within the token budget of the model
     logger.info("Preparing GPT request with code changes and context")
-    changes_str = "Title: " + gh_pr.title + "\n"
+    header = "Title: " + gh_pr.title + "\n"
     if gh_pr.body is not None:
-        changes_str += "Body: " + gh_pr.body + "\n"
+        header += "Body: " + gh_pr.body + "\n"
     if issues_description != "":
-        changes_str += "---------------Issues referenced---------------\n"
-        changes_str += issues_description
-    for change in code_changes:
-        changes_str += "---------------File changed---------------\n"
-        changes_str += f"File: {change['filename']}\n\nPatch:\n{change['patch']}\n\nFull Content:\n{change['full_content']}\n"
-
-
-    # Prepare the GPT prompt and store it in MongoDB
-    messages = [
-            {
-                "role": "system",
-                "content": 
-"""
-As an AI assistant with expertise in programming, your primary task is to review the pull request provided by the user.
-
-When generating your review, adhere to the following template:
-**[Changes]**: Summarize the main changes made in the pull request in less than 50 words.
-**[Suggestions]**: Provide any suggestions or improvements for the code. Focus on code quality, logic, potential bugs and performance problems. Refrain from mentioning document-related suggestions such as "I suggest adding some comments", etc.
-**[Clarifications]**: (Optional) If there are parts of the pull request that are unclear or lack sufficient context, ask for clarification here. If not, this section can be omitted.
-**[Conclusion]**: Conclude the review with an overall assessment.
-**[Other]**: (Optional) If there are additional observations or notes, mention them here. If not, this section can be omitted.
-
-The user may also engage in further discussions about the review. It is not necessary to use the template when discussing with the user.
-""",
-            },
-            {
-                "role": "user",
-                "content": f"Review the following pull request. The patches are in standard `diff` format. Evaluate the pull request within the context of the referenced issues and full content of the code file(s).\n{changes_str}\n",
-            },
-        ]
+        header += "---------------Issues referenced---------------\n"
+        header += issues_description
+    if incremental is not None:
+        header += "---------------Previous review---------------\n"
+        header += incremental["previous_review"] + "\n"
+    related_code = []
+    if repo_index is not None:
+        with metrics.span("related_code"):
+            try:
+                related_code = repo_index.related_code(repo["full_name"], code_changes, review_related_code_snippets)
+            except Exception as e:
+                logger.error(f"Error while looking up related code in the repository index: {e}")
     try:
-        logger.info("Creating the document to store the review messages in MongoDB")
-        # collection.insert_one({"uuid": event_id, "messages": messages})
+        with metrics.span("prompt_build"):
+            prompt_chunks = prompt_builder.build(header, code_changes, related_code)
     except Exception as e:
-        logger.error(f"Error while creating the document to store the review messages in MongoDB: {e}")
-        return "Error while creating the document to store the review messages in MongoDB", 500
+        logger.error(f"Error while building the review prompt: {e}")
+        raise ReviewError(f"Error while building the review prompt: {e}") from e
+
+    if incremental is None:
+        instruction = "Review the following pull request. The patches are in standard `diff` format. Evaluate the pull request within the context of the referenced issues and full content of the code file(s)."
+    else:
+        instruction = (
+            f"The following pull request was reviewed before at commit {incremental['previous_head_sha']}, the previous review is included below. "
+            f"Review only the changes pushed since then, which are in standard `diff` format against that commit. "
+            f"Evaluate them within the context of the referenced issues, the previous review and full content of the code file(s), "
+            f"and point out which earlier suggestions have been addressed."
+        )
 
+    output_mode = output_mode_for(repo["full_name"], REVIEW_MODEL)
+    if len(prompt_chunks) == 1:
+        # Prepare the GPT prompt and store it in MongoDB
+        messages = [
+            {"role": "system", "content": REVIEW_SYSTEM_PROMPT},
+            {"role": "user", "content": f"{instruction}\n{header}{prompt_chunks[0].body}\n"},
+        ]
+        logger.info("Queueing the document to store the review messages in MongoDB")
+        save_messages(event_id, messages, replace=True)
     try:
         # Call GPT to get the review result
-        logger.info("Sending request to OpenAI API")
-        response = openai.ChatCompletion.create(
-            model="gpt-4-1106-preview",
-            messages=messages
-        )
+        with metrics.span("llm_review"):
+            if len(prompt_chunks) == 1:
+                logger.info(f"Sending request to OpenAI API, output mode {output_mode}")
+                review_content, review_translation = create_final_review(messages, output_mode)
+            else:
+                messages, review_content, review_translation = review_in_chunks(
+                    instruction, header, prompt_chunks, output_mode)
         logger.info("Received responses from OpenAI API")
     except Exception as e:
         logger.error(f"Error while calling OpenAI API: {e}")
-        return "Error while calling OpenAI API", 500
+        raise ReviewError(f"Error while calling OpenAI API: {e}") from e
+    if len(prompt_chunks) > 1:
+        # 所有分块合在一起会超出对话的token预算，对话从合并步骤的提示词（PR信息和各部分的review）开始
+        logger.info("Queueing the document to store the merge prompt in MongoDB")
+        save_messages(event_id, messages, replace=True)
+
+    # 在保存结果和准备评论的同时翻译模型生成的review
+    translation_future = None
+    if review_translation is None and output_mode != "english":
+        logger.info("Translating review to Chinese")
+        translation_future = translation_executor.submit(translate_in_background, review_content, metrics.current_trace_id())
+
+    logger.info("Queueing the review results to store in MongoDB")
+    save_messages(event_id, [{"role": "assistant", "content": review_content}])
+
+    if translation_future is not None:
+        try:
+            review_translation = translation_future.result()
+        except Exception as e:
+            logger.error(f"Error while translating the review: {e}")
+            raise ReviewError(f"Error while translating the review: {e}") from e
+        logger.info("Translation completed")
 
-    try:
-        logger.info("Storing the review results in MongoDB")
-        # collection.update_one({"uuid": event_id}, {"$push": {"messages": response.choices[0]['message']}})
-    except Exception as e:
-        logger.error(f"Error while storing the review results in MongoDB {e}")
-        return "Error while storing the review results in MongoDB", 500
-
-    final_review = f"""**[AI Review]** This comment is generated by an AI model (GPT-4 Turbo) via **v2** prompt.\n\n{response.choices[0]['message']['content'].strip()}\n
-**[Note]** 
-The above AI review results are for reference only, please rely on human expert review results for the final conclusion.
-Usually, AI is better at enhancing the quality of code snippets. However, it's essential for human experts to pay close attention to whether the modifications meet the overall requirements. Providing detailed information in the PR description helps the AI generate more specific and useful review results.
-For further discussion with the AI Reviewer, please visit: http://8.210.154.109:32765/conversation?uuid={event_id}\n\n"""
+    final_review = format_comment(review_content, review_translation, event_id)
     logger.info("Final review prepared")
 
-    logger.info("Translating review to Chinese")
-    translate_messages = [{"role": "user", "content": f"将下面内容翻译为中文:\n{final_review}"}]
-    try:
-        translated_response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=translate_messages
-        )
-    except Exception as e:
-        logger.error(f"Error while fetching PR details from GitHub API: {e}")
-        return "Error while fetching PR details from GitHub API", 500
-    logger.info("Translation completed")
-
     try:
         # Post the GPT result as a PR comment
         logger.info("Submitting PR review comment")
-        gh_pr.create_issue_comment(
-            final_review
-            + "\n"
-            + translated_response.choices[0]["message"]["content"].strip()
-        )
+        with metrics.span("comment_post"):
+            comment = gh_pr.create_issue_comment(final_review)
 
         logger.info("PR review comment submitted")
     except Exception as e:
         logger.error(f"Error while submitting PR review comment: {e}")
-        return "Error while submitting PR review comment", 500
+        raise ReviewError(f"Error while submitting PR review comment: {e}") from e
 
-    return "Review submitted", 200
+    try:
+        review_states.save(
+            repo["full_name"], gh_pr.number, gh_pr.head.sha, gh_pr.base.ref,
+            review_content, event_id,
+        )
+    except Exception as e:
+        # 只影响下一次是否能增量review，不影响本次结果
+        logger.error(f"Error while saving the review state in MongoDB: {e}")
+
+    return {"comment_url": comment.html_url}
 
 
+worker_pool = ReviewWorkerPool(
+    job_queue,
+    process_review_job,
+    num_workers=int(os.environ.get("REVIEW_WORKERS", "2")),
+    poll_interval=float(os.environ.get("REVIEW_WORKER_POLL_SECONDS", "1")),
+    scheduler=review_scheduler,
+)
+
+def start_background_workers():
+    # 在每个进程中各自调用（gunicorn 在 worker fork 之后调用），后台线程不能跨 fork 使用
+    try:
+        collection.create_index("uuid", unique=True)
+        job_queue.ensure_indexes()
+        idempotency.ensure_indexes()
+        review_states.ensure_indexes()
+        token_ledger.ensure_indexes()
+    except Exception as e:
+        logger.error(f"Error while creating MongoDB indexes: {e}")
+    mongo_writer.start()
+    # 不经过 gunicorn 运行时也在退出前写完队列中的对话
+    atexit.register(mongo_writer.stop, 10)
+    worker_pool.start()
+
+def stop_background_workers(timeout=None):
+    # 等待正在进行的review结束；超时未完成的任务在租约过期后会被其他worker重新领取
+    logger.info("Stopping review workers")
+    deadline = None if timeout is None else time.monotonic() + timeout
+    worker_pool.stop(timeout)
+    # review结束后再写入它们提交的对话，至少留出几秒
+    mongo_writer.stop(None if deadline is None else max(deadline - time.monotonic(), 5))
+
 if __name__ == "__main__":
+    start_background_workers()
     app.run(host="0.0.0.0", port=9000)
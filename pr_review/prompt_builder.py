@@ -0,0 +1,187 @@
+import logging
+import os
+
+from common.repo_index import render_snippet
+from common.tokens import PROMPT_TOKEN_BUDGETS, count_tokens
+from context_extractor import ContextExtractor
+
+logger = logging.getLogger(__name__)
+
+# 留给 system prompt 和回复的余量之后，每个模型可以用于PR内容的token数
+DEFAULT_TOKEN_BUDGETS = {
+    "gpt-4-1106-preview": 100000,
+    "gpt-4": 6000,
+    "gpt-3.5-turbo": 12000,
+}
+
+LEVELS = ("patch", "context", "full")
+
+
+def token_budget(model):
+    budget = os.environ.get("PROMPT_TOKEN_BUDGET")
+    if budget:
+        return int(budget)
+    return PROMPT_TOKEN_BUDGETS.get(model, 6000)
+
+
+class PromptChunk:
+    def __init__(self, files, body, tokens):
+        self.files = files
+        self.body = body
+        self.tokens = tokens
+
+
+class PromptBuilder:
+    """Assembles the review prompt within a token budget.
+
+    Every changed file gets its patch first. Remaining budget is spent on the
+    functions and classes around each hunk, then on full file contents,
+    cheapest upgrades first. Depending on `context_mode`, full contents are
+    never sent ("hunk"), only for files of at most `full_file_max_lines`
+    lines ("auto"), or for any file ("full"). When the patches alone do not
+    fit, the files are split into chunks by directory, each of which fits the
+    budget on its own.
+
+    Code from other files related to the changes (see `common.repo_index`) is
+    added after the patches and before any upgrade, within at most
+    `related_code_tokens`, and only when the changes fit in one chunk.
+    """
+
+    def __init__(self, model, budget=None, context_lines=20, context_mode="auto", full_file_max_lines=300,
+                 related_code_tokens=0):
+        self.model = model
+        self.budget = budget if budget is not None else token_budget(model)
+        self.context_mode = context_mode
+        self.full_file_max_lines = full_file_max_lines
+        self.related_code_tokens = related_code_tokens
+        self.extractor = ContextExtractor(radius=context_lines)
+
+    def _allow_full(self, change):
+        if self.context_mode == "full":
+            return True
+        if self.context_mode == "hunk":
+            return False
+        return change["full_content"].count("\n") < self.full_file_max_lines
+
+    def render_file(self, change, level):
+        section = "---------------File changed---------------\n"
+        section += f"File: {change['filename']}\n\nPatch:\n{change['patch'] or '(no patch available)'}\n"
+        if level == "context":
+            section += f"\nContext around the changes:\n{change['context']}\n"
+        elif level == "full":
+            section += f"\nFull Content:\n{change['full_content']}\n"
+        return section
+
+    def _section(self, change):
+        change = dict(change)
+        change["context"] = self.extractor.extract(change["filename"], change["full_content"], change["patch"])
+        levels = {"patch": count_tokens(self.render_file(change, "patch"), self.model)}
+        # 以前每个文件都会附带完整内容，用于统计节省的token数
+        baseline = levels["patch"]
+        if change["full_content"]:
+            full_tokens = count_tokens(self.render_file(change, "full"), self.model)
+            baseline = full_tokens
+            if self._allow_full(change):
+                levels["full"] = full_tokens
+            if change["context"]:
+                context_tokens = count_tokens(self.render_file(change, "context"), self.model)
+                if context_tokens < full_tokens or "full" not in levels:
+                    levels["context"] = context_tokens
+        return {"change": change, "level": "patch", "tokens": levels, "baseline": baseline}
+
+    def _truncate_patch(self, section, available):
+        # 单个文件的 patch 就超出预算时，按比例截断
+        change = section["change"]
+        keep = max(int(len(change["patch"]) * available / section["tokens"]["patch"]) - 200, 0)
+        change["patch"] = change["patch"][:keep] + "\n... (patch truncated)"
+        section["tokens"] = {"patch": count_tokens(self.render_file(change, "patch"), self.model)}
+
+    def _fill(self, sections, available):
+        used = sum(section["tokens"]["patch"] for section in sections)
+        for level in LEVELS[1:]:
+            candidates = [section for section in sections if level in section["tokens"]]
+            candidates.sort(key=lambda s: s["tokens"][level] - s["tokens"][s["level"]])
+            for section in candidates:
+                extra = section["tokens"][level] - section["tokens"][section["level"]]
+                if used + extra <= available:
+                    section["level"] = level
+                    used += extra
+        body = "".join(self.render_file(section["change"], section["level"]) for section in sections)
+        return PromptChunk([section["change"]["filename"] for section in sections], body, used)
+
+    def _split(self, sections, available):
+        # 按目录分组，保持文件原有顺序
+        groups = {}
+        for section in sections:
+            if section["tokens"]["patch"] > available:
+                self._truncate_patch(section, available)
+            groups.setdefault(os.path.dirname(section["change"]["filename"]), []).append(section)
+
+        chunks, current, current_tokens = [], [], 0
+        for group in groups.values():
+            group_tokens = sum(section["tokens"]["patch"] for section in group)
+            # 目录整体放不下时，拆成单个文件
+            items = [group] if group_tokens <= available else [[section] for section in group]
+            for item in items:
+                item_tokens = sum(section["tokens"]["patch"] for section in item)
+                if current and current_tokens + item_tokens > available:
+                    chunks.append(current)
+                    current, current_tokens = [], 0
+                current.extend(item)
+                current_tokens += item_tokens
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _related(self, related_code, available):
+        # 按相关性顺序加入，直到用完预算
+        body, used, count = "", 0, 0
+        for item in related_code:
+            snippet = render_snippet(item)
+            tokens = count_tokens(snippet, self.model)
+            if used + tokens > available:
+                continue
+            body += snippet
+            used += tokens
+            count += 1
+        if not count:
+            return "", 0, 0
+        title = "---------------Related code (default branch, not changed by this PR)---------------\n"
+        return title + body, used + count_tokens(title, self.model), count
+
+    def build(self, header, code_changes, related_code=None):
+        """Return the list of `PromptChunk`s for the changes; one when they fit.
+
+        Raises ValueError when `header` alone does not fit in the budget.
+        """
+        header_tokens = count_tokens(header, self.model)
+        available = self.budget - header_tokens
+        if available <= 0:
+            raise ValueError(f"The pull request description uses {header_tokens} tokens, "
+                             f"leaving nothing of the {self.budget} token budget for the changes")
+        sections = [self._section(change) for change in code_changes]
+        patch_tokens = sum(section["tokens"]["patch"] for section in sections)
+        related, related_tokens, related_count = "", 0, 0
+        if patch_tokens <= available:
+            groups = [sections]
+            if related_code and self.related_code_tokens:
+                related, related_tokens, related_count = self._related(
+                    related_code, min(self.related_code_tokens, available - patch_tokens))
+        else:
+            groups = self._split(sections, available)
+        chunks = [self._fill(group, available - related_tokens) for group in groups]
+        if related:
+            chunks[0].body += related
+            chunks[0].tokens += related_tokens
+
+        counts = {level: 0 for level in LEVELS}
+        for section in sections:
+            counts[section["level"]] += 1
+        tokens_saved = sum(section["baseline"] for section in sections) - sum(chunk.tokens for chunk in chunks)
+        logger.info(
+            f"Prompt built in {len(chunks)} chunk(s) using up to {max((c.tokens for c in chunks), default=0)} of {available} "
+            f"tokens: {counts['patch']} files with patch only, {counts['context']} with the enclosing functions/classes, "
+            f"{counts['full']} with full content, {related_count} related code snippets in {related_tokens} tokens; "
+            f"{tokens_saved} tokens saved compared to sending every full file (context mode {self.context_mode})"
+        )
+        return chunks
@@ -0,0 +1,97 @@
+import json
+import os
+
+# 输出模式：
+# single_pass        一次GPT调用同时生成英文和中文的review
+# parallel_translate 只翻译模型生成的review部分，与其他准备工作并行
+# english            只输出英文
+OUTPUT_MODES = ("single_pass", "parallel_translate", "english")
+
+PROMPT_VERSION = "v2"
+
+BILINGUAL_INSTRUCTION = (
+    'Respond with a JSON object with exactly two string fields: "en" holding the review in English, '
+    'and "zh" holding the same review translated into Chinese. Keep the markdown formatting and the '
+    'section titles such as **[Changes]** unchanged in both languages.'
+)
+
+# 固定的说明文字提前翻译好，不再每次交给模型翻译
+BOILERPLATE = {
+    "en": {
+        "header": f"**[AI Review]** This comment is generated by an AI model (GPT-4 Turbo) via **{PROMPT_VERSION}** prompt.",
+        "note": (
+            "**[Note]** \n"
+            "The above AI review results are for reference only, please rely on human expert review results for the final conclusion.\n"
+            "Usually, AI is better at enhancing the quality of code snippets. However, it's essential for human experts to pay close attention to whether the modifications meet the overall requirements. "
+            "Providing detailed information in the PR description helps the AI generate more specific and useful review results.\n"
+            "For further discussion with the AI Reviewer, please visit: {url}"
+        ),
+    },
+    "zh": {
+        "header": f"**[AI 审查]** 本评论由 AI 模型（GPT-4 Turbo）基于 **{PROMPT_VERSION}** 版本提示词生成。",
+        "note": (
+            "**[注意]** \n"
+            "以上 AI 审查结果仅供参考，最终结论请以人类专家的审查结果为准。\n"
+            "通常 AI 更擅长提升代码片段的质量，但人类专家仍需重点关注这些修改是否满足整体需求。"
+            "在 PR 描述中提供详细信息有助于 AI 生成更具体、更有用的审查结果。\n"
+            "如需与 AI 审查者进一步讨论，请访问：{url}"
+        ),
+    },
+}
+
+# 支持 response_format={"type": "json_object"} 的模型（按前缀匹配）；其他模型不使用 single_pass
+JSON_MODE_MODELS = (
+    "gpt-4-1106-preview", "gpt-4-0125-preview", "gpt-4-turbo", "gpt-4o", "gpt-3.5-turbo-1106", "gpt-3.5-turbo-0125",
+)
+
+CONVERSATION_BASE_URL = os.environ.get("CONVERSATION_BASE_URL", "http://8.210.154.109:32765/conversation")
+
+
+def supports_json_mode(model):
+    return model.startswith(JSON_MODE_MODELS)
+
+
+def output_mode_for(repo_full_name, model):
+    # REVIEW_OUTPUT_MODES 为 JSON，例如 {"owner/repo": "english"}，未配置的仓库使用 REVIEW_OUTPUT_MODE
+    modes = json.loads(os.environ.get("REVIEW_OUTPUT_MODES", "{}"))
+    mode = modes.get(repo_full_name, os.environ.get("REVIEW_OUTPUT_MODE", "single_pass"))
+    if mode not in OUTPUT_MODES:
+        mode = "single_pass"
+    if mode == "single_pass" and not supports_json_mode(model):
+        # 模型不支持 JSON 输出时，先生成英文review再单独翻译
+        mode = "parallel_translate"
+    return mode
+
+
+def split_bilingual(content):
+    """Return `(en, zh)` from a single-pass response, or None when it is not valid."""
+    try:
+        result = json.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(result, dict) or not isinstance(result.get("en"), str) or not isinstance(result.get("zh"), str):
+        return None
+    return result["en"].strip(), result["zh"].strip()
+
+
+def translate_review(review, llm):
+    # 只翻译模型生成的review内容
+    response = llm.chat(
+        "gpt-3.5-turbo",
+        [{"role": "user", "content": f"将下面内容翻译为中文，保持markdown格式不变:\n{review}"}],
+        purpose="translation",
+    )
+    return response.choices[0]["message"]["content"].strip()
+
+
+def format_section(language, review, event_id):
+    text = BOILERPLATE[language]
+    url = f"{CONVERSATION_BASE_URL}?uuid={event_id}"
+    return f"{text['header']}\n\n{review}\n\n{text['note'].format(url=url)}\n\n"
+
+
+def format_comment(review_en, review_zh, event_id):
+    comment = format_section("en", review_en, event_id)
+    if review_zh is not None:
+        comment += "\n" + format_section("zh", review_zh, event_id)
+    return comment
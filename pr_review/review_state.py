@@ -0,0 +1,31 @@
+from datetime import datetime
+
+
+class ReviewStateStore:
+    """Last reviewed head SHA and review text per (repo, PR), kept in MongoDB.
+
+    Later `synchronize` events compare against this head to review only the
+    commits pushed since then.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def ensure_indexes(self):
+        self.collection.create_index([("repo", 1), ("pr", 1)], unique=True)
+
+    def get(self, repo, pr):
+        return self.collection.find_one({"repo": repo, "pr": pr})
+
+    def save(self, repo, pr, head_sha, base_ref, review, event_id):
+        self.collection.update_one(
+            {"repo": repo, "pr": pr},
+            {"$set": {
+                "head_sha": head_sha,
+                "base_ref": base_ref,
+                "review": review,
+                "event_id": event_id,
+                "updated_at": datetime.utcnow(),
+            }},
+            upsert=True,
+        )
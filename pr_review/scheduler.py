@@ -0,0 +1,259 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from common import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = metrics.gauge("review_queue_depth", "Review jobs ready to run.", ("repo",))
+QUEUE_WAIT = metrics.histogram("review_queue_wait_seconds", "Time review jobs waited after becoming ready.", ("repo",))
+REPO_TOKENS = metrics.counter("review_repo_tokens_total", "OpenAI tokens used by the reviews of each repository.", ("repo",))
+BUDGET_EXHAUSTED = metrics.gauge(
+    "review_repo_budget_exhausted", "1 while the repository's jobs are held back by its token budget.", ("repo",))
+
+# 估算一次review的token数：系统提示词和PR描述、每个文件的上下文、每一行改动
+BASE_TOKENS = 2000
+TOKENS_PER_FILE = 600
+TOKENS_PER_CHANGED_LINE = 12
+
+
+def estimate_cost(job):
+    """Estimated tokens of a review, from the file count and patch size in the webhook payload."""
+    lines = (job.get("additions") or 0) + (job.get("deletions") or 0)
+    return BASE_TOKENS + TOKENS_PER_FILE * (job.get("changed_files") or 0) + TOKENS_PER_CHANGED_LINE * lines
+
+
+def parse_repo_values(value):
+    # "org/big=0.5,*=1" -> {"org/big": 0.5, "*": 1.0}，"*" 是其他仓库的默认值
+    values = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        repo, _, number = item.rpartition("=")
+        values[repo.strip()] = float(number)
+    return values
+
+
+class TokenLedger:
+    """OpenAI tokens used per repository in fixed windows of `window_seconds`.
+
+    Shared by all processes through MongoDB; old windows expire through a TTL index.
+    """
+
+    def __init__(self, collection, window_seconds=3600):
+        self.collection = collection
+        self.window_seconds = window_seconds
+
+    def ensure_indexes(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def _window(self):
+        return int(time.time() // self.window_seconds)
+
+    def add(self, repo, tokens):
+        window = self._window()
+        self.collection.update_one(
+            {"_id": f"{repo}:{window}"},
+            {
+                "$inc": {"tokens": tokens},
+                "$setOnInsert": {
+                    "repo": repo,
+                    "window": window,
+                    "expires_at": datetime.utcfromtimestamp((window + 2) * self.window_seconds),
+                },
+            },
+            upsert=True,
+        )
+
+    def used(self, repos):
+        window = self._window()
+        docs = self.collection.find({"_id": {"$in": [f"{repo}:{window}" for repo in repos]}}, {"repo": 1, "tokens": 1})
+        return {doc["repo"]: doc["tokens"] for doc in docs}
+
+
+class LocalTokenLedger:
+    """In-process `TokenLedger` for tests and local runs."""
+
+    def __init__(self, window_seconds=3600):
+        self.window_seconds = window_seconds
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        pass
+
+    def _window(self):
+        return int(time.time() // self.window_seconds)
+
+    def add(self, repo, tokens):
+        key = (repo, self._window())
+        with self._lock:
+            self._used[key] = self._used.get(key, 0) + tokens
+
+    def used(self, repos):
+        window = self._window()
+        with self._lock:
+            # 顺便清理过去的窗口
+            for key in [key for key in self._used if key[1] < window]:
+                del self._used[key]
+            return {repo: self._used[(repo, window)] for repo in repos if (repo, window) in self._used}
+
+
+class ReviewScheduler:
+    """Chooses which ready review job a worker claims next.
+
+    - Repositories share the workers by start-time fair queueing: each
+      repository has a virtual finish time that advances by the estimated
+      cost of its dispatched jobs divided by its weight, its next job starts
+      at that time, and the repository whose next job starts first goes next.
+      A repository that was idle starts from the current virtual time (the
+      start of the last dispatched job), so it cannot save up credit.
+    - Within a repository, the smallest job goes first, except that jobs
+      ready for longer than `aging_seconds` go first in arrival order, so
+      large PRs are not starved.
+    - A repository that used its token budget in the current window of the
+      `ledger` (plus the estimated remainder of its running jobs) is held back
+      until the next window. Budgets are charged with the real usage
+      reported by the LLM gateway (`record_usage`).
+
+    The virtual times are kept per process; the token ledger is shared.
+    """
+
+    def __init__(self, ledger, weights=None, budgets=None, aging_seconds=600, per_repo=50):
+        self.ledger = ledger
+        self.weights = weights or {}
+        self.budgets = budgets or {}
+        self.aging_seconds = aging_seconds
+        self.per_repo = per_repo
+        self._lock = threading.Lock()
+        self._finish = {}
+        self._clock = 0.0
+        # job_id -> 仓库、估算的token数和已经使用的token数
+        self._running = {}
+        self._repos_seen = set()
+
+    def weight(self, repo):
+        return self.weights.get(repo, self.weights.get("*", 1.0)) or 1.0
+
+    def budget(self, repo):
+        # None 表示不限制
+        return self.budgets.get(repo, self.budgets.get("*"))
+
+    def claim(self, queue):
+        groups = queue.ready(self.per_repo)
+        for group in groups:
+            group["repo"] = group["repo"] or ""
+        self._report_depth(groups)
+        if not groups:
+            return None
+        for repo, job in self._order(groups):
+            claimed = queue.claim(job["_id"])
+            if claimed is None:
+                # 已被其他worker或进程领取
+                continue
+            self._dispatched(repo, job, claimed)
+            return claimed
+        return None
+
+    def finish(self, job):
+        with self._lock:
+            self._running.pop(job["_id"], None)
+
+    def record_usage(self, model, purpose, usage):
+        # 由 LLMGateway 在发起调用的线程中调用；review 任务的 trace ID 就是任务ID
+        with self._lock:
+            entry = self._running.get(metrics.current_trace_id())
+            if entry is None:
+                return
+            tokens = usage.get("total_tokens", 0)
+            entry["used"] += tokens
+            repo = entry["repo"]
+        REPO_TOKENS.inc(tokens, repo=repo)
+        try:
+            self.ledger.add(repo, tokens)
+        except Exception as e:
+            logger.error(f"Error while recording the token usage of {repo}: {e}")
+
+    def _report_depth(self, groups):
+        depths = {group["repo"]: group["count"] for group in groups}
+        with self._lock:
+            repos = self._repos_seen | set(depths)
+            self._repos_seen = set(depths)
+        for repo in repos:
+            QUEUE_DEPTH.set(depths.get(repo, 0), repo=repo)
+            if repo not in depths and self.budget(repo) is not None:
+                BUDGET_EXHAUSTED.set(0, repo=repo)
+
+    def _held_back(self, repos):
+        limited = [repo for repo in repos if self.budget(repo) is not None]
+        if not limited:
+            return set()
+        try:
+            used = self.ledger.used(limited)
+        except Exception as e:
+            # 无法读取用量时不限制
+            logger.error(f"Error while loading the token usage of repositories: {e}")
+            return set()
+        with self._lock:
+            for entry in self._running.values():
+                if entry["repo"] in limited:
+                    used[entry["repo"]] = used.get(entry["repo"], 0) + max(entry["estimate"] - entry["used"], 0)
+        held = set()
+        for repo in limited:
+            exhausted = used.get(repo, 0) >= self.budget(repo)
+            BUDGET_EXHAUSTED.set(int(exhausted), repo=repo)
+            if exhausted:
+                held.add(repo)
+        return held
+
+    def _job_key(self, job, now):
+        waited = (now - job["next_run_at"]).total_seconds()
+        if waited >= self.aging_seconds:
+            return (0, job["next_run_at"], 0)
+        return (1, estimate_cost(job), job["next_run_at"])
+
+    def _order(self, groups):
+        # 返回按调度顺序排列的 (仓库, 任务)，领取失败时依次尝试下一个
+        now = datetime.utcnow()
+        held = self._held_back([group["repo"] for group in groups])
+        if held:
+            logger.info(f"Token budget used up, holding back the review jobs of {', '.join(sorted(held))}")
+        queues = []
+        with self._lock:
+            for group in groups:
+                repo = group["repo"]
+                if repo in held or not group["jobs"]:
+                    continue
+                jobs = sorted(group["jobs"], key=lambda job: self._job_key(job, now))
+                # 按虚拟开始时间选择；按结束时间选择时权重大的仓库会一直排在等待中的仓库前面
+                queues.append((max(self._finish.get(repo, self._clock), self._clock), repo, jobs))
+        queues.sort(key=lambda item: (item[0], item[1]))
+        return [(repo, job) for _, repo, jobs in queues for job in jobs]
+
+    def _dispatched(self, repo, job, claimed):
+        cost = estimate_cost(job)
+        with self._lock:
+            start = max(self._finish.get(repo, self._clock), self._clock)
+            self._finish[repo] = start + cost / self.weight(repo)
+            self._clock = start
+            self._running[claimed["_id"]] = {"repo": repo, "estimate": cost, "used": 0}
+        QUEUE_WAIT.observe(max((datetime.utcnow() - job["next_run_at"]).total_seconds(), 0), repo=repo)
+        logger.info(f"Scheduling review job {claimed['_id']} of {repo}, estimated {cost} tokens")
+
+
+def review_scheduler_from_env(ledger):
+    """Build the scheduler from REVIEW_REPO_WEIGHTS, REVIEW_REPO_TOKEN_BUDGETS and REVIEW_SCHEDULER_*.
+
+    Weights and budgets are lists like "org/monorepo=0.5,*=1"; repositories
+    without a budget are not limited.
+    """
+    return ReviewScheduler(
+        ledger,
+        weights=parse_repo_values(os.environ.get("REVIEW_REPO_WEIGHTS")),
+        budgets=parse_repo_values(os.environ.get("REVIEW_REPO_TOKEN_BUDGETS")),
+        aging_seconds=float(os.environ.get("REVIEW_SCHEDULER_AGING_SECONDS", "600")),
+        per_repo=int(os.environ.get("REVIEW_SCHEDULER_CANDIDATES_PER_REPO", "50")),
+    )
@@ -0,0 +1,28 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from context_extractor import heuristic_scopes
+
+
+def test_definitions_found():
+    content = "public static int add(int a, int b) {\n    return a + b;\n}\n\nfunc (s *Server) Run() {\n}\n"
+    scopes, _ = heuristic_scopes(content)
+    assert scopes == [(1, 3), (5, 6)]
+
+
+def test_long_whitespace_line():
+    # 定义行的正则曾在长空白行上回溯爆炸，3000个空格的行无法结束
+    content = "\n".join([" " * 3000 + "a", " " * 3000 + "a b c (", "int main() {", "}"])
+    start = time.monotonic()
+    scopes, _ = heuristic_scopes(content)
+    assert time.monotonic() - start < 1
+    assert scopes == [(3, 4)]
+
+
+if __name__ == "__main__":
+    test_definitions_found()
+    test_long_whitespace_line()
+    print("OK")
@@ -0,0 +1,140 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.diff_model import parse_patch, parse_unified_diff
+
+PATCH = "\n".join([
+    "@@ -1,3 +1,4 @@ def main():",
+    " a",
+    "+b",
+    " c",
+    " d",
+    "@@ -10,3 +11,2 @@",
+    " x",
+    "-y",
+    "-w",
+    "+z",
+    "\\ No newline at end of file",
+])
+
+
+def test_hunks_and_line_numbers():
+    file = parse_patch(PATCH, "app.py")
+    first, second = file.hunks
+    assert (first.old_start, first.old_count, first.new_start, first.new_count) == (1, 3, 1, 4)
+    assert first.section == "def main():"
+    assert list(first.added) == [2]
+    assert list(second.removed) == [11, 12]
+    assert list(second.added) == [12]
+    assert list(file.changed_lines()) == [2, 12]
+    assert (file.additions, file.deletions, file.hunk_count) == (2, 2, 2)
+    assert file.render() == PATCH
+
+
+def test_positions():
+    # GitHub 的 diff position 从第一个 @@ 行之后开始计数，后面的 @@ 行也占一个位置
+    file = parse_patch(PATCH, "app.py")
+    assert [file.new_line_to_position(line) for line in (1, 2, 3, 4)] == [1, 2, 3, 4]
+    assert file.hunks[1].position == 5
+    assert file.new_line_to_position(11) == 6
+    assert file.new_line_to_position(12) == 9
+    assert file.new_line_to_position(5) is None
+    assert file.new_line_to_position(13) is None
+
+
+def test_hunks_touching_and_windows():
+    file = parse_patch(PATCH, "app.py")
+    assert file.hunks_touching(3, 3) == file.hunks[:1]
+    assert file.hunks_touching(5, 10) == []
+    assert file.hunks_touching(4, 11) == file.hunks
+    assert file.context_windows(2) == [(1, 6), (9, 14)]
+    # 相邻的窗口也会合并
+    assert file.context_windows(3) == [(1, 15)]
+    assert file.context_windows(2, total_lines=13) == [(1, 6), (9, 13)]
+
+
+def test_pure_deletion_hunk():
+    file = parse_patch("@@ -5,2 +4,0 @@\n-a\n-b", "app.py")
+    hunk = file.hunks[0]
+    assert (hunk.new_start, hunk.new_end) == (4, 4)
+    assert list(hunk.removed) == [5, 6]
+    assert file.hunks_touching(4, 4) == [hunk]
+    assert file.new_line_to_position(4) is None
+
+
+def test_empty_patch():
+    file = parse_patch(None, "image.png")
+    assert (file.hunks, file.hunk_count, file.size) == ([], 0, 0)
+
+
+DIFF = [
+    "diff --git a/old name.py b/new name.py",
+    "similarity index 90%",
+    "rename from old name.py",
+    "rename to new name.py",
+    "--- a/old name.py",
+    "+++ b/new name.py",
+    "@@ -1 +1 @@",
+    "-x = 1",
+    "+x = 2",
+    "diff --git a/logo.png b/logo.png",
+    "index 1111111..2222222 100644",
+    "Binary files a/logo.png and b/logo.png differ",
+    "diff --git a/moved.txt b/renamed.txt",
+    "similarity index 100%",
+    "rename from moved.txt",
+    "rename to renamed.txt",
+    "diff --git a/gone.py b/gone.py",
+    "deleted file mode 100644",
+    "--- a/gone.py",
+    "+++ /dev/null",
+    "@@ -1,2 +0,0 @@",
+    "-a",
+    "-b",
+    "diff --git a/new.py b/new.py",
+    "new file mode 100644",
+    "--- /dev/null",
+    "+++ b/new.py",
+    "@@ -0,0 +1 @@",
+    "+print('hi')",
+]
+
+
+def test_unified_diff_files():
+    files = list(parse_unified_diff(DIFF))
+    assert [(f.path, f.status, f.previous_path) for f in files] == [
+        ("new name.py", "renamed", "old name.py"),
+        ("logo.png", "modified", None),
+        ("renamed.txt", "renamed", "moved.txt"),
+        ("gone.py", "removed", None),
+        ("new.py", "added", None),
+    ]
+    renamed, binary, moved, gone, added = files
+    assert (renamed.additions, renamed.deletions, renamed.hunks[0].old_count) == (1, 1, 1)
+    assert binary.binary and not binary.hunks
+    assert not moved.binary and moved.hunk_count == 0
+    assert list(gone.hunks[0].removed) == [1, 2]
+    assert list(added.changed_lines()) == [1]
+    assert sum(f.size for f in files) == sum(len(line) + 1 for line in DIFF)
+
+
+def test_unified_diff_bytes_and_keep():
+    lines = [line.encode("utf-8") for line in DIFF]
+    files = list(parse_unified_diff(lines, keep=lambda file: not file.path.endswith(".py")))
+    renamed = files[0]
+    # 不保留的文件只统计数量
+    assert renamed.hunks == [] and renamed.hunk_count == 1 and renamed.additions == 1
+    assert files[-1].hunks == [] and files[-1].hunk_count == 1
+
+
+if __name__ == "__main__":
+    test_hunks_and_line_numbers()
+    test_positions()
+    test_hunks_touching_and_windows()
+    test_pure_deletion_hunk()
+    test_empty_patch()
+    test_unified_diff_files()
+    test_unified_diff_bytes_and_keep()
+    print("OK")
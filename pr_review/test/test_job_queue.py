@@ -0,0 +1,176 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from job_queue import JOB_DEAD, JOB_DONE, JOB_QUEUED, LocalJobQueue, MongoJobQueue, ReviewWorkerPool, retry_delay
+
+
+def queues(**options):
+    # 有 mongomock 时同时测试 MongoJobQueue
+    result = [LocalJobQueue(**options)]
+    try:
+        import mongomock
+    except ImportError:
+        return result
+    result.append(MongoJobQueue(mongomock.MongoClient()["pr_review"]["review_jobs"], **options))
+    return result
+
+
+def payload(repo="o/r", number=1):
+    return {"repository": {"full_name": repo},
+            "pull_request": {"number": number, "changed_files": 1, "additions": 10, "deletions": 2}}
+
+
+def test_claim_in_order_once():
+    for queue in queues():
+        assert queue.enqueue("a", payload())
+        assert queue.enqueue("b", payload())
+        assert not queue.enqueue("a", payload())
+        assert queue.enqueue("later", payload(), delay=60)
+        assert queue.claim()["_id"] == "a"
+        assert queue.claim("later") is None
+        job = queue.claim()
+        assert (job["_id"], job["attempts"]) == ("b", 1)
+        assert queue.claim() is None
+
+
+def test_ready_grouped_by_repo():
+    for queue in queues():
+        queue.enqueue("a1", payload("o/a"))
+        queue.enqueue("b1", payload("o/b"))
+        queue.enqueue("a2", payload("o/a", 2))
+        groups = {group["repo"]: group for group in queue.ready(per_repo=1)}
+        assert groups["o/a"]["count"] == 2
+        assert [job["_id"] for job in groups["o/a"]["jobs"]] == ["a1"]
+        assert groups["o/b"]["count"] == 1
+
+
+def test_expired_lease_is_retried():
+    for queue in queues(lease_seconds=0):
+        queue.enqueue("a", payload())
+        assert queue.claim()["attempts"] == 1
+        # worker 崩溃后租约过期，任务被再次领取
+        job = queue.claim()
+        assert (job["_id"], job["attempts"]) == ("a", 2)
+
+
+def test_expired_lease_on_last_attempt_is_dead_lettered():
+    for queue in queues(max_attempts=2, lease_seconds=0):
+        queue.enqueue("a", payload())
+        queue.claim()
+        queue.claim()
+        assert queue.claim() is None
+        job = queue.get("a")
+        assert job["status"] == JOB_DEAD
+        assert job["last_error"] == "Lease expired on the last attempt"
+
+
+def test_lost_lease_cannot_finish_the_job():
+    for queue in queues(lease_seconds=0):
+        queue.enqueue("a", payload())
+        stale = queue.claim()
+        current = queue.claim()
+        assert not queue.complete(stale, {"stale": True})
+        assert queue.fail(stale, "too late") is None
+        assert queue.complete(current, {"ok": True})
+        job = queue.get("a")
+        assert (job["status"], job["result"], job["last_error"]) == (JOB_DONE, {"ok": True}, None)
+
+
+def test_fail_backs_off_then_dead_letters():
+    for queue in queues(max_attempts=2, backoff_base=10, backoff_max=600):
+        queue.enqueue("a", payload())
+        before = datetime.utcnow()
+        assert queue.fail(queue.claim(), "boom") == JOB_QUEUED
+        job = queue.get("a")
+        assert before + timedelta(seconds=7) < job["next_run_at"] < before + timedelta(seconds=13)
+        assert queue.claim() is None
+
+        queue.enqueue("b", payload())
+        queue.fail(queue.claim("b"), "boom")
+        # 退避结束后再次失败，重试次数用完
+        if isinstance(queue, LocalJobQueue):
+            queue._jobs["b"]["next_run_at"] = datetime.utcnow()
+        else:
+            queue.collection.update_one({"_id": "b"}, {"$set": {"next_run_at": datetime.utcnow()}})
+        assert queue.fail(queue.claim("b"), "boom again") == JOB_DEAD
+        assert queue.get("b")["last_error"] == "boom again"
+
+
+def test_retry_delay():
+    for _ in range(100):
+        assert 24 <= retry_delay(1, 30, 600) <= 36
+        assert 48 <= retry_delay(2, 30, 600) <= 72
+        assert 480 <= retry_delay(10, 30, 600) <= 720
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_worker_pool_retries_and_completes():
+    queue = LocalJobQueue(backoff_base=0)
+    calls = []
+
+    def handler(job):
+        calls.append(job["attempts"])
+        if job["attempts"] == 1:
+            raise RuntimeError("flaky")
+        return {"review": job["_id"]}
+
+    pool = ReviewWorkerPool(queue, handler, num_workers=2, poll_interval=0.01)
+    queue.enqueue("a", payload())
+    pool.start()
+    try:
+        wait_for(lambda: queue.get("a")["status"] == JOB_DONE)
+    finally:
+        pool.stop(timeout=5)
+    job = queue.get("a")
+    assert calls == [1, 2]
+    assert (job["attempts"], job["result"], job["last_error"]) == (2, {"review": "a"}, "flaky")
+
+
+def test_worker_pool_uses_scheduler():
+    queue = LocalJobQueue()
+    finished = []
+
+    class Scheduler:
+        # 只领取指定的任务，并记录每个任务的结束
+        def claim(self, queue):
+            return queue.claim("b")
+
+        def finish(self, job):
+            finished.append(job["_id"])
+
+    done = threading.Event()
+    pool = ReviewWorkerPool(queue, lambda job: done.set(), num_workers=1, poll_interval=0.01, scheduler=Scheduler())
+    queue.enqueue("a", payload())
+    queue.enqueue("b", payload())
+    pool.start()
+    try:
+        assert done.wait(5)
+        wait_for(lambda: finished)
+    finally:
+        pool.stop(timeout=5)
+    assert finished == ["b"]
+    assert queue.get("a")["status"] == JOB_QUEUED
+
+
+if __name__ == "__main__":
+    test_claim_in_order_once()
+    test_ready_grouped_by_repo()
+    test_expired_lease_is_retried()
+    test_expired_lease_on_last_attempt_is_dead_lettered()
+    test_lost_lease_cannot_finish_the_job()
+    test_fail_backs_off_then_dead_letters()
+    test_retry_delay()
+    test_worker_pool_retries_and_completes()
+    test_worker_pool_uses_scheduler()
+    print("OK")
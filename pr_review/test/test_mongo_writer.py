@@ -0,0 +1,104 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pymongo.errors import BulkWriteError
+
+from mongo_writer import MongoWriter
+
+
+class FakeCollection:
+    # 记录每次 bulk_write；errors 中的异常依次在写入时抛出
+    def __init__(self, name, writes, errors=()):
+        self.name = name
+        self.full_name = f"pr_review.{name}"
+        self.writes = writes
+        self.errors = list(errors)
+
+    def bulk_write(self, operations, ordered=True):
+        self.writes.append((self.name, list(operations), ordered))
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def test_runs_per_collection_in_submission_order():
+    writes = []
+    contents = FakeCollection("contents", writes)
+    conversations = FakeCollection("conversations", writes)
+    writer = MongoWriter(batch_size=100, flush_interval=0.01)
+    writer.submit(contents, "c1", "c2")
+    writer.submit(conversations, "u1")
+    writer.submit(contents, "c3")
+    writer.submit(conversations, "u2", "u3")
+    writer.start()
+    writer.stop(timeout=5)
+    # 内容总是在引用它的对话之前写入
+    assert writes == [
+        ("contents", ["c1", "c2"], True),
+        ("conversations", ["u1"], True),
+        ("contents", ["c3"], True),
+        ("conversations", ["u2", "u3"], True),
+    ]
+    stats = writer.stats()
+    assert (stats["submitted"], stats["written"], stats["batches"], stats["queued"]) == (6, 6, 4, 0)
+
+
+def test_batch_size():
+    writes = []
+    collection = FakeCollection("conversations", writes)
+    writer = MongoWriter(batch_size=2, flush_interval=0.01)
+    writer.submit(collection, "a", "b", "c")
+    writer.start()
+    writer.stop(timeout=5)
+    assert [operations for _, operations, _ in writes] == [["a", "b"], ["c"]]
+
+
+def test_retry_then_write():
+    writes = []
+    collection = FakeCollection("conversations", writes, [ConnectionError("primary stepped down")])
+    writer = MongoWriter(max_retries=2, retry_delay=0)
+    writer.flush([(collection, "a")])
+    assert len(writes) == 2
+    assert (writer.stats()["written"], writer.stats()["failed"]) == (1, 0)
+
+
+def test_dropped_after_retries():
+    writes = []
+    collection = FakeCollection("conversations", writes, [ConnectionError("down")] * 3)
+    other = FakeCollection("contents", writes)
+    writer = MongoWriter(max_retries=2, retry_delay=0)
+    writer.flush([(collection, "a"), (collection, "b"), (other, "c")])
+    # 第一次加两次重试后丢弃，后面其他集合的写入不受影响
+    assert [name for name, _, _ in writes] == ["conversations"] * 3 + ["contents"]
+    stats = writer.stats()
+    assert (stats["written"], stats["failed"]) == (1, 2)
+
+
+def test_write_errors_not_retried():
+    writes = []
+    error = BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate key"}]})
+    collection = FakeCollection("conversations", writes, [error])
+    writer = MongoWriter(max_retries=2, retry_delay=0)
+    writer.flush([(collection, "a"), (collection, "b"), (collection, "c")])
+    assert len(writes) == 1
+    assert (writer.stats()["written"], writer.stats()["failed"]) == (1, 2)
+
+
+def test_full_queue_drops():
+    writer = MongoWriter(max_queue=2)
+    collection = FakeCollection("conversations", [])
+    assert writer.submit(collection, "a")
+    assert not writer.submit(collection, "b", "c")
+    stats = writer.stats()
+    assert (stats["submitted"], stats["dropped"], stats["queued"]) == (2, 1, 2)
+
+
+if __name__ == "__main__":
+    test_runs_per_collection_in_submission_order()
+    test_batch_size()
+    test_retry_then_write()
+    test_dropped_after_retries()
+    test_write_errors_not_retried()
+    test_full_queue_drops()
+    print("OK")
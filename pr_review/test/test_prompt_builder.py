@@ -0,0 +1,42 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prompt_builder import PromptBuilder
+
+
+def change(filename, lines):
+    patch = "@@ -1,1 +1,%d @@\n" % lines + "".join(f"+value_{i} = {i}\n" for i in range(lines))
+    return {"filename": filename, "patch": patch, "full_content": ""}
+
+
+def test_fits_in_one_chunk():
+    chunks = PromptBuilder("gpt-4", budget=2000).build("Title: small\n", [change("a.py", 5), change("b.py", 5)])
+    assert len(chunks) == 1
+    assert chunks[0].files == ["a.py", "b.py"]
+
+
+def test_split_by_directory():
+    changes = [change("x/a.py", 60), change("x/b.py", 60), change("y/c.py", 60)]
+    chunks = PromptBuilder("gpt-4", budget=500).build("Title: large\n", changes)
+    assert [chunk.files for chunk in chunks] == [["x/a.py", "x/b.py"], ["y/c.py"]]
+    assert all(chunk.tokens <= 500 for chunk in chunks)
+
+
+def test_header_over_budget():
+    # 只有标题和描述就超出预算时报错，而不是生成空的或截断为负数长度的提示词
+    header = "Body: " + "long description " * 200
+    try:
+        PromptBuilder("gpt-4", budget=100).build(header, [change("a.py", 5)])
+    except ValueError as e:
+        assert "100 token budget" in str(e)
+    else:
+        assert False, "expected ValueError"
+
+
+if __name__ == "__main__":
+    test_fits_in_one_chunk()
+    test_split_by_directory()
+    test_header_over_budget()
+    print("OK")
@@ -1,10 +1,13 @@
 import os
+import sys
 import hmac
 import hashlib
 from time import sleep
 import openai
 from github import Github
-import re
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fetcher import PRFetcher
 
 
 # def preprocess_changes(changes_str):
@@ -23,7 +26,7 @@ import re
 # Set up OpenAI API client
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 # Set up GitHub API client
-gh = Github(os.environ.get("GITHUB_TOKEN"))
+gh = Github(os.environ.get("GITHUB_TOKEN"), per_page=100, pool_size=8, seconds_between_requests=0)
 
 # Get the code changes from the PR
 # gh_repo = gh.get_repo("pytorch/pytorch")
@@ -45,24 +48,9 @@ gh_pr = gh_repo.get_pull(37)
 # gh_repo = gh.get_repo("ProgPanda/GPT-Assist")
 # gh_pr = gh_repo.get_pull(8)
 
-# Extract issue description from the PR body
-ref_numbers = re.findall(r"#(\d+)", gh_pr.body)
-# 确定每个引用是Issue还是PR，并收集Issue的描述
-issues_description = ""
-for ref_number in ref_numbers:
-    issue_or_pr = gh_repo.get_issue(int(ref_number))
-    if issue_or_pr.pull_request is None:  # 这意味着它是一个Issue
-        issues_description += f"Issue #{ref_number}: {issue_or_pr.title}\n{issue_or_pr.body}\n\n"
-
-# Extract the code changes from the PR
-code_changes = []
-for file in gh_pr.get_files():
-    full_file_content = gh_repo.get_contents(file.filename, ref=gh_pr.head.sha).decoded_content.decode()
-    code_changes.append({
-        "filename": file.filename,
-        "patch": file.patch,
-        "full_content": full_file_content
-    })
+# Extract the referenced issues and the code changes from the PR in parallel
+issues_description, code_changes, fetch_timings = PRFetcher(max_workers=8).fetch(gh_repo, gh_pr)
+print(fetch_timings)
 
 # Concatenate the changes into a single string
 changes_str = "Title: " + gh_pr.title + "\n"
@@ -0,0 +1,112 @@
+import os
+import sys
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common import metrics
+from job_queue import LocalJobQueue
+from scheduler import LocalTokenLedger, ReviewScheduler, estimate_cost, parse_repo_values
+
+
+def payload(repo, changed_files=1, lines=10):
+    return {"repository": {"full_name": repo},
+            "pull_request": {"changed_files": changed_files, "additions": lines, "deletions": 0}}
+
+
+def claim_order(scheduler, queue, count):
+    order = []
+    for _ in range(count):
+        job = scheduler.claim(queue)
+        if job is None:
+            break
+        order.append(job["_id"])
+        scheduler.finish(job)
+    return order
+
+
+def fill(queue, repos, count):
+    for i in range(count):
+        for repo in repos:
+            queue.enqueue(f"{repo}-{i}", payload(repo))
+
+
+def test_repos_take_turns():
+    queue = LocalJobQueue()
+    fill(queue, ["o/a", "o/b"], 4)
+    order = claim_order(ReviewScheduler(LocalTokenLedger()), queue, 6)
+    assert [job_id[:3] for job_id in order] == ["o/a", "o/b"] * 3
+
+
+def test_weights():
+    # 权重为3的仓库得到3倍的份额，另一个仓库也不会等到前者的任务全部完成
+    queue = LocalJobQueue()
+    fill(queue, ["o/a", "o/b"], 10)
+    scheduler = ReviewScheduler(LocalTokenLedger(), weights=parse_repo_values("o/a=3,*=1"))
+    order = [job_id[:3] for job_id in claim_order(scheduler, queue, 8)]
+    assert order.count("o/a") == 6
+    assert order.count("o/b") == 2
+    assert "o/b" in order[:4]
+
+
+def test_idle_repo_cannot_save_credit():
+    queue = LocalJobQueue()
+    scheduler = ReviewScheduler(LocalTokenLedger())
+    fill(queue, ["o/a"], 4)
+    claim_order(scheduler, queue, 4)
+    fill(queue, ["o/a", "o/b"], 2)
+    queue.enqueue("o/a-late", payload("o/a"))
+    order = [job_id[:3] for job_id in claim_order(scheduler, queue, 4)]
+    assert order.count("o/b") == 2
+
+
+def test_small_jobs_first_then_aging():
+    queue = LocalJobQueue()
+    queue.enqueue("big", payload("o/a", changed_files=50, lines=2000))
+    queue.enqueue("small", payload("o/a"))
+    queue.enqueue("medium", payload("o/a", changed_files=5))
+    assert estimate_cost({"changed_files": 50, "additions": 2000}) > estimate_cost({"changed_files": 5})
+    assert claim_order(ReviewScheduler(LocalTokenLedger(), aging_seconds=600), queue, 1) == ["small"]
+
+    # 等待超过 aging_seconds 的大任务优先
+    queue._jobs["big"]["next_run_at"] -= timedelta(seconds=700)
+    assert claim_order(ReviewScheduler(LocalTokenLedger(), aging_seconds=600), queue, 2) == ["big", "medium"]
+
+
+def test_token_budget_holds_repo_back():
+    queue = LocalJobQueue()
+    ledger = LocalTokenLedger()
+    fill(queue, ["o/a", "o/b"], 2)
+    scheduler = ReviewScheduler(ledger, budgets=parse_repo_values("o/a=1000"))
+    ledger.add("o/a", 1000)
+    assert [job_id[:3] for job_id in claim_order(scheduler, queue, 3)] == ["o/b", "o/b"]
+
+
+def test_running_jobs_count_against_budget():
+    queue = LocalJobQueue()
+    ledger = LocalTokenLedger()
+    fill(queue, ["o/a"], 3)
+    cost = estimate_cost({"changed_files": 1, "additions": 10})
+    scheduler = ReviewScheduler(ledger, budgets={"o/a": cost * 2 - 1})
+    first = scheduler.claim(queue)
+    second = scheduler.claim(queue)
+    assert second is not None
+    # 两个任务估算的剩余用量已经超出预算
+    assert scheduler.claim(queue) is None
+
+    # 实际用量由 LLMGateway 在任务的 trace 中报告
+    with metrics.trace(first["_id"]):
+        scheduler.record_usage("gpt-4", "review", {"total_tokens": 100})
+    scheduler.finish(first)
+    assert ledger.used(["o/a"]) == {"o/a": 100}
+    assert scheduler.claim(queue) is not None
+
+
+if __name__ == "__main__":
+    test_repos_take_turns()
+    test_weights()
+    test_idle_repo_cannot_save_credit()
+    test_small_jobs_first_then_aging()
+    test_token_budget_holds_repo_back()
+    test_running_jobs_count_against_budget()
+    print("OK")
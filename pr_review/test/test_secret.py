@@ -3,6 +3,7 @@ import json
 import hmac
 import hashlib
 import os
+import time
 
 # Replace these variables with your own values
 url = os.environ.get("TEST_REVIEW_ENDPOINT", "http://127.0.0.1:8080/review_pr")
@@ -66,3 +67,13 @@ headers["X-Hub-Signature-256"] = create_signature(payload, secret)
 response = requests.post(url, json=payload, headers=headers)
 print(response.status_code)
 print(response.text)
+
+# The review runs in the background, poll the job status until it finishes
+if response.status_code == 202:
+    status_url = requests.compat.urljoin(url, response.json()["status_url"])
+    while True:
+        job = requests.get(status_url).json()
+        print(job["status"], job["attempts"], job["last_error"])
+        if job["status"] in ("done", "dead"):
+            break
+        time.sleep(5)